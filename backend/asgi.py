@@ -0,0 +1,214 @@
+"""
+Async serving mode. Same /heartbeat, /stats, /metrics, /init, /chat, /chat/stream and /close contract as main.py,
+served by FastAPI on one event loop. Answers stream through LangChain's astream (guardrail batches
+and background summaries keep their worker threads), Firestore, session store I/O and the first build of
+a model's client run in threads, and each user's turns are serialized by an asyncio lock.
+PT_WARMUP builds the clients at startup instead, see main.py.
+
+Run with: uvicorn asgi:app --host 0.0.0.0 --port 5000
+"""
+import asyncio
+import weakref
+from time import time
+from fastapi import FastAPI, Request
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
+from metrics import metrics
+from scheduler import Overloaded
+from database import user_doc_id
+# the Flask app owns the session pool, both serving modes share it
+from main import pool, sse_event, collect_stats
+
+app = FastAPI()
+app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
+session_locks = weakref.WeakValueDictionary() # api_id -> asyncio.Lock, dropped once nobody holds it
+
+
+def session_lock(api_id: str) -> asyncio.Lock:
+    """
+    Used so one user's turns run one after the other while other users are served concurrently
+    """
+    lock = session_locks.get(api_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        session_locks[api_id] = lock
+    return lock
+
+
+@app.get('/heartbeat')
+async def heartbeat():
+    """Simple route to check if the API is running"""
+    return {"status": "alive", "message": "API is running"}
+
+
+@app.get('/stats')
+async def stats():
+    """Counters used to see how much work the caches and background workers save"""
+    return collect_stats()
+
+
+@app.get('/metrics')
+async def metrics_endpoint():
+    """Stage latencies, token counts and the /stats counters in the Prometheus text format"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.post('/init')
+async def init(request: Request):
+    """
+    Initialize the database for a user, same payload as main.py's /init
+    """
+    data = await request.json()
+    userfname = data.get('userfname')
+    userlname = data.get('userlname')
+    start_time = time()
+    api_id = user_doc_id(userfname, userlname)
+
+    async with session_lock(api_id):
+        cur_db = await asyncio.to_thread(pool.open, api_id, userfname, userlname, str(request.url))
+        payload = cur_db.history_payload(data.get('cursor'))
+        payload.update(cur_db.meal_plan.payload(data.get('meal_plan_version')))
+    end_time = time()
+    metrics.request_seconds.observe(end_time - start_time, "/init")
+
+    return {
+        "status": "success",
+        "message": "Database connection initialized",
+        **payload,
+        "latency": end_time - start_time
+    }
+
+
+@app.post('/chat')
+async def chat(request: Request):
+    """
+    Chat endpoint that processes user messages. Same payload as main.py's /chat
+    """
+    try:
+        start_time = time()
+        data = await request.json()
+        if not data:
+            return JSONResponse({"error": "No data provided"}, status_code=400)
+
+        message = data.get('message')
+        userfname = data.get('userfname')
+        userlname = data.get('userlname')
+        model = data.get('model')
+        if not userfname or not userlname:
+            return JSONResponse({"error": "Invalid user credentials"}, status_code=401)
+        api_id = user_doc_id(userfname, userlname)
+
+        async with session_lock(api_id):
+            with metrics.trace() as stages:
+                cur_db = await asyncio.to_thread(pool.acquire, api_id, userfname, userlname, str(request.url))
+                try:
+                    cur_db.model = model
+                    ai_response = await cur_db.acall_chat(message)
+                finally:
+                    await asyncio.to_thread(pool.release, api_id)
+
+        end_time = time()
+        metrics.request_seconds.observe(end_time - start_time, "/chat")
+        response = {
+            "status": "success",
+            "response": ai_response,
+            **cur_db.meal_plan.payload(data.get('meal_plan_version')),
+            "latency": end_time - start_time,
+            "langchain_rtt": cur_db.last_langchain_rtt,
+            "prompt_tokens": cur_db.last_prompt_tokens
+        }
+        if data.get('stages'):
+            response["stage_latency"] = {**stages, **cur_db.last_stage_latency}
+        return response
+    except Overloaded as e:
+        return JSONResponse({"error": str(e), "retry_after": e.retry_after}, status_code=429, headers={"Retry-After": str(e.retry_after)})
+    except Exception as e:
+        print(e)
+        metrics.request_errors.inc(1, "/chat")
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+@app.post('/chat/stream')
+async def chat_stream(request: Request):
+    """
+    Streaming version of /chat, same Server-Sent Events as main.py's /chat/stream
+    """
+    start_time = time()
+    data = await request.json()
+    if not data:
+        return JSONResponse({"error": "No data provided"}, status_code=400)
+
+    message = data.get('message')
+    userfname = data.get('userfname')
+    userlname = data.get('userlname')
+    model = data.get('model')
+    if not userfname or not userlname:
+        return JSONResponse({"error": "Invalid user credentials"}, status_code=401)
+    api_id = user_doc_id(userfname, userlname)
+    url = str(request.url)
+
+    async def generate():
+        async with session_lock(api_id):
+            try:
+                with metrics.trace() as stages: # Firestore reads of a rehydrated session
+                    cur_db = await asyncio.to_thread(pool.acquire, api_id, userfname, userlname, url)
+            except Exception as e:
+                print(e)
+                yield sse_event({"error": str(e)}, event="error")
+                return
+            try:
+                cur_db.model = model
+                first_token_time = None
+                async for token in cur_db.acall_chat_stream(message):
+                    if first_token_time is None:
+                        first_token_time = time()
+                    yield sse_event({"token": token})
+                end_time = time()
+                metrics.request_seconds.observe(end_time - start_time, "/chat/stream")
+                yield sse_event({
+                    "status": "success",
+                    **cur_db.meal_plan.payload(data.get('meal_plan_version')),
+                    "latency": end_time - start_time,
+                    "time_to_first_token": (first_token_time or end_time) - start_time,
+                    "stage_latency": {**stages, **cur_db.last_stage_latency},
+                    "langchain_rtt": cur_db.last_langchain_rtt,
+                    "prompt_tokens": cur_db.last_prompt_tokens
+                }, event="done")
+            except Overloaded as e:
+                yield sse_event({"error": str(e), "retry_after": e.retry_after}, event="error")
+            except Exception as e:
+                print(e)
+                metrics.request_errors.inc(1, "/chat/stream")
+                yield sse_event({"error": str(e)}, event="error")
+            finally:
+                await asyncio.to_thread(pool.release, api_id)
+
+    return StreamingResponse(generate(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
+
+@app.post('/close')
+async def close(request: Request):
+    """
+    Close the database for a user
+    """
+    start_time = time()
+    data = await request.json()
+    userfname = data.get('userfname')
+    userlname = data.get('userlname')
+    api_id = user_doc_id(userfname, userlname)
+
+    try:
+        async with session_lock(api_id):
+            cur_db = await asyncio.to_thread(pool.remove, api_id, userfname, userlname, str(request.url))
+            if cur_db is None: # evicted sessions were already saved
+                return JSONResponse({"error": "Session not found"}, status_code=404)
+            _, message = await asyncio.to_thread(cur_db.close, False) # saved with the next write-behind batch
+        metrics.request_seconds.observe(time() - start_time, "/close")
+        return {"status": "success", "message": message}
+    except Exception as e:
+        print(e)
+        metrics.request_errors.inc(1, "/close")
+        return JSONResponse({"error": str(e)}, status_code=500)
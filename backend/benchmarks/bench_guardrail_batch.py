@@ -0,0 +1,64 @@
+"""
+Offline benchmark of guardrail micro-batching. Checks arrive at a steady rate from many users and are sent to a
+fake model either one call per check or through a GuardrailBatcher. Reports model calls, checks per call and
+p50/p95 check latency per window size.
+
+Usage (from backend/): python benchmarks/bench_guardrail_batch.py [checks] [checks per second]
+"""
+import os
+import sys
+import random
+from time import perf_counter, sleep
+from concurrent.futures import ThreadPoolExecutor
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("PT_FIRESTORE_BACKEND", "memory")
+
+from fakes import FakeChatModel
+from models import model_registry
+model_registry.register_provider("openai", lambda model, **params: FakeChatModel(model=model, latency=0.3, latency_sigma=0.2), prefix="gpt")
+from database import classify_guardrails
+from guardrails import GuardrailBatcher
+from metrics import metrics
+
+WINDOWS = [0.002, 0.005, 0.02]
+
+
+def percentile(samples: list[float], p: float) -> float:
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * p), len(samples) - 1)]
+
+
+def llm_calls() -> float:
+    return sum(metrics.llm_calls.values.values())
+
+
+def run(checks: int, rate: float, check) -> tuple[list[float], float]:
+    """ Latency of every check and the model calls made, checks arriving rate per second """
+    def timed(i: int):
+        start = perf_counter()
+        check(f"is it fine to have message {i} before bed?")
+        return perf_counter() - start
+    calls = llm_calls()
+    random.seed(0)
+    with ThreadPoolExecutor(256) as pool:
+        futures = []
+        for i in range(checks):
+            futures.append(pool.submit(timed, i))
+            sleep(random.expovariate(rate))
+        latencies = [f.result() for f in futures]
+    return latencies, llm_calls() - calls
+
+
+def main(checks: int, rate: float):
+    print(f"{checks} checks arriving at {rate:.0f}/s, fake model answers in ~300 ms")
+    print(f"{'mode':<22}{'model calls':>12}{'checks/call':>13}{'p50 (ms)':>10}{'p95 (ms)':>10}")
+    modes = {"one call per check": lambda m: classify_guardrails([m])[0]}
+    for window in WINDOWS:
+        modes[f"batched, {window * 1e3:g} ms window"] = GuardrailBatcher(classify_guardrails, window=window).check
+    for mode, check in modes.items():
+        latencies, calls = run(checks, rate, check)
+        print(f"{mode:<22}{calls:>12.0f}{checks / calls:>13.1f}{percentile(latencies, 0.5) * 1e3:>10.0f}{percentile(latencies, 0.95) * 1e3:>10.0f}")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 400, float(sys.argv[2]) if len(sys.argv) > 2 else 200)
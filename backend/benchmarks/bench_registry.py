@@ -0,0 +1,58 @@
+"""
+Micro-benchmark of the per-call overhead of getting a chat model client.
+"before" builds the client and chain on every call like invoke_chat and chat_guardrails used to,
+"after" goes through the shared ModelRegistry. Calls go to a stubbed provider so no network is used.
+
+Usage (from backend/): python benchmarks/bench_registry.py [iterations]
+"""
+import os
+import sys
+from time import perf_counter
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain_core.messages import HumanMessage
+from langchain_core.output_parsers import StrOutputParser, PydanticOutputParser
+from langchain_openai.chat_models import ChatOpenAI
+from fakes import FakeChatModel
+from guardrails import Guardrail
+from models import ModelRegistry, model_registry
+
+
+def per_call_us(fn, iterations: int) -> float:
+    fn() # warm up
+    start = perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (perf_counter() - start) / iterations * 1e6
+
+
+def main(iterations: int):
+    messages = [HumanMessage(content="how much water should I drink?")]
+    guard_messages = [HumanMessage(content="Return is_health_related for: how much water should I drink?")]
+
+    registry = ModelRegistry()
+    registry.register_provider("stub", lambda model, **params: FakeChatModel(model=model, **params), prefix="stub")
+
+    results = dict()
+    # stubbed provider: client construction + chain + invoke
+    results["stub str chain"] = (
+        per_call_us(lambda: (FakeChatModel(model="stub-1") | StrOutputParser()).invoke(messages), iterations),
+        per_call_us(lambda: registry.get_chain("str", "stub-1", lambda chat: chat | StrOutputParser()).invoke(messages), iterations),
+    )
+    results["stub guardrail chain"] = (
+        per_call_us(lambda: (FakeChatModel(model="stub-1") | PydanticOutputParser(pydantic_object=Guardrail)).invoke(guard_messages), iterations),
+        per_call_us(lambda: registry.get_chain("guardrail", "stub-1", lambda chat: chat | PydanticOutputParser(pydantic_object=Guardrail)).invoke(guard_messages), iterations),
+    )
+    # real OpenAI client construction, nothing is sent over the network
+    results["openai client + guardrail chain"] = (
+        per_call_us(lambda: ChatOpenAI(model="gpt-4o-mini", api_key="sk-bench") | PydanticOutputParser(pydantic_object=Guardrail), iterations),
+        per_call_us(lambda: model_registry.get_chain("guardrail", "gpt-4o-mini", lambda chat: chat | PydanticOutputParser(pydantic_object=Guardrail), api_key="sk-bench"), iterations),
+    )
+
+    print(f"{'case':<34}{'before (us/call)':>18}{'after (us/call)':>18}{'speedup':>10}")
+    for case, (before, after) in results.items():
+        print(f"{case:<34}{before:>18.1f}{after:>18.1f}{before / after:>9.1f}x")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
@@ -0,0 +1,60 @@
+"""
+Benchmark of the long-term memory search used by call_chat. Builds histories of synthetic turns,
+then times search() (what every turn pays), reloading a saved index and its size on disk.
+
+Usage (from backend/): python benchmarks/bench_retrieval.py [turns ...]
+"""
+import os
+import sys
+import random
+import tempfile
+from time import perf_counter
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from retrieval import UserHistory
+
+TOPICS = ["protein", "squats", "sleep", "hydration", "creatine", "marathon", "knee pain", "keto", "bench press",
+          "vegetarian", "calories", "stretching", "cardio", "lactose", "snacks", "deadlift", "vitamin d", "fasting"]
+WORDS = ("how much should i eat before after my workout is it fine to do every day what about the weekend "
+         "my goal is to lose weight gain muscle feel better recover faster with less soreness").split()
+
+
+def fake_turn(rng: random.Random) -> tuple[str, str]:
+    topic = rng.choice(TOPICS)
+    human = " ".join(rng.choices(WORDS, k=12)) + " " + topic
+    ai = " ".join(rng.choices(WORDS, k=40)) + f" {topic} " + " ".join(rng.choices(WORDS, k=20))
+    return human, ai
+
+
+def percentile(samples: list[float], p: float) -> float:
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * p), len(samples) - 1)]
+
+
+def main(sizes: list[int], queries: int = 200):
+    rng = random.Random(0)
+    print(f"{'turns':>8}{'p50 search (ms)':>18}{'p95 search (ms)':>18}{'load (ms)':>12}{'index (KB)':>12}{'log (KB)':>10}")
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            history = UserHistory("bench", directory)
+            for start in range(0, size, 500):
+                history.append([fake_turn(rng) for _ in range(min(500, size - start))])
+            history.save()
+
+            timings = []
+            for _ in range(queries):
+                query = " ".join(rng.choices(WORDS, k=8)) + " " + rng.choice(TOPICS)
+                start = perf_counter()
+                history.search(query, exclude_last=3)
+                timings.append((perf_counter() - start) * 1e3)
+
+            start = perf_counter()
+            UserHistory("bench", directory)
+            load_ms = (perf_counter() - start) * 1e3
+            index_kb = os.path.getsize(history.index_path) / 1024
+            log_kb = os.path.getsize(history.log_path) / 1024
+        print(f"{size:>8}{percentile(timings, 0.5):>18.2f}{percentile(timings, 0.95):>18.2f}{load_ms:>12.1f}{index_kb:>12.0f}{log_kb:>10.0f}")
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [100, 1000, 5000, 20000])
@@ -0,0 +1,76 @@
+"""
+Offline benchmark of the routing layer. The primary fake provider has a slow tail (a few percent of calls
+take seconds longer) or fails part of its calls, the fallback is a healthy fake. Compares calling the
+primary directly with going through the Router, with and without hedging.
+
+Usage (from backend/): python benchmarks/bench_routing.py [calls]
+"""
+import os
+import sys
+import random
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain_core.messages import HumanMessage
+from fakes import FakeChatModel
+from models import ModelRegistry
+from routing import Router
+
+MESSAGES = [HumanMessage(content="how much water should I drink?")]
+
+
+def percentile(samples: list[float], p: float) -> float:
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * p), len(samples) - 1)]
+
+
+def build_registry(primary: dict) -> ModelRegistry:
+    registry = ModelRegistry()
+    registry.register_provider("primary", lambda model, **params: FakeChatModel(model=model, **primary), prefix="primary")
+    registry.register_provider("fallback", lambda model, **params: FakeChatModel(model=model, latency=0.05, latency_sigma=0.2), prefix="fallback")
+    return registry
+
+
+def run(calls: int, call) -> tuple[list[float], int]:
+    """ Latencies of the successful calls and the number of failures, 16 calls at a time """
+    def timed(_):
+        start = perf_counter()
+        try:
+            call()
+        except Exception:
+            return None
+        return perf_counter() - start
+    with ThreadPoolExecutor(16) as pool:
+        results = list(pool.map(timed, range(calls)))
+    return [r for r in results if r is not None], sum(1 for r in results if r is None)
+
+
+def scenario(name: str, primary: dict, calls: int):
+    print(f"\n{name}")
+    print(f"{'mode':<22}{'p50 (ms)':>10}{'p95 (ms)':>10}{'p99 (ms)':>10}{'errors':>8}{'hedges':>8}")
+    modes = {
+        "direct": None,
+        "router": Router(build_registry(primary), {"primary-1": "fallback-1"}, deadline=5, backoff=0.01, hedge=False),
+        "router + hedging": Router(build_registry(primary), {"primary-1": "fallback-1"}, deadline=5, backoff=0.01, hedge=True),
+    }
+    for mode, router in modes.items():
+        random.seed(0)
+        if router is None:
+            chat = build_registry(primary).get_chat("primary-1")
+            call = lambda: chat.invoke(MESSAGES)
+        else:
+            call = lambda: router.invoke("primary-1", lambda model: router.registry.get_chat(model).invoke(MESSAGES))
+        latencies, errors = run(calls, call)
+        hedges = router.stats().get("primary:primary-1", {}).get("hedges", 0) if router is not None else 0
+        print(f"{mode:<22}{percentile(latencies, 0.5) * 1e3:>10.0f}{percentile(latencies, 0.95) * 1e3:>10.0f}"
+              f"{percentile(latencies, 0.99) * 1e3:>10.0f}{errors:>8}{hedges:>8}")
+
+
+def main(calls: int):
+    scenario("slow tail: 5% of primary calls take 1s longer", {"latency": 0.05, "latency_sigma": 0.2, "tail_probability": 0.05, "tail_latency": 1.0}, calls)
+    scenario("flaky: 20% of primary calls fail", {"latency": 0.05, "latency_sigma": 0.2, "error_rate": 0.2}, calls)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 400)
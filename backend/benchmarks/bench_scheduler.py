@@ -0,0 +1,118 @@
+"""
+Offline benchmark of LLM admission control. A traffic spike hits a simulated provider that serves 8 calls at
+full speed and slows down for everyone past that (like a provider throttling an account): regular users send
+a few questions each, one user fires a burst of questions at once, and the summaries of every turn run in
+the background. Every question is a guardrail call and an answer call running side by side.
+Compares sending every call straight to the provider with queueing them in a Scheduler, with and without
+an SLO, and reports per-group latency and the share of each group's questions that got a 429.
+
+Usage (from backend/): python benchmarks/bench_scheduler.py [users] [burst]
+"""
+import os
+import sys
+import random
+import threading
+from time import perf_counter, sleep
+from concurrent.futures import ThreadPoolExecutor
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scheduler import Scheduler, Overloaded, GUARDRAIL, INTERACTIVE, BACKGROUND
+
+CAPACITY = 8 # calls the provider serves at full speed
+CALL_SECONDS = 0.2
+GUARDRAIL_SECONDS = 0.1
+
+
+class SimulatedProvider:
+    """ Every call takes seconds, stretched by how far past CAPACITY the calls in flight are """
+    def __init__(self):
+        self.in_flight = 0
+        self.lock = threading.Lock()
+
+    def call(self, seconds: float = CALL_SECONDS):
+        with self.lock:
+            self.in_flight += 1
+            load = max(self.in_flight / CAPACITY, 1.0)
+        sleep(seconds * load * random.uniform(0.8, 1.2))
+        with self.lock:
+            self.in_flight -= 1
+
+
+def percentile(samples: list[float], p: float) -> float:
+    if len(samples) == 0:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * p), len(samples) - 1)]
+
+
+def workload(users: int, burst: int) -> list[tuple[float, str, str, str]]:
+    """ (start offset, group, user, priority) of every call, over about 2 seconds """
+    random.seed(0)
+    calls = []
+    for u in range(users):
+        for _ in range(3):
+            start = random.uniform(0, 2)
+            calls.append((start, "users", f"user-{u}", INTERACTIVE))
+            calls.append((start + 0.3, "summaries", f"user-{u}", BACKGROUND))
+    calls += [(0.5 + i * 0.001, "burst", "burst-user", INTERACTIVE) for i in range(burst)]
+    return sorted(calls)
+
+
+def run(calls: list, scheduler: Scheduler = None) -> dict:
+    """ Latency of every answered call per group, and the calls turned away """
+    provider = SimulatedProvider()
+    latencies = {"users": [], "burst": [], "summaries": []}
+    rejected = {"users": 0, "burst": 0, "summaries": 0}
+
+    def call(user: str, priority: str, seconds: float = CALL_SECONDS):
+        if scheduler is None:
+            provider.call(seconds)
+        else:
+            with scheduler.slot("simulated", user, priority):
+                provider.call(seconds)
+
+    def one(group: str, user: str, priority: str):
+        start = perf_counter()
+        try:
+            if priority == INTERACTIVE:
+                if scheduler is not None:
+                    scheduler.admit("simulated", user)
+                guardrail = guardrails.submit(call, "guardrails", GUARDRAIL, GUARDRAIL_SECONDS)
+                call(user, priority)
+                guardrail.result()
+            else:
+                call(user, priority)
+        except Overloaded:
+            rejected[group] += 1
+            return
+        latencies[group].append(perf_counter() - start)
+
+    begin = perf_counter()
+    with ThreadPoolExecutor(512) as pool, ThreadPoolExecutor(512) as guardrails:
+        for offset, group, user, priority in calls:
+            sleep(max(begin + offset - perf_counter(), 0))
+            pool.submit(one, group, user, priority)
+    return {"latencies": latencies, "rejected": rejected}
+
+
+def main(users: int, burst: int):
+    calls = workload(users, burst)
+    print(f"{users} users x 3 questions + a {burst} question burst from one user, a background summary per question")
+    print(f"provider serves {CAPACITY} calls at ~{CALL_SECONDS * 1e3:.0f} ms, slower for everyone past that")
+    modes = {
+        "no scheduler": None,
+        "fair queue, no SLO": Scheduler(concurrency=CAPACITY, tokens_per_minute=0, budgets={}, slo=float("inf"), max_wait=60),
+        "fair queue, 1 s SLO": Scheduler(concurrency=CAPACITY, tokens_per_minute=0, budgets={}, slo=1.0, max_wait=60),
+    }
+    asked = {group: sum(1 for c in calls if c[1] == group) for group in ("users", "burst")}
+    print(f"{'mode':<22}{'users p50':>10}{'users p95':>10}{'burst p95':>10}{'summ. p95':>10}{'users 429':>11}{'burst 429':>11}  (ms, % of questions)")
+    for mode, scheduler in modes.items():
+        result = run(calls, scheduler)
+        latencies = {group: [s * 1e3 for s in samples] for group, samples in result["latencies"].items()}
+        print(f"{mode:<22}{percentile(latencies['users'], 0.5):>10.0f}{percentile(latencies['users'], 0.95):>10.0f}"
+              f"{percentile(latencies['burst'], 0.95):>10.0f}{percentile(latencies['summaries'], 0.95):>10.0f}"
+              f"{result['rejected']['users'] / asked['users']:>11.0%}{result['rejected']['burst'] / asked['burst']:>11.0%}")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 16, int(sys.argv[2]) if len(sys.argv) > 2 else 60)
@@ -0,0 +1,88 @@
+"""
+Cold start benchmark: time from a fresh interpreter to the app's first answers, each run in its own process.
+"eager" imports at startup what database.py and models.py used to (every provider package, firebase_admin
+and the tokenizer), "lazy" is the current behaviour and "lazy + warm-up" also sets PT_WARMUP.
+Firestore is the in-memory stand-in and the model is a fake, so no credentials or network are needed;
+the fake provider's factory still imports langchain_openai like openai_factory does.
+
+Usage (from backend/): python benchmarks/bench_startup.py [runs]
+"""
+import os
+import sys
+import json
+import tempfile
+import threading
+import subprocess
+from time import perf_counter
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EAGER_IMPORTS = ["langchain_openai.chat_models", "langchain_google_genai.chat_models", "langchain_ollama.chat_models", "firebase_admin.firestore"]
+MODES = {"eager": {}, "lazy": {}, "lazy + warm-up": {"PT_WARMUP": "gpt-4o-mini"}}
+
+
+def child(mode: str):
+    """ Runs in the measured process, prints its timings as JSON """
+    start = perf_counter()
+    sys.path.insert(0, BACKEND)
+    if mode == "eager":
+        import importlib
+        for module in EAGER_IMPORTS:
+            importlib.import_module(module)
+        try:
+            import tiktoken
+            tiktoken.get_encoding("o200k_base")
+        except Exception:
+            pass
+    from fakes import FakeChatModel
+    from models import model_registry
+
+    def fake_openai(model: str, **params):
+        from langchain_openai.chat_models import ChatOpenAI # what openai_factory pays on first use
+        return FakeChatModel(model=model)
+    model_registry.register_provider("openai", fake_openai, prefix="gpt")
+    import main
+    imported = perf_counter()
+    client = main.app.test_client()
+    client.get("/heartbeat")
+    heartbeat = perf_counter()
+    # users arrive after the health check passes, warm-up has had its chance to finish by then
+    for thread in threading.enumerate():
+        if thread.name == "warm-up":
+            thread.join()
+    credentials = {"userfname": "cold", "userlname": "start"}
+    request_start = perf_counter()
+    client.post("/init", json=credentials)
+    response = client.post("/chat", json={**credentials, "message": "how much water should I drink?", "model": "gpt-4o-mini"})
+    chat = perf_counter()
+    assert response.status_code == 200, response.json
+    print(json.dumps({"import": imported - start, "first_heartbeat": heartbeat - start, "first_chat": chat - start, "first_user": chat - request_start}))
+
+
+def run(mode: str, env: dict) -> dict:
+    env = {**os.environ, "PT_FIRESTORE_BACKEND": "memory", "RETRIEVAL_DIR": tempfile.mkdtemp(prefix="pt-startup-"), **env}
+    start = perf_counter()
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", mode], env=env, cwd=BACKEND,
+                            capture_output=True, text=True, check=True).stdout
+    timings = json.loads(output.strip().splitlines()[-1])
+    timings["process"] = perf_counter() - start
+    return timings
+
+
+def median(values: list[float]) -> float:
+    return sorted(values)[len(values) // 2]
+
+
+def main(runs: int):
+    print("milliseconds from interpreter start, except first user: /init + /chat of the first user")
+    print(f"{'mode':<18}{'import':>9}{'heartbeat':>11}{'first /chat':>13}{'process':>9}{'first user':>12}")
+    for mode, env in MODES.items():
+        results = [run("eager" if mode == "eager" else "lazy", env) for _ in range(runs)]
+        row = {k: median([r[k] for r in results]) * 1e3 for k in ("import", "first_heartbeat", "first_chat", "process", "first_user")}
+        print(f"{mode:<18}{row['import']:>9.0f}{row['first_heartbeat']:>11.0f}{row['first_chat']:>13.0f}{row['process']:>9.0f}{row['first_user']:>12.0f}")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == "--child":
+        child(sys.argv[2])
+    else:
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
@@ -0,0 +1,272 @@
+"""
+Load test of the whole backend, offline. Boots the app in-process against the in-memory Firestore stand-in
+(PT_FIRESTORE_BACKEND=memory) and fake chat models with a configurable latency and token rate, then drives
+virtual users through /init -> N x /chat -> /close at a given concurrency.
+Reports throughput, p50/p95/p99 per endpoint and per stage, and memory per live session, saves the results
+as JSON and can compare them with an earlier run.
+
+Usage (from backend/):
+    python benchmarks/loadtest.py --users 100 --concurrency 20 --turns 5
+    python benchmarks/loadtest.py --stream --app asgi --compare benchmarks/results/baseline.json
+"""
+import os
+import sys
+import json
+import random
+import argparse
+import tempfile
+import tracemalloc
+import threading
+from datetime import datetime
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+SCRIPT = [
+    "How much protein should I eat per day to build muscle?",
+    "Is it fine to do squats every day?",
+    "What should I eat before a morning run?",
+    "How much water should I drink when I train?",
+    "Can you change my meal plan to have more vegetables at dinner?",
+    "Is creatine safe to take every day?",
+    "How many hours of sleep do I need to recover?",
+    "What is a good stretching routine after lifting?",
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50, help="virtual users, each one runs a whole session")
+    parser.add_argument("--concurrency", type=int, default=10, help="virtual users running at the same time")
+    parser.add_argument("--turns", type=int, default=5, help="/chat calls per session")
+    parser.add_argument("--latency", type=float, default=0.2, help="fake model time to first token, seconds")
+    parser.add_argument("--tokens-per-second", type=float, default=100, help="fake model token rate")
+    parser.add_argument("--firestore-latency", type=float, default=0.02, help="seconds per Firestore round trip")
+    parser.add_argument("--stream", action="store_true", help="use /chat/stream instead of /chat")
+    parser.add_argument("--app", choices=["flask", "asgi"], default="flask")
+    parser.add_argument("--cache-friendly", action="store_true", help="every user asks the exact same questions")
+    parser.add_argument("--memory-sessions", type=int, default=20, help="live sessions used to measure memory per session")
+    parser.add_argument("--out", default=None, help="where to save the results, defaults to benchmarks/results/")
+    parser.add_argument("--compare", default=None, help="earlier results to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative slowdown reported as a regression")
+    return parser.parse_args()
+
+
+def boot(args):
+    """
+    Import the app against the stand-ins. Has to run before anything imports database
+    """
+    os.environ["PT_FIRESTORE_BACKEND"] = "memory"
+    os.environ["PT_FIRESTORE_LATENCY"] = str(args.firestore_latency)
+    os.environ.setdefault("RETRIEVAL_DIR", tempfile.mkdtemp(prefix="pt-loadtest-"))
+    from fakes import FakeChatModel
+    from models import model_registry
+    fake = lambda model, **params: FakeChatModel(model=model, latency=args.latency, latency_sigma=0.2, tokens_per_second=args.tokens_per_second)
+    model_registry.register_provider("openai", fake, prefix="gpt")
+    model_registry.register_provider("google", fake, prefix="gemini")
+    import main
+    if args.app == "asgi":
+        from fastapi.testclient import TestClient
+        import asgi
+        return main, lambda: TestClient(asgi.app)
+    return main, main.app.test_client
+
+
+class Recorder:
+    """ Latencies per endpoint and per stage, from any thread """
+    def __init__(self):
+        self.samples = dict() # name -> list of seconds
+        self.errors = dict()
+        self.lock = threading.Lock()
+
+    def add(self, name: str, seconds: float):
+        with self.lock:
+            self.samples.setdefault(name, []).append(seconds)
+
+    def error(self, name: str):
+        with self.lock:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+
+def percentile(samples: list[float], p: float) -> float:
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * p), len(samples) - 1)]
+
+
+def summarize(samples: list[float]) -> dict:
+    return {
+        "count": len(samples),
+        "mean": sum(samples) / len(samples),
+        "p50": percentile(samples, 0.5),
+        "p95": percentile(samples, 0.95),
+        "p99": percentile(samples, 0.99),
+    }
+
+
+def done_event(body: str) -> dict:
+    """ Payload of the done event of a /chat/stream answer """
+    for event in body.split("\n\n"):
+        if event.startswith("event: done"):
+            return json.loads(event.split("data: ", 1)[1])
+    raise ValueError("stream ended without a done event")
+
+
+def post(client, path: str, payload: dict, stream: bool = False):
+    """ Returns (status code, json payload) """
+    response = client.post(path, json=payload)
+    try:
+        if stream:
+            body = response.data.decode() if hasattr(response, "data") else response.text
+            return response.status_code, done_event(body)
+        return response.status_code, (response.json if hasattr(response, "data") else response.json())
+    finally:
+        if hasattr(response, "close"):
+            response.close() # releases the user's turn lock for Flask streams
+
+
+def run_session(client, user: int, run_id: str, args, recorder: Recorder, close: bool = True):
+    rng = random.Random(user)
+    credentials = {"userfname": f"load{user}", "userlname": run_id}
+    timed(recorder, "init", lambda: post(client, "/init", credentials))
+    for turn in range(args.turns):
+        message = SCRIPT[(user + turn) % len(SCRIPT)]
+        if not args.cache_friendly:
+            message += f" I am {rng.randint(18, 70)} years old and weigh {rng.randint(50, 120)} kg."
+        path = "/chat/stream" if args.stream else "/chat"
+        payload = timed(recorder, path, lambda: post(client, path, {**credentials, "message": message, "model": "gpt-4o-mini", "stages": True}, args.stream))
+        if payload is None:
+            continue
+        for stage, seconds in payload.get("stage_latency", {}).items():
+            recorder.add("stage:" + stage, seconds)
+        if "time_to_first_token" in payload:
+            recorder.add("stage:time_to_first_token", payload["time_to_first_token"])
+        if "langchain_rtt" in payload:
+            recorder.add("stage:langchain_rtt", payload["langchain_rtt"])
+    if close:
+        timed(recorder, "close", lambda: post(client, "/close", credentials))
+
+
+def timed(recorder: Recorder, name: str, request):
+    start = perf_counter()
+    try:
+        status, payload = request()
+    except Exception as e:
+        print(f"{name} failed: ", e)
+        recorder.error(name)
+        return None
+    recorder.add(name, perf_counter() - start)
+    if status >= 400:
+        recorder.error(name)
+        return None
+    return payload
+
+
+def measure_memory(main, make_client, args, run_id: str) -> dict:
+    """
+    Memory held per live session: sessions are opened and chatted with but not closed
+    """
+    recorder = Recorder()
+    client = make_client()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for user in range(args.memory_sessions):
+        run_session(client, 100000 + user, run_id, args, recorder, close=False)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    pool_bytes = main.pool.stats()["bytes"]
+    for user in range(args.memory_sessions):
+        post(client, "/close", {"userfname": f"load{100000 + user}", "userlname": run_id})
+    return {
+        "sessions": args.memory_sessions,
+        "traced_bytes_per_session": (after - before) / max(args.memory_sessions, 1),
+        "pool_bytes_per_session": pool_bytes / max(args.memory_sessions, 1),
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> bool:
+    """
+    Print how latencies moved since baseline. Returns False if anything got slower than tolerance allows
+    """
+    ok = True
+    print(f"\n{'compared with ' + baseline['started']:<34}{'baseline p95':>14}{'now p95':>10}{'change':>9}")
+    for section in ("endpoints", "stages"):
+        for name, now in results[section].items():
+            before = baseline.get(section, {}).get(name)
+            if before is None or before["p95"] == 0:
+                continue
+            change = now["p95"] / before["p95"] - 1
+            flag = "  REGRESSION" if change > tolerance else ""
+            ok = ok and flag == ""
+            print(f"{name:<34}{before['p95'] * 1e3:>12.1f}ms{now['p95'] * 1e3:>8.1f}ms{change:>+9.0%}{flag}")
+    before, now = baseline["throughput"]["requests_per_second"], results["throughput"]["requests_per_second"]
+    change = now / before - 1 if before > 0 else 0
+    flag = "  REGRESSION" if change < -tolerance else ""
+    ok = ok and flag == ""
+    print(f"{'throughput (req/s)':<34}{before:>14.1f}{now:>10.1f}{change:>+9.0%}{flag}")
+    return ok
+
+
+def main():
+    args = parse_args()
+    main_module, make_client = boot(args)
+    from database import memory_firestore
+    run_id = "run" + datetime.now().strftime("%H%M%S%f")
+    recorder = Recorder()
+    clients = threading.local()
+
+    def virtual_user(user: int):
+        if not hasattr(clients, "client"):
+            clients.client = make_client()
+        run_session(clients.client, user, run_id, args, recorder)
+
+    started = datetime.now().isoformat(timespec="seconds")
+    start = perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        list(pool.map(virtual_user, range(args.users)))
+    wall = perf_counter() - start
+    memory = measure_memory(main_module, make_client, args, run_id) if args.memory_sessions > 0 else {}
+
+    requests = sum(len(s) for name, s in recorder.samples.items() if not name.startswith("stage:"))
+    results = {
+        "started": started,
+        "config": {k: v for k, v in vars(args).items() if k not in ("out", "compare")},
+        "throughput": {"seconds": wall, "requests": requests, "requests_per_second": requests / wall, "sessions_per_second": args.users / wall},
+        "endpoints": {name: summarize(s) for name, s in recorder.samples.items() if not name.startswith("stage:")},
+        "stages": {name[len("stage:"):]: summarize(s) for name, s in recorder.samples.items() if name.startswith("stage:")},
+        "errors": recorder.errors,
+        "memory": memory,
+        "firestore": memory_firestore.stats(),
+        "backend": main_module.collect_stats(),
+    }
+
+    print(f"{args.users} sessions x {args.turns} turns at concurrency {args.concurrency} ({args.app}{', streaming' if args.stream else ''})")
+    print(f"{requests} requests in {wall:.1f}s: {results['throughput']['requests_per_second']:.1f} req/s, errors: {recorder.errors or 'none'}")
+    print(f"\n{'':<26}{'count':>7}{'p50 (ms)':>10}{'p95 (ms)':>10}{'p99 (ms)':>10}")
+    for section in ("endpoints", "stages"):
+        for name, s in results[section].items():
+            print(f"{name:<26}{s['count']:>7}{s['p50'] * 1e3:>10.1f}{s['p95'] * 1e3:>10.1f}{s['p99'] * 1e3:>10.1f}")
+    if memory:
+        print(f"\nmemory per live session: {memory['traced_bytes_per_session'] / 1024:.1f} KB traced, {memory['pool_bytes_per_session'] / 1024:.1f} KB of text")
+    print(f"firestore: {results['firestore']}")
+
+    out = args.out or os.path.join(RESULTS_DIR, f"loadtest-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(results, f, indent=2, default=str)
+    print(f"saved to {out}")
+
+    cache = results["backend"]["response_cache"]
+    print(f"response cache: {cache['hits']} hits, {cache['misses']} misses, hit rate {cache['hit_rate']:.0%}")
+    if args.cache_friendly and cache["hit_rate"] == 0:
+        print("every user asked the same questions but none was answered from the cache")
+        sys.exit(1)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            if not compare(results, json.load(f), args.tolerance):
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
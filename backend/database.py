@@ -1,15 +1,28 @@
 from time import time
-import firebase_admin
-from firebase_admin import credentials, firestore
 from typing_extensions import TypedDict
-from langchain_openai.chat_models import ChatOpenAI
-from langchain_google_genai.chat_models import ChatGoogleGenerativeAI
-from langchain_ollama.chat_models import ChatOllama
 from langchain_core.output_parsers import JsonOutputParser, StrOutputParser, PydanticOutputParser
-from langchain_core.messages import HumanMessage, AIMessage, BaseMessage
+from langchain_core.messages import HumanMessage, AIMessage, BaseMessage, messages_to_dict, messages_from_dict
 from pydantic import BaseModel
 import os
+import json
 import base64
+import hashlib
+import uuid
+from functools import lru_cache
+from google.api_core.exceptions import AlreadyExists, NotFound
+import threading
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, Future
+from summarizer import summary_worker
+from guardrails import Guardrail, GuardrailBatch, GuardrailBatcher, tiered_guardrail
+from models import model_registry
+from routing import router
+from persistence import WriteBehindJournal
+from retrieval import UserHistory, RETRIEVAL_TOP_K
+from response_cache import response_cache, context_fingerprint
+from meal_plan import MealPlanDocument, PATCH_INSTRUCTIONS, patch_parser
+from metrics import metrics
+from scheduler import scheduler, Overloaded, GUARDRAIL, INTERACTIVE, BACKGROUND, SCHEDULER_OUTPUT_TOKENS
 
 
 
@@ -18,145 +31,429 @@ class StructuredData(TypedDict):
     messages: list[str] # store last 20 messages
     responses: list[str] # store last 20 responses
     summary: str # summary of the conversation
-    meal_plan: str # meal plan of the conversation
+    meal_plan: dict # meal plan of the conversation, a MealPlanDocument.to_data() (see meal_plan.py)
 # TECHNICAL DECISION: focused on data made/changed this session and for short term use
 class UnstructuredData(TypedDict):
     key_facts: dict[str, str] # key facts of the conversation
 
-pk_service = base64.b64decode(os.getenv("BASE64_ENCODE_PK")).decode("utf-8")
+# TECHNICAL DECISION: PT_FIRESTORE_BACKEND=memory swaps Firestore for an in-process stand-in, used by the load tests
+FIRESTORE_BACKEND = os.getenv("PT_FIRESTORE_BACKEND", "firebase")
+if FIRESTORE_BACKEND == "memory":
+    from memory_firestore import MemoryFirestore
+    memory_firestore = MemoryFirestore(float(os.getenv("PT_FIRESTORE_LATENCY", "0")))
 
-credens = credentials.Certificate({
-    "type": os.getenv("FIRESTORE_TYPE"),
-    "project_id": os.getenv("FIRESTORE_PROJECT_ID"),
-    "private_key_id": os.getenv("FIRESTORE_PRIVATE_KEY_ID"),
-    "private_key": pk_service,
-    "client_email": os.getenv("FIRESTORE_CLIENT_EMAIL"),
-    "client_id": os.getenv("FIRESTORE_CLIENT_ID"),
-    "auth_uri": os.getenv("FIRESTORE_AUTH_URI"),
-    "token_uri": os.getenv("FIRESTORE_TOKEN_URI"),
-    "auth_provider_x509_cert_url": os.getenv("FIRESTORE_AUTH_PROVIDER_X509_CERT_URL"),
-    "client_x509_cert_url": os.getenv("FIRESTORE_CLIENT_X509_CERT_URL"),
-    "universe_domain": os.getenv("FIRESTORE_UNIVERSE_DOMAIN")
-})
+firestore_lock = threading.Lock()
+firestore_db = None # the Firestore client, created on first use
 
+def init_firebase():
+    """
+    Used to connect to Firebase. Called on the first Firestore call rather than on import,
+    so workers that start without serving a user do not pay for it
+    """
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+    pk_service = base64.b64decode(os.getenv("BASE64_ENCODE_PK")).decode("utf-8")
 
-firebase_admin.initialize_app(credens)
+    credens = credentials.Certificate({
+        "type": os.getenv("FIRESTORE_TYPE"),
+        "project_id": os.getenv("FIRESTORE_PROJECT_ID"),
+        "private_key_id": os.getenv("FIRESTORE_PRIVATE_KEY_ID"),
+        "private_key": pk_service,
+        "client_email": os.getenv("FIRESTORE_CLIENT_EMAIL"),
+        "client_id": os.getenv("FIRESTORE_CLIENT_ID"),
+        "auth_uri": os.getenv("FIRESTORE_AUTH_URI"),
+        "token_uri": os.getenv("FIRESTORE_TOKEN_URI"),
+        "auth_provider_x509_cert_url": os.getenv("FIRESTORE_AUTH_PROVIDER_X509_CERT_URL"),
+        "client_x509_cert_url": os.getenv("FIRESTORE_CLIENT_X509_CERT_URL"),
+        "universe_domain": os.getenv("FIRESTORE_UNIVERSE_DOMAIN")
+    })
 
+    try:
+        firebase_admin.get_app()
+    except ValueError: # no app yet
+        firebase_admin.initialize_app(credens)
+    return firestore.client()
 
-# pydantic model with reasoning and is_health_related
-class Guardrail(BaseModel):
-    reasoning: str
-    is_health_related: bool
 
-def create_db_user(user_fname: str, user_lname: str):
+def firestore_client():
     """
-    Stateless API. Used to create a new user in the database
+    Used instead of firestore.client() so the backend can be swapped. The client is created once and shared
     """
-    db = firestore.client()
-    users = db.collection("convos")\
-        .where(filter=firestore.firestore.FieldFilter("fname", "==", user_fname))\
-        .where(filter=firestore.firestore.FieldFilter("lname", "==", user_lname))\
-        .get()
-    if len(users) > 0:
-        return grab_db_user_data(user_fname, user_lname)
-    # create key facts
-    kf_ref = db.collection("keyfacts").document()
-    kf_ref.set({})
+    global firestore_db
+    if FIRESTORE_BACKEND == "memory":
+        return memory_firestore
+    if firestore_db is None:
+        with firestore_lock:
+            if firestore_db is None:
+                firestore_db = init_firebase()
+    return firestore_db
+
+
+# TECHNICAL DECISION: prompts carry the rolling summary plus only as many recent messages as fit the budget of their call type
+CONTEXT_BUDGETS = {
+    "chat": int(os.getenv("CONTEXT_BUDGET_CHAT", "2000")),
+    "summary": int(os.getenv("CONTEXT_BUDGET_SUMMARY", "3000")),
+    "key_facts": int(os.getenv("CONTEXT_BUDGET_KEY_FACTS", "3000")),
+    "meal_plan": int(os.getenv("CONTEXT_BUDGET_MEAL_PLAN", "2000")),
+}
+RETRIEVAL_TOKEN_BUDGET = int(os.getenv("RETRIEVAL_TOKEN_BUDGET", "400")) # part of the chat budget spent on recalled turns
+MESSAGE_TOKEN_OVERHEAD = 4 # role and separators the provider adds around every message
+
+@lru_cache(maxsize=1)
+def get_tokenizer():
+    """
+    Used to load the tokenizer on first use. tiktoken is optional, without it we fall back to ~4 characters per token
+    """
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        return None
+
+@lru_cache(maxsize=65536)
+def count_tokens(text: str) -> int:
+    """
+    Number of tokens in a piece of text. Cached, so every message is only tokenized once
+    """
+    tokenizer = get_tokenizer()
+    if tokenizer is not None:
+        return len(tokenizer.encode(text, disallowed_special=()))
+    return (len(text) + 3) // 4
+
+class ContextAssembler:
+    """
+    Used to build prompts within a token budget per call type. The prompt itself is always sent,
+    the history before it is a sliding window of the most recent messages that still fits
+    """
+    def __init__(self, budgets: dict[str, int] = CONTEXT_BUDGETS):
+        self.budgets = budgets
+        self.calls = dict[str, int]()
+        self.max_tokens = dict[str, int]()
+        self.lock = threading.Lock()
+
+    def message_tokens(self, message: BaseMessage) -> int:
+        content = message.content if isinstance(message.content, str) else str(message.content)
+        return count_tokens(content) + MESSAGE_TOKEN_OVERHEAD
+
+    def build(self, call_type: str, history: list[BaseMessage], prompt: BaseMessage, max_messages: int = None):
+        """
+        Returns (messages, prompt tokens) for a call
+        """
+        budget = self.budgets[call_type]
+        used = self.message_tokens(prompt)
+        window = []
+        candidates = history if max_messages is None else history[-max_messages:]
+        for message in reversed(candidates):
+            tokens = self.message_tokens(message)
+            if used + tokens > budget:
+                break
+            window.append(message)
+            used += tokens
+        window.reverse()
+        with self.lock:
+            self.calls[call_type] = self.calls.get(call_type, 0) + 1
+            self.max_tokens[call_type] = max(self.max_tokens.get(call_type, 0), used)
+        metrics.prompt_tokens.observe(used, call_type)
+        return window + [prompt], used
+
+    def fit(self, snippets: list[str], budget: int) -> list[str]:
+        """
+        The leading snippets that fit in budget tokens
+        """
+        fitted = []
+        for snippet in snippets:
+            budget -= count_tokens(snippet)
+            if budget < 0:
+                break
+            fitted.append(snippet)
+        return fitted
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {call_type: {"budget": budget, "calls": self.calls.get(call_type, 0), "max_prompt_tokens": self.max_tokens.get(call_type, 0)}
+                    for call_type, budget in self.budgets.items()}
+
+context_assembler = ContextAssembler()
+
+def call_tokens(messages: list[BaseMessage]) -> int:
+    """ Used to estimate the tokens a call takes from its provider's budget, prompt and answer """
+    return sum(context_assembler.message_tokens(m) for m in messages) + SCHEDULER_OUTPUT_TOKENS
 
-    # create user
-    user_ref = db.collection("convos").document()
-    user_ref.set({
+# runs guardrail checks alongside answer generation
+speculation_pool = ThreadPoolExecutor(max_workers=int(os.getenv("GUARDRAIL_WORKERS", "16")), thread_name_prefix="guardrail")
+
+REFUSAL_MESSAGE = "The message sent is not within the realms of medical/fitness/nutrition advice. Please rephrase your question."
+UNSURE_MESSAGE = "I am not sure how to respond to that. Can you please rephrase your question?"
+MODEL_DOWN_MESSAGE = "The model is currently down. Please try again later."
+
+def user_doc_id(user_fname: str, user_lname: str) -> str:
+    """
+    Deterministic document id of a user, shared by its convos and keyfacts documents.
+    The names are JSON encoded, joining them with a separator would give "a:b" "c" and "a" "b:c" the same id
+    """
+    return hashlib.sha256(json.dumps([user_fname, user_lname]).encode("utf-8")).hexdigest()
+
+# set by migrate_legacy_users once every user has its deterministic id, after that /init stops looking for legacy users
+MIGRATION_DOC = "meta/user_ids"
+legacy_state = {"remain": None} # None until read from MIGRATION_DOC, once per process
+
+def legacy_users_remain(db) -> bool:
+    """
+    Used to skip the fname/lname query for new users once the migration is complete
+    """
+    if legacy_state["remain"] is None:
+        snap = db.document(MIGRATION_DOC).get()
+        legacy_state["remain"] = not (snap.exists and (snap.to_dict() or {}).get("complete", False))
+    return legacy_state["remain"]
+
+def select_user_data(user_data: dict) -> dict:
+    """ Chose the user data we need from a convos document """
+    return {
+        "messages": user_data.get("messages", []),
+        "responses": user_data.get("responses", []),
+        "summary": user_data.get("summary", ""),
+        "meal_plan": user_data.get("meal_plan", ""),
+    }
+
+@metrics.timed("firestore_create_user")
+def create_db_user(user_fname: str, user_lname: str):
+    """
+    Stateless API. Used to create a new user in the database. One batched commit
+    """
+    db = firestore_client()
+    doc_id = user_doc_id(user_fname, user_lname)
+    kf_ref = db.collection("keyfacts").document(doc_id)
+    user_ref = db.collection("convos").document(doc_id)
+    user_data = {
         "fname": user_fname,
         "lname": user_lname,
         "messages": [],
         "responses": [],
         "summary": "",
         "kf_ref": kf_ref.path, # we want the path
-        "meal_plan": ""
-    })
-    # save references   
-    user_ref = user_ref.get().to_dict()
-    kf_ref =  {}
+        "meal_plan": MealPlanDocument().to_data()
+    }
+    # create key facts and user together. create() fails instead of overwriting an existing user
+    batch = db.batch()
+    batch.create(kf_ref, {})
+    batch.create(user_ref, user_data)
+    try:
+        batch.commit()
+    except AlreadyExists:
+        return grab_db_user_data(user_fname, user_lname)
 
-    return user_ref, kf_ref
+    return select_user_data(user_data), {}, False
 
-def grab_db_user_data(user_fname: str, user_lname: str):
+@metrics.timed("firestore_migrate_user")
+def migrate_legacy_user(db, user_fname: str, user_lname: str):
     """
-    Stateless API. Used to grab user data from the database
+    Stateless API. Moves a user created before deterministic ids (random document ids, found by fname/lname)
+    to its deterministic id. Returns (user_data, key_facts, True) or None if there is no such user
     """
-    db = firestore.client()
+    from google.cloud.firestore_v1.base_query import FieldFilter
     users = db.collection("convos")\
-        .where(filter=firestore.firestore.FieldFilter("fname", "==", user_fname))\
-        .where(filter=firestore.firestore.FieldFilter("lname", "==", user_lname))\
+        .where(filter=FieldFilter("fname", "==", user_fname))\
+        .where(filter=FieldFilter("lname", "==", user_lname))\
         .get()
-    
+    doc_id = user_doc_id(user_fname, user_lname)
+    users = [u for u in users if u.id != doc_id] # already migrated
     if len(users) == 0:
+        return None
+
+    old_user = users[0]
+    user_data = old_user.to_dict()
+    old_kf_path = user_data.get("kf_ref")
+    key_facts = (db.document(old_kf_path).get().to_dict() if old_kf_path else None) or {}
+
+    kf_ref = db.collection("keyfacts").document(doc_id)
+    user_data["kf_ref"] = kf_ref.path
+    batch = db.batch()
+    batch.set(kf_ref, key_facts)
+    batch.set(db.collection("convos").document(doc_id), user_data)
+    batch.delete(old_user.reference)
+    if old_kf_path:
+        batch.delete(db.document(old_kf_path))
+    batch.commit()
+    print(f"Migrated user {old_user.id} to {doc_id}")
+    return select_user_data(user_data), key_facts, True
+
+def migrate_legacy_users() -> int:
+    """
+    Stateless API. One-time migration of every legacy user to its deterministic id. Returns how many were moved
+    """
+    db = firestore_client()
+    moved = 0
+    for doc in db.collection("convos").stream():
+        user_data = doc.to_dict()
+        fname, lname = user_data.get("fname"), user_data.get("lname")
+        if fname is None or lname is None or doc.id == user_doc_id(fname, lname):
+            continue
+        if migrate_legacy_user(db, fname, lname) is not None:
+            moved += 1
+    db.document(MIGRATION_DOC).set({"complete": True})
+    legacy_state["remain"] = False
+    return moved
+
+@metrics.timed("firestore_grab_user")
+def grab_db_user_data(user_fname: str, user_lname: str):
+    """
+    Stateless API. Used to grab user data from the database, creating the user if it is new. Returns (user_data, key_facts, existed).
+    The convos and keyfacts documents are fetched together in one round trip
+    """
+    db = firestore_client()
+    doc_id = user_doc_id(user_fname, user_lname)
+    user_ref = db.collection("convos").document(doc_id)
+    kf_ref = db.collection("keyfacts").document(doc_id)
+    snapshots = {snap.reference.path: snap for snap in db.get_all([user_ref, kf_ref])}
+    user_snap = snapshots.get(user_ref.path)
+
+    if user_snap is None or not user_snap.exists:
+        migrated = migrate_legacy_user(db, user_fname, user_lname) if legacy_users_remain(db) else None
+        if migrated is not None:
+            return migrated
         return create_db_user(user_fname, user_lname)
-    
-    user_ref = users[0]
 
-    user_data = user_ref.to_dict()
-    # get key facts
-    kf_ref_path = user_data.get("kf_ref")
-    key_facts = db.document(kf_ref_path).get().to_dict()
-    # chose the user data we need
-    user_data = {
-        "messages": user_data.get("messages", []),
-        "responses": user_data.get("responses", []),
-        "summary": user_data.get("summary", ""),
-        "meal_plan": user_data.get("meal_plan", ""),
-    }
-    # return user data and key facts
-    return user_data, key_facts
+    kf_snap = snapshots.get(kf_ref.path)
+    key_facts = (kf_snap.to_dict() if kf_snap is not None and kf_snap.exists else None) or {}
+    # return user data, key facts and whether the user already existed
+    return select_user_data(user_snap.to_dict()), key_facts, True
 
+@metrics.timed("firestore_save_user")
 def save_db_user_data(fname: str, lname: str, user_data: dict, key_facts: dict) -> tuple[bool, str]:
     """
-    Stateless API. Used to save user data to the database
+    Stateless API. Used to save user data to the database. A single write, no lookups
     """
     if (user_data.get("messages") == [] and user_data.get("responses") == []):
         return False, "No user data to save"
     
-    db = firestore.client()
-    # find the user
-    users = db.collection("convos")\
-        .where(filter=firestore.firestore.FieldFilter("fname", "==", fname))\
-        .where(filter=firestore.firestore.FieldFilter("lname", "==", lname)).get()
+    db = firestore_client()
+    user_ref = db.collection("convos").document(user_doc_id(fname, lname))
     
-    if len(users) == 0:
+    # update user data. update() fails if the user does not exist
+    try:
+        user_ref.update(select_user_data(user_data))
+    except NotFound:
         return False, "User not found"
-    
-    user_ref = users[0].reference
-    
-    # update user data
-    user_ref.update(user_data)
 
-    # update key facts
-    user_doc = user_ref.get()
-    user_doc_data = user_doc.to_dict()
     # if key_facts != {}:
-    #     kf_ref_path = user_doc_data.get("kf_ref")
-    #     kf_ref = db.document(kf_ref_path)
+    #     kf_ref = db.collection("keyfacts").document(user_doc_id(fname, lname))
     #     kf_ref.update(key_facts)
 
     return True, "User data saved"
 
+@metrics.timed("firestore_save_batch")
+def save_db_users_batch(users: list[tuple[str, str, dict]]) -> int:
+    """
+    Stateless API. Used to save many users at once, users is a list of (fname, lname, user_data).
+    One batched commit per call, callers keep it under the Firestore limit of 500 writes
+    """
+    if len(users) == 0:
+        return 0
+    db = firestore_client()
+    batch = db.batch()
+    for fname, lname, user_data in users:
+        batch.update(db.collection("convos").document(user_doc_id(fname, lname)), select_user_data(user_data))
+    try:
+        batch.commit()
+    except NotFound:
+        # a batch fails as a whole, save the users that do exist one by one
+        return sum(1 for fname, lname, user_data in users if save_db_user_data(fname, lname, user_data, {})[0])
+    return len(users)
+
+# TECHNICAL DECISION: conversations are saved every PERSIST_INTERVAL_SECONDS, not only on /close
+journal = WriteBehindJournal(save_db_users_batch)
+
+def guardrail_prompt(human_message: str):
+    """
+    Used to build the message list asking the model whether a message is within guardrails
+    """
+    return [HumanMessage(content="""
+        Determine if the following message is within the realms of medical/fitness/nutrition advice.
+        Message: {human_message}
+        Return a JSON object with the following fields:
+        - reasoning: a short explanation of your reasoning
+        - is_health_related: True if the message is within the realms of medical/fitness/nutrition advice, False otherwise
+    """.format(human_message=human_message))]
+
+def batch_guardrail_prompt(human_messages: list[str]):
+    """
+    Used to build the message list asking the model about several messages at once.
+    Messages are JSON encoded, one per line, so they cannot break out of the list
+    """
+    return [HumanMessage(content="""
+        Determine for each of the following messages if it is within the realms of medical/fitness/nutrition advice.
+        Judge every message on its own, they come from different users.
+        Messages:
+        {human_messages}
+        Return a JSON object with a "verdicts" list holding one object per message, in the same order, with the following fields:
+        - reasoning: a short explanation of your reasoning
+        - is_health_related: True if the message is within the realms of medical/fitness/nutrition advice, False otherwise
+    """.format(human_messages="\n        ".join(f"{i + 1}. {json.dumps(m)}" for i, m in enumerate(human_messages))))]
+
+def classify_guardrails(human_messages: list[str]) -> list[Guardrail]:
+    """
+    Stateless API. Used to get a Guardrail per message in one call. A single message gets the plain guardrail prompt
+    """
+    # a batch serves several users, so batches queue in a class of their own, ahead of the answers waiting on them
+    if len(human_messages) == 1:
+        messages = guardrail_prompt(human_messages[0])
+        build = lambda chat: chat | PydanticOutputParser(pydantic_object=Guardrail)
+        with scheduler.slot(model_registry.provider_for("gpt-4o-mini"), "guardrails", GUARDRAIL, call_tokens(messages)):
+            return [router.invoke("gpt-4o-mini", lambda model: model_registry.get_chain("guardrail", model, build).invoke(messages))]
+    messages = batch_guardrail_prompt(human_messages)
+    build = lambda chat: chat | PydanticOutputParser(pydantic_object=GuardrailBatch)
+    with scheduler.slot(model_registry.provider_for("gpt-4o-mini"), "guardrails", GUARDRAIL, call_tokens(messages)):
+        return router.invoke("gpt-4o-mini", lambda model: model_registry.get_chain("guardrail_batch", model, build).invoke(messages)).verdicts
+
+# TECHNICAL DECISION: LLM guardrail checks of concurrent users are sent together, every GUARDRAIL_BATCH_WINDOW_SECONDS
+guardrail_batcher = GuardrailBatcher(classify_guardrails)
+
+def warm_up(models: list[str]):
+    """
+    Used to pay the first-use costs before the first user does: the Firestore connection,
+    the tokenizer and the clients (and provider packages) of models. Errors are only printed
+    """
+    start_time = time()
+    for step, warm in [("firestore", firestore_client), ("tokenizer", get_tokenizer)] + \
+                     [(model, lambda model=model: model_registry.get_chat(model)) for model in models]:
+        try:
+            warm()
+        except Exception as e:
+            print(f"Warm-up of {step} failed: ", e)
+    metrics.stage_seconds.observe(time() - start_time, "warm_up")
+
 class HumanExternalDataStore:
-    def __init__(self, user_fname: str, user_lname: str, requester_url: str):
+    def __init__(self, user_fname: str, user_lname: str, requester_url: str, state: dict = None):
         self.msg_chain = list[BaseMessage]() # list of HumanMessage and AIMessage
 
         # allow user to select model across multiple
         self.model = "gpt-4o-mini"
-        self.chat = ChatOpenAI(model=self.model)
+        self.chat = model_registry.get_chat(self.model)
+        self.chat_model = self.model # model self.chat serves
         self.fname = user_fname
         self.lname = user_lname
-        self.structured_data = StructuredData(messages=[], responses=[], summary="", meal_plan="")
+        self.structured_data = StructuredData(messages=[], responses=[], summary="", meal_plan={})
+        self.meal_plan = MealPlanDocument()
         self.unstructured_data = UnstructuredData(key_facts={})
         self.requester_url = requester_url
         self.last_langchain_rtt = 0
+        self.last_stage_latency = dict[str, float]() # seconds spent per stage of the last call_chat
+        self.last_prompt_tokens = dict[str, int]() # prompt tokens of the last call of each type
+        self.summary_lock = threading.Lock() # held while the summary is being rewritten
+        self.history = None # UserHistory, loaded on the first turn
+        self.epoch = uuid.uuid4().hex # changes whenever msg_chain is rebuilt from Firestore, clients sync against it
+        self.rehydrated = False # True once loaded from a user document Firestore already had
+
+        # a session handed over by another worker does not need Firestore
+        if state is not None:
+            self.load_state(state)
+            return
 
         # use fname and lname to get user id. Thats our authentication
         print("retrieving user id...")
-        self.structured_data, self.unstructured_data["key_facts"] = grab_db_user_data(user_fname, user_lname)
+        journal.flush_user(user_fname, user_lname) # read our own writes
+        self.structured_data, self.unstructured_data["key_facts"], self.rehydrated = grab_db_user_data(user_fname, user_lname)
+        self.set_meal_plan(MealPlanDocument.from_data(self.structured_data["meal_plan"])) # migrates plain string plans
 
 
         # populate msg_chain
@@ -164,17 +461,76 @@ class HumanExternalDataStore:
             self.msg_chain.append(HumanMessage(content=m))
             self.msg_chain.append(AIMessage(content=self.structured_data["responses"][i]))
 
+    def to_state(self) -> dict:
+        """
+        Used to serialize the session so any worker can load it (see state_store.py)
+        """
+        return {
+            "model": self.model,
+            "msg_chain": messages_to_dict(self.msg_chain),
+            "structured_data": dict(self.structured_data),
+            "key_facts": self.unstructured_data["key_facts"],
+            "epoch": self.epoch,
+        }
 
-    def close(self):
-        # save summary and key facts
-        self.update_summary()
-        # self.update_key_facts()
+    def load_state(self, state: dict):
+        """
+        Used to replace the session with one serialized by to_state
+        """
+        self.model = state["model"]
+        self.msg_chain = messages_from_dict(state["msg_chain"])
+        self.structured_data = StructuredData(**state["structured_data"])
+        self.unstructured_data = UnstructuredData(key_facts=state["key_facts"])
+        self.epoch = state.get("epoch", self.epoch)
+        self.set_meal_plan(MealPlanDocument.from_data(self.structured_data["meal_plan"]))
+
+    def history_payload(self, cursor: dict = None) -> dict:
+        """
+        Conversation fields of an /init response. A client that sends back the cursor it was given
+        only gets the messages added since, as long as msg_chain was not rebuilt in between.
+        Anything else sent as a cursor gets the full history
+        """
+        count = cursor.get("count") if isinstance(cursor, dict) else None
+        valid = isinstance(count, int) and not isinstance(count, bool)
+        delta = valid and cursor.get("epoch") == self.epoch and 0 <= count <= len(self.msg_chain)
+        messages = self.msg_chain[count:] if delta else self.msg_chain
+        return {
+            "human_messages": [m.content for m in messages if isinstance(m, HumanMessage)], # "responses" and "messages" was removed
+            "ai_responses": [m.content for m in messages if isinstance(m, AIMessage)],
+            "delta": delta,
+            "cursor": {"epoch": self.epoch, "count": len(self.msg_chain)},
+        }
+
+    def set_meal_plan(self, meal_plan: MealPlanDocument):
+        """
+        Used to replace the meal plan, keeps structured_data["meal_plan"] in sync for saving
+        """
+        self.meal_plan = meal_plan
+        self.structured_data["meal_plan"] = meal_plan.to_data()
+
+    def apply_meal_plan_patch(self, patch_text: str) -> bool:
+        """
+        Used to apply the patch the model answered a meal plan request with. Returns False if it could not be parsed
+        """
+        try:
+            patch = patch_parser.parse(patch_text)
+        except Exception as e:
+            print("Error parsing meal plan patch: ", e)
+            return False
+        self.meal_plan.apply(patch)
+        self.set_meal_plan(self.meal_plan)
+        return True
 
+
+    def snapshot(self) -> dict:
+        """
+        Used to build the user data saved to Firestore from msg_chain
+        """
         # split messages in msg_chain into messages (HumanMessage) and responses (AIMessage)
         # reset messages and responses to ensure double entries into Firestore dont happen
         msgs = []
         resps = []
-        for m in self.msg_chain:
+        for m in list(self.msg_chain):
             if isinstance(m, HumanMessage):
                 msgs.append(m.content.strip())
             elif isinstance(m, AIMessage):
@@ -186,64 +542,149 @@ class HumanExternalDataStore:
 
         self.structured_data["messages"] = msgs
         self.structured_data["responses"] = resps
-        print("structured_data: ", self.structured_data)
-        # save to database
-        return save_db_user_data(self.fname, self.lname, self.structured_data, self.unstructured_data)
+        # the full history lives in the retrieval log, save its index along with the session
+        if self.history is not None:
+            self.history.save()
+        return dict(self.structured_data)
+
+    def close(self, wait: bool = True):
+        """
+        Used to save the session. With wait=False the save is left to the write-behind journal
+        so a burst of closes is committed in batches
+        """
+        # save summary and key facts. Waits for the background summarizer to catch up
+        summary_worker.flush(self)
+        # self.update_key_facts()
+
+        if not wait:
+            journal.mark_dirty(self)
+            return True, "User data queued for saving"
+        with journal.flush_lock: # never race an older background write of this session
+            journal.discard(self)
+            user_data = self.snapshot()
+            print("structured_data: ", user_data)
+            # save to database
+            return save_db_user_data(self.fname, self.lname, user_data, self.unstructured_data)
 
     def chat_guardrails(self, human_message: str):
         """
-        Used to check if the human message is within guardrails of medical/fitness/nutrition advice
+        Used to check if the human message is within guardrails of medical/fitness/nutrition advice.
+        Cached and obvious messages are answered locally, the rest go to llm_guardrails
         """
         if human_message == "":
             return False
 
-        # invoke chat
-        chain = ChatOpenAI(model="gpt-4o-mini") | PydanticOutputParser(pydantic_object=Guardrail)
-        result = chain.invoke([HumanMessage(content="""
-            Determine if the following message is within the realms of medical/fitness/nutrition advice.
-            Message: {human_message}
-            Return a JSON object with the following fields:
-            - reasoning: a short explanation of your reasoning
-            - is_health_related: True if the message is within the realms of medical/fitness/nutrition advice, False otherwise
-        """.format(human_message=human_message))])
+        result = tiered_guardrail.check(human_message, self.llm_guardrails)
         if isinstance(result, Guardrail):
             return result.is_health_related
         else:
             return False
 
-    
-    def invoke_chat(self, messages: list[BaseMessage], ret_type: str):
-        """ Used to invoke the chat model and return the result in the specified format """
+    def llm_guardrails(self, human_message: str):
+        """
+        Used to ask the model whether the human message is within guardrails. Returns a Guardrail.
+        Checks of concurrent users share one call (see GuardrailBatcher)
+        """
+        return guardrail_batcher.check(human_message)
+
+    async def achat_guardrails(self, human_message: str):
+        """
+        Async version of chat_guardrails
+        """
+        if human_message == "":
+            return False
+
+        result = await tiered_guardrail.acheck(human_message, self.allm_guardrails)
+        if isinstance(result, Guardrail):
+            return result.is_health_related
+        else:
+            return False
+
+    async def allm_guardrails(self, human_message: str):
+        """
+        Async version of llm_guardrails
+        """
+        return await guardrail_batcher.acheck(human_message)
+
+    def select_chat(self):
+        """ Used to get the shared client for self.model. Returns None if the model is down """
         try:
-            if self.model.startswith("gpt"):
-                self.chat = ChatOpenAI(model=self.model)
-            elif self.model.startswith("gemini"):
-                self.chat = ChatGoogleGenerativeAI(model=self.model)
-            elif self.requester_url.startswith("http://localhost"):
-                self.chat = ChatOllama(model=self.model)   
+            chat = model_registry.get_chat(self.model, self.requester_url)
+            if chat is not None: # unknown models keep using the last client
+                self.chat = chat
+                self.chat_model = self.model
         except Exception as e:
             print(e)
-            return "The model is currently down. Please try again later."
+            return None
+        return self.chat
+
+    def provider(self):
+        """ Used to get the provider whose budget the calls of this session take from, None if no provider serves the model """
+        return model_registry.provider_for(self.chat_model, self.requester_url)
+
+    def admit(self):
+        """
+        Used before the LLM calls of a turn. Raises Overloaded if the provider's queue would make the user wait past the SLO
+        """
+        self.select_chat() # settles the model the calls go to
+        scheduler.admit(self.provider(), f"{self.fname}:{self.lname}")
+
+    def invoke_chat(self, messages: list[BaseMessage], ret_type: str, priority: str = INTERACTIVE):
+        """
+        Used to invoke the chat model and return the result in the specified format.
+        Goes through the router, so slow or failing models are retried on their fallbacks.
+        Waits for a slot of the provider's budget first, background work only gets one when no user is waiting
+        """
+        chat = self.select_chat()
+        if chat is None:
+            return MODEL_DOWN_MESSAGE
         if ret_type == "json":
+            # an answer that is not valid JSON is retried like a failed call, on the next model of the chain
             parser = JsonOutputParser()
-            try:
-                result = self.chat.invoke(messages)
-                parsed_result = parser.invoke(result)
-                return parsed_result
-            except Exception as e:
-                reformat_msg = HumanMessage(content=f"""
-                    Please reformat {result.content.strip()} as a valid JSON object.
-                    RETURN ONLY THE REFORMATTED JSON OBJECT
-                """)
-                second_try = self.chat.invoke([reformat_msg])
-                second_parsed = parser.invoke(second_try)
-                return second_parsed
+            call = lambda model: parser.invoke(model_registry.get_chat(model, self.requester_url).invoke(messages))
         elif ret_type == "str":
-            chain = self.chat | StrOutputParser()
-            result = chain.invoke(messages)
-            return result
+            call = lambda model: model_registry.get_chain("str", model, lambda chat: chat | StrOutputParser(), self.requester_url).invoke(messages)
         else:
             raise ValueError("Invalid return type")
+        # TECHNICAL DECISION: the slot is taken before the router, so queueing never counts against a model's deadline
+        # or circuit breaker. Retries and hedges on a fallback run under the primary's slot
+        with scheduler.slot(self.provider(), f"{self.fname}:{self.lname}", priority, call_tokens(messages)):
+            return router.invoke(self.chat_model, call, self.requester_url)
+
+    def stream_chat(self, messages: list[BaseMessage]):
+        """ Used to stream the chat model's answer token by token. Yields strings """
+        chat = self.select_chat()
+        if chat is None:
+            yield MODEL_DOWN_MESSAGE
+            return
+        def open_stream(model: str):
+            for chunk in model_registry.get_chat(model, self.requester_url).stream(messages):
+                if isinstance(chunk.content, str) and chunk.content != "":
+                    yield chunk.content
+        # the slot is held until the stream is exhausted or closed
+        with scheduler.slot(self.provider(), f"{self.fname}:{self.lname}", INTERACTIVE, call_tokens(messages)):
+            yield from router.stream(self.chat_model, open_stream, self.requester_url)
+
+    async def astream_chat(self, messages: list[BaseMessage]):
+        """ Async version of stream_chat """
+        chat = self.select_chat()
+        if chat is None:
+            yield MODEL_DOWN_MESSAGE
+            return
+        async def open_stream(model: str):
+            async for chunk in model_registry.get_chat(model, self.requester_url).astream(messages):
+                if isinstance(chunk.content, str) and chunk.content != "":
+                    yield chunk.content
+        async with scheduler.aslot(self.provider(), f"{self.fname}:{self.lname}", INTERACTIVE, call_tokens(messages)):
+            async for token in router.astream(self.chat_model, open_stream, self.requester_url):
+                yield token
+
+    def record_stage(self, stage: str, seconds: float):
+        """
+        Used to time a stage of the current call_chat, kept in last_stage_latency and the pt_stage_seconds histogram
+        """
+        self.last_stage_latency[stage] = seconds
+        metrics.stage_seconds.observe(seconds, stage)
 
     def update_summary(self):
         "Called by API when summary needs to be updated (end of question-answer) Update the summary within the PT Data points"
@@ -261,7 +702,10 @@ class HumanExternalDataStore:
         ))
 
         # invoke chat
-        self.structured_data["summary"] = self.invoke_chat(self.msg_chain + [sum_upd], "str")
+        messages, self.last_prompt_tokens["summary"] = context_assembler.build("summary", self.msg_chain, sum_upd)
+        with metrics.span("summary"):
+            self.structured_data["summary"] = self.invoke_chat(messages, "str", BACKGROUND)
+        journal.mark_dirty(self)
         
     def update_key_facts(self):
         "Called by API when key facts need to be updated (end of question-answer) Update the key facts within the PT Data points"
@@ -281,61 +725,389 @@ class HumanExternalDataStore:
         ))
         # invoke chat
         try:
-            output = self.invoke_chat(self.msg_chain + [kf_upd], "json")
+            messages, self.last_prompt_tokens["key_facts"] = context_assembler.build("key_facts", self.msg_chain, kf_upd)
+            with metrics.span("key_facts"):
+                output = self.invoke_chat(messages, "json", BACKGROUND)
             if type(output) == list:
                 self.unstructured_data["key_facts"] = output
+                if self.history is not None:
+                    self.history.set_key_facts(output)
         except Exception as e:
             self.unstructured_data["key_facts"] = {}
             print("Error updating key facts: ", e)
 
+    def user_history(self) -> UserHistory:
+        """
+        Used to get the user's searchable history. Users without one yet are seeded with the turns Firestore kept
+        """
+        if self.history is None:
+            history = UserHistory(user_doc_id(self.fname, self.lname))
+            if not history.exists():
+                history.append(list(zip(self.structured_data["messages"], self.structured_data["responses"])))
+            history.set_key_facts(self.unstructured_data["key_facts"])
+            self.history = history
+        return self.history
+
+    def recall(self, human_message: str) -> str:
+        """
+        Used to bring back the earlier turns and key facts most relevant to a human message
+        """
+        retrieval_start = time()
+        try:
+            # the newest 3 turns are already in the chat window
+            snippets = self.user_history().search(human_message, RETRIEVAL_TOP_K, exclude_last=3)
+        except Exception as e:
+            print("Error searching history: ", e)
+            snippets = []
+        snippets = context_assembler.fit(snippets, RETRIEVAL_TOKEN_BUDGET)
+        self.record_stage("retrieval", time() - retrieval_start)
+        self.last_prompt_tokens["retrieval"] = sum(count_tokens(s) for s in snippets)
+        return "\n".join(snippets)
+
+    def chat_prompt(self, human_message: str):
+        """
+        Used to build the message list sent to the model for a human message
+        """
+        recalled = self.recall(human_message)
+        human_msg = HumanMessage(content="""
+            Here is the summary of the conversation: {summary}
+            {recalled}
+            Here is the human message: {human_message}
+            Here is the current meal plan: {meal_plan}
+            Keep your answer short, concise and to the point. Don't use markdown, bold, italic, etc.
+        """.format(
+            # key_facts=self.unstructured_data["key_facts"],
+            summary=self.structured_data["summary"],
+            recalled=("Here are relevant parts of earlier conversations: " + recalled) if recalled != "" else "",
+            human_message=human_message,
+            meal_plan=self.meal_plan.rendered
+        ))
+        messages, self.last_prompt_tokens["chat"] = context_assembler.build("chat", self.msg_chain, human_msg, max_messages=6)
+        return messages
+
+    def record_turn(self, human_message: str, ai_msg: str, start_time: float):
+        """
+        Used to add a finished question-answer turn to msg_chain. The summary is refreshed in the background
+        """
+        self.msg_chain.append(AIMessage(content=ai_msg))
+
+        human_msg_simplified = HumanMessage(content=human_message)
+        self.msg_chain.append(human_msg_simplified)
+        end_time = time()
+        self.last_langchain_rtt = end_time - start_time
+        metrics.stage_seconds.observe(self.last_langchain_rtt, "langchain_rtt")
+        try:
+            self.user_history().append([(human_message, ai_msg)])
+        except Exception as e:
+            print("Error logging turn: ", e)
+
+        # update unstructured data off the request path, the next turn uses the latest summary available
+        summary_worker.submit(self)
+        journal.mark_dirty(self)
+        # self.update_key_facts()
+
+    def start_guardrails(self, human_message: str):
+        """
+        Used to run chat_guardrails in the background. Returns a future with the verdict
+        """
+        guardrail_start = time()
+        def run():
+            guardrail_health_related = self.chat_guardrails(human_message)
+            self.record_stage("guardrail", time() - guardrail_start)
+            print("Passed Guardrails: ", guardrail_health_related)
+            return guardrail_health_related
+        return speculation_pool.submit(run)
+
+    def speculative_stream(self, messages: list[BaseMessage], guardrail: Future):
+        """
+        Streams the model's answer while the guardrail is still running. Tokens are held back
+        until the guardrail passes, and the stream is dropped (closing the connection to the provider)
+        as soon as it fails. Callers check guardrail.result() once the generator is exhausted
+        """
+        if guardrail.done() and not guardrail.result():
+            return
+        held = []
+        stream = self.stream_chat(messages)
+        try:
+            for token in stream:
+                if not guardrail.done():
+                    held.append(token)
+                    continue
+                if not guardrail.result():
+                    return
+                if len(held) > 0:
+                    yield "".join(held)
+                    held = []
+                yield token
+            if guardrail.result() and len(held) > 0:
+                yield "".join(held)
+        finally:
+            stream.close()
+
+    def cached_answer(self, human_message: str, fingerprint: str, start_time: float):
+        """
+        Used to answer from the response cache. A hit still has to pass the guardrail (cached itself),
+        then it is recorded like any other turn. Returns None on a miss
+        """
+        # TECHNICAL DECISION: only plain answers are cached, a meal plan change has to run every time
+        if "meal plan" in human_message.lower():
+            return None
+        ai_msg = response_cache.get(human_message, fingerprint)
+        if ai_msg is None:
+            return None
+        if not self.chat_guardrails(human_message):
+            return REFUSAL_MESSAGE
+        self.record_stage("cache", time() - start_time)
+        self.record_turn(human_message, ai_msg, start_time)
+        return ai_msg
+
+    async def acached_answer(self, human_message: str, fingerprint: str, start_time: float):
+        """
+        Async version of cached_answer. The lookup and the history write run in a thread, off the event loop
+        """
+        if "meal plan" in human_message.lower():
+            return None
+        ai_msg = await asyncio.to_thread(response_cache.get, human_message, fingerprint)
+        if ai_msg is None:
+            return None
+        if not await self.achat_guardrails(human_message):
+            return REFUSAL_MESSAGE
+        self.record_stage("cache", time() - start_time)
+        await asyncio.to_thread(self.record_turn, human_message, ai_msg, start_time)
+        return ai_msg
+
+    def cache_answer(self, human_message: str, fingerprint: str, ai_msg: str, start_time: float):
+        """
+        Used to keep an answer that passed the guardrail for the next similar message
+        """
+        if ai_msg != UNSURE_MESSAGE:
+            response_cache.put(human_message, fingerprint, ai_msg, time() - start_time)
+
     def call_chat(self, human_message: str):
         """
         Used to call the chat model and return the result in the specified format
         """
-        # handle guardrails first
-        guardrail_health_related = self.chat_guardrails(human_message)
-        print("Passed Guardrails: ", guardrail_health_related)
-        if not guardrail_health_related:
-            return "The message sent is not within the realms of medical/fitness/nutrition advice. Please rephrase your question."
-        # add human message to msg_chain
+        # TECHNICAL DECISION: the guardrail and the answer run at the same time, the answer is only kept if the guardrail passes
+        self.last_stage_latency = dict[str, float]()
         start_time = time()
-        if "meal plan" in human_message.lower():                
-            self.change_meal_plan(human_message)
+        fingerprint = context_fingerprint(human_message, user_doc_id(self.fname, self.lname), self.model, self.meal_plan.rendered, self.structured_data["summary"])
+        ai_msg = self.cached_answer(human_message, fingerprint, start_time)
+        if ai_msg is not None:
+            return ai_msg
+        self.admit()
+        guardrail = self.start_guardrails(human_message)
+        if "meal plan" in human_message.lower():
+            try:
+                meal_plan = "".join(self.speculative_stream(self.meal_plan_prompt(human_message), guardrail))
+            except Exception as e:
+                if not guardrail.result():
+                    return REFUSAL_MESSAGE
+                raise
+            if not guardrail.result():
+                return REFUSAL_MESSAGE
+            if not self.apply_meal_plan_patch(meal_plan):
+                return UNSURE_MESSAGE
             ai_msg = "The meal plan needs to be changed. Please wait while I update it."
             self.msg_chain.append(AIMessage(content="Request Fullfilled."))
         else:
-            human_msg = HumanMessage(content="""
-                Here is the summary of the conversation: {summary}
-                Here is the human message: {human_message}
-                Here is the current meal plan: {meal_plan}
-                Keep your answer short, concise and to the point. Don't use markdown, bold, italic, etc.
-            """.format(
-                # key_facts=self.unstructured_data["key_facts"],
-                summary=self.structured_data["summary"],
-                human_message=human_message,
-                meal_plan=self.structured_data["meal_plan"]
-            ))
             # invoke chat
             try: 
-                ai_msg = self.invoke_chat(self.msg_chain[-6:] + [human_msg], "str")
-                if ai_msg.strip() == "":
-                    ai_msg = "I am not sure how to respond to that. Can you please rephrase your question?"
+                ai_msg = "".join(self.speculative_stream(self.chat_prompt(human_message), guardrail))
+            except Overloaded:
+                raise # answered with a 429, not as if the model had failed
             except Exception as e:
-                return "I am not sure how to respond to that. Can you please rephrase your question?"
+                if not guardrail.result():
+                    return REFUSAL_MESSAGE
+                return UNSURE_MESSAGE
+            if not guardrail.result():
+                return REFUSAL_MESSAGE
+            if ai_msg.strip() == "":
+                ai_msg = UNSURE_MESSAGE
+            self.cache_answer(human_message, fingerprint, ai_msg, start_time)
+        self.record_stage("generation", time() - start_time)
 
-        self.msg_chain.append(AIMessage(content=ai_msg))
+        self.record_turn(human_message, ai_msg, start_time)
+        return ai_msg
 
-        human_msg_simplified = HumanMessage(content=human_message)
-        self.msg_chain.append(human_msg_simplified)
-        end_time = time()
-        self.last_langchain_rtt = end_time - start_time
-        print(f"Lang to GPT and back RTT: {self.last_langchain_rtt} seconds")
+    def call_chat_stream(self, human_message: str):
+        """
+        Streaming version of call_chat. Yields the answer as it is generated, then records the turn
+        like call_chat does. Timings are left in last_stage_latency and last_langchain_rtt
+        """
+        self.last_stage_latency = dict[str, float]()
+        start_time = time()
+        fingerprint = context_fingerprint(human_message, user_doc_id(self.fname, self.lname), self.model, self.meal_plan.rendered, self.structured_data["summary"])
+        ai_msg = self.cached_answer(human_message, fingerprint, start_time)
+        if ai_msg is not None:
+            self.record_stage("first_token", time() - start_time)
+            yield ai_msg
+            return
+        self.admit()
+        guardrail = self.start_guardrails(human_message)
+        if "meal plan" in human_message.lower():
+            # the meal plan is rewritten as a whole, there is nothing useful to stream
+            try:
+                meal_plan = "".join(self.speculative_stream(self.meal_plan_prompt(human_message), guardrail))
+            except Exception as e:
+                if not guardrail.result():
+                    yield REFUSAL_MESSAGE
+                    return
+                raise
+            if not guardrail.result():
+                yield REFUSAL_MESSAGE
+                return
+            if not self.apply_meal_plan_patch(meal_plan):
+                yield UNSURE_MESSAGE
+                return
+            ai_msg = "The meal plan needs to be changed. Please wait while I update it."
+            self.msg_chain.append(AIMessage(content="Request Fullfilled."))
+            self.record_stage("first_token", time() - start_time)
+            yield ai_msg
+        else:
+            tokens = []
+            try:
+                for token in self.speculative_stream(self.chat_prompt(human_message), guardrail):
+                    if len(tokens) == 0:
+                        self.record_stage("first_token", time() - start_time)
+                    tokens.append(token)
+                    yield token
+            except Overloaded:
+                raise
+            except Exception as e:
+                print(e)
+                if len(tokens) > 0:
+                    raise # the client already saw part of the answer, let the caller report the error
+                yield REFUSAL_MESSAGE if not guardrail.result() else UNSURE_MESSAGE
+                return
+            if not guardrail.result():
+                yield REFUSAL_MESSAGE
+                return
+            ai_msg = "".join(tokens)
+            if ai_msg.strip() == "":
+                ai_msg = UNSURE_MESSAGE
+                self.record_stage("first_token", time() - start_time)
+                yield ai_msg
+            self.cache_answer(human_message, fingerprint, ai_msg, start_time)
+        self.record_stage("generation", time() - start_time)
 
-        # update unstructured data
-        self.update_summary()
-        # self.update_key_facts()
-        return ai_msg
+        self.record_turn(human_message, ai_msg, start_time)
     
+    def astart_guardrails(self, human_message: str):
+        """
+        Async version of start_guardrails. Returns a task with the verdict
+        """
+        guardrail_start = time()
+        async def run():
+            guardrail_health_related = await self.achat_guardrails(human_message)
+            self.record_stage("guardrail", time() - guardrail_start)
+            print("Passed Guardrails: ", guardrail_health_related)
+            return guardrail_health_related
+        return asyncio.ensure_future(run())
+
+    async def aspeculative_stream(self, messages: list[BaseMessage], guardrail: asyncio.Task):
+        """
+        Async version of speculative_stream
+        """
+        if guardrail.done() and not guardrail.result():
+            return
+        held = []
+        stream = self.astream_chat(messages)
+        try:
+            async for token in stream:
+                if not guardrail.done():
+                    held.append(token)
+                    continue
+                if not guardrail.result():
+                    return
+                if len(held) > 0:
+                    yield "".join(held)
+                    held = []
+                yield token
+            if await guardrail and len(held) > 0:
+                yield "".join(held)
+        finally:
+            await stream.aclose()
+
+    async def acall_chat(self, human_message: str):
+        """
+        Async version of call_chat
+        """
+        tokens = []
+        try:
+            async for token in self.acall_chat_stream(human_message):
+                tokens.append(token)
+        except Overloaded:
+            raise
+        except Exception as e:
+            if "meal plan" in human_message.lower():
+                raise
+            print(e)
+            return UNSURE_MESSAGE
+        return "".join(tokens)
+
+    async def acall_chat_stream(self, human_message: str):
+        """
+        Async version of call_chat_stream, built on the provider's astream API.
+        History search (BM25 over the user's file) and the turn's history write run in threads, off the event loop
+        """
+        self.last_stage_latency = dict[str, float]()
+        start_time = time()
+        fingerprint = context_fingerprint(human_message, user_doc_id(self.fname, self.lname), self.model, self.meal_plan.rendered, self.structured_data["summary"])
+        ai_msg = await self.acached_answer(human_message, fingerprint, start_time)
+        if ai_msg is not None:
+            self.record_stage("first_token", time() - start_time)
+            yield ai_msg
+            return
+        await asyncio.to_thread(self.admit) # the first turn on a model builds its client (and imports the provider)
+        guardrail = self.astart_guardrails(human_message)
+        if "meal plan" in human_message.lower():
+            try:
+                meal_plan = "".join([token async for token in self.aspeculative_stream(self.meal_plan_prompt(human_message), guardrail)])
+            except Exception as e:
+                if not await guardrail:
+                    yield REFUSAL_MESSAGE
+                    return
+                raise
+            if not await guardrail:
+                yield REFUSAL_MESSAGE
+                return
+            if not self.apply_meal_plan_patch(meal_plan):
+                yield UNSURE_MESSAGE
+                return
+            ai_msg = "The meal plan needs to be changed. Please wait while I update it."
+            self.msg_chain.append(AIMessage(content="Request Fullfilled."))
+            self.record_stage("first_token", time() - start_time)
+            yield ai_msg
+        else:
+            tokens = []
+            try:
+                messages = await asyncio.to_thread(self.chat_prompt, human_message)
+                async for token in self.aspeculative_stream(messages, guardrail):
+                    if len(tokens) == 0:
+                        self.record_stage("first_token", time() - start_time)
+                    tokens.append(token)
+                    yield token
+            except Overloaded:
+                raise
+            except Exception as e:
+                print(e)
+                if len(tokens) > 0:
+                    raise # the client already saw part of the answer, let the caller report the error
+                yield REFUSAL_MESSAGE if not await guardrail else UNSURE_MESSAGE
+                return
+            if not await guardrail:
+                yield REFUSAL_MESSAGE
+                return
+            ai_msg = "".join(tokens)
+            if ai_msg.strip() == "":
+                ai_msg = UNSURE_MESSAGE
+                self.record_stage("first_token", time() - start_time)
+                yield ai_msg
+            self.cache_answer(human_message, fingerprint, ai_msg, start_time)
+        self.record_stage("generation", time() - start_time)
+
+        await asyncio.to_thread(self.record_turn, human_message, ai_msg, start_time)
+
     def determine_if_meal_plan_change_needed(self, human_message: str, ai_message:str):
         """
         Used to determine if the meal plan needs to be changed using key facts, summary and last 8 messages.
@@ -355,7 +1127,7 @@ class HumanExternalDataStore:
             If the response to the user's wants includes something that looks like a meal plan return ONLY True
             RETURN ONLY True OR False """
         .format(
-            meal_plan=self.structured_data["meal_plan"],
+            meal_plan=self.meal_plan.rendered,
             key_facts=(", ".join([k+" : "+v  for k,v in self.unstructured_data["key_facts"].items()])),
             summary=self.structured_data["summary"],
             last_message=human_message,
@@ -366,21 +1138,29 @@ class HumanExternalDataStore:
         result = True if result.content.strip() == "True" else False
         return result
     
-    def change_meal_plan(self, human_message: str):
+    def meal_plan_prompt(self, human_message: str):
         """
-        If the meal plan needs to be changed, change it
+        Used to build the message list asking the model for a new meal plan
         """
-        # invoke chat
-        result = self.invoke_chat([HumanMessage(content="""
+        meal_plan_msg = HumanMessage(content="""
             Here is the existing meal plan: {meal_plan}
             Here is the summary of the conversation: {summary}
             Here is what the user wants: {last_message}
-            The meal plan needs to change. What should the new meal plan be? Make minimal changes to the existing meal plan while PIORITIZING THE USERS WANTS.
-            ONLY INCLUDE INFORMATION PERTAINING TO A MEAL PLAN
-            RETURN ONLY THE NEW MEAL PLAN AS A STRING
+            The meal plan needs to change. Make minimal changes to the existing meal plan while PIORITIZING THE USERS WANTS.
+            ONLY INCLUDE INFORMATION PERTAINING TO A MEAL PLAN{patch_instructions}
         """.format(
-            meal_plan=self.structured_data["meal_plan"],
+            patch_instructions=PATCH_INSTRUCTIONS,
+            meal_plan=self.meal_plan.rendered,
             summary=self.structured_data["summary"],
             last_message=human_message
-        ))], "str")
-        self.structured_data["meal_plan"] = result
\ No newline at end of file
+        ))
+        messages, self.last_prompt_tokens["meal_plan"] = context_assembler.build("meal_plan", [], meal_plan_msg)
+        return messages
+
+    def change_meal_plan(self, human_message: str):
+        """
+        If the meal plan needs to be changed, change it
+        """
+        # invoke chat
+        result = self.invoke_chat(self.meal_plan_prompt(human_message), "str", BACKGROUND)
+        self.apply_meal_plan_patch(result)
\ No newline at end of file
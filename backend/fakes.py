@@ -0,0 +1,93 @@
+"""
+Offline stand-ins used by the benchmarks. Nothing in here talks to a real provider
+"""
+import re
+import json
+import random
+import asyncio
+from time import sleep
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatResult, ChatGeneration, ChatGenerationChunk
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Chat model that answers instantly (or after latency seconds) without any network calls.
+    latency is the median of a log-normal distribution with spread latency_sigma, tail_probability of the
+    calls take tail_latency seconds longer and error_rate of them fail, to reproduce a provider's tail offline.
+    With tokens_per_second set, answers are produced at that rate after the first token like a real provider.
+    Guardrail prompts get a positive Guardrail JSON answer (one per message for batches) and meal plan prompts a one meal patch,
+    so the whole call_chat path can run
+    """
+    model: str = "fake"
+    reply: str = "Drink about 2 to 3 liters of water a day and more when you train."
+    latency: float = 0.0
+    latency_sigma: float = 0.0
+    tail_probability: float = 0.0
+    tail_latency: float = 0.0
+    error_rate: float = 0.0
+    tokens_per_second: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake"
+
+    def answer(self, messages) -> str:
+        last = messages[-1].content if len(messages) > 0 else ""
+        if '"verdicts"' in last:
+            count = len(re.findall(r'^\s*\d+\. "', last, flags=re.M))
+            return json.dumps({"verdicts": [{"reasoning": "fake provider", "is_health_related": True}] * count})
+        if "is_health_related" in last:
+            return json.dumps({"reasoning": "fake provider", "is_health_related": True})
+        if '"operations"' in last:
+            return json.dumps({"operations": [{"op": "set_meal", "day": "Monday", "meal": "Breakfast",
+                                               "items": [{"name": "oats", "quantity": "80g"}, {"name": "banana", "quantity": "1"}]}]})
+        return self.reply
+
+    def delay(self) -> float:
+        """
+        Seconds this call takes. Raises for the calls that fail
+        """
+        if self.error_rate > 0 and random.random() < self.error_rate:
+            raise ConnectionError(f"fake provider {self.model} failed")
+        delay = self.latency * random.lognormvariate(0, self.latency_sigma) if self.latency_sigma > 0 else self.latency
+        if self.tail_probability > 0 and random.random() < self.tail_probability:
+            delay += self.tail_latency
+        return delay
+
+    def tokens(self, messages) -> list[str]:
+        return [word if i == 0 else " " + word for i, word in enumerate(self.answer(messages).split(" "))]
+
+    def token_gap(self) -> float:
+        return 1 / self.tokens_per_second if self.tokens_per_second > 0 else 0.0
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        delay = self.delay() + self.token_gap() * (len(self.tokens(messages)) - 1)
+        if delay > 0:
+            sleep(delay)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.answer(messages)))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        delay = self.delay()
+        if delay > 0:
+            sleep(delay)
+        for i, token in enumerate(self.tokens(messages)):
+            if i > 0 and self.token_gap() > 0:
+                sleep(self.token_gap())
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        delay = self.delay() + self.token_gap() * (len(self.tokens(messages)) - 1)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.answer(messages)))])
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        delay = self.delay()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        for i, token in enumerate(self.tokens(messages)):
+            if i > 0 and self.token_gap() > 0:
+                await asyncio.sleep(self.token_gap())
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
@@ -0,0 +1,334 @@
+import os
+import re
+import random
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from time import time
+from pydantic import BaseModel
+
+GUARDRAIL_CACHE_SIZE = int(os.getenv("GUARDRAIL_CACHE_SIZE", "4096"))
+GUARDRAIL_CACHE_TTL = float(os.getenv("GUARDRAIL_CACHE_TTL", "3600"))
+GUARDRAIL_BATCH_WINDOW_SECONDS = float(os.getenv("GUARDRAIL_BATCH_WINDOW_SECONDS", "0.005"))
+GUARDRAIL_BATCH_SIZE = int(os.getenv("GUARDRAIL_BATCH_SIZE", "16"))
+GUARDRAIL_BATCH_WORKERS = int(os.getenv("GUARDRAIL_BATCH_WORKERS", "8")) # batches classified at the same time
+GUARDRAIL_BATCH_AUDIT_RATE = float(os.getenv("GUARDRAIL_BATCH_AUDIT_RATE", "1")) # share of batches cross-checked
+
+
+# pydantic model with reasoning and is_health_related
+class Guardrail(BaseModel):
+    reasoning: str
+    is_health_related: bool
+
+
+class GuardrailBatch(BaseModel):
+    verdicts: list[Guardrail] # one per message, in the order they were sent
+
+
+def normalize_message(message: str) -> str:
+    """
+    Used to turn a message into the key verdicts are cached under
+    """
+    message = message.lower().strip()
+    message = re.sub(r"[^\w\s]", " ", message)
+    return re.sub(r"\s+", " ", message).strip()
+
+
+# TECHNICAL DECISION: the lexicon never decides on its own. Health words are trivial to pad an off-topic request with,
+# and a word list misses health questions that mention code, cars or games, so the LLM makes every call.
+# The lexicon only flags messages it reads as off topic, and the counters show how often the LLM disagrees
+HEALTH_TERMS = {
+    "protein", "proteins", "calorie", "calories", "carb", "carbs", "carbohydrate", "carbohydrates", "fat", "fats",
+    "diet", "dieting", "nutrition", "nutrient", "nutrients", "vitamin", "vitamins", "mineral", "minerals",
+    "creatine", "supplement", "supplements", "macro", "macros", "fiber", "hydration", "hydrated",
+    "workout", "workouts", "exercise", "exercises", "cardio", "lifting", "squat", "squats", "deadlift", "bench",
+    "pushup", "pushups", "running", "stretching", "muscle", "muscles", "strength", "gym", "training", "reps",
+    "weight", "bmi", "metabolism", "sleep", "fitness", "health", "healthy", "injury", "recovery", "meal", "meals",
+    "breakfast", "lunch", "dinner", "snack", "snacks", "vegan", "vegetarian", "keto", "fasting", "cholesterol",
+    "sugar", "sodium", "blood", "pressure", "diabetes", "heart", "doctor", "symptom", "symptoms", "pain",
+    "eat", "eating", "drink", "water", "grams", "back", "neck", "shoulder", "knee", "knees", "hip", "joint", "joints",
+    "posture", "surgery", "sore", "soreness", "ache", "injured", "stretch", "body", "medical", "medicine", "sitting",
+}
+OFF_TOPIC_TERMS = {
+    "python", "javascript", "java", "code", "coding", "program", "programming", "compile", "sql", "database",
+    "movie", "movies", "song", "songs", "lyrics", "poem", "novel", "election", "president", "politics",
+    "stock", "stocks", "crypto", "bitcoin", "invest", "investing", "weather", "capital", "translate",
+    "homework", "essay", "math", "equation", "physics", "chemistry", "history", "car", "cars", "game", "games",
+}
+LEXICON_MIN_HITS = 2
+
+
+def lexicon_flags(normalized: str) -> bool:
+    """
+    Fast in-process hint. True when the message reads as clearly off topic (several off-topic words, no health word)
+    """
+    words = set(normalized.split(" "))
+    return len(words & OFF_TOPIC_TERMS) >= LEXICON_MIN_HITS and len(words & HEALTH_TERMS) == 0
+
+
+# messages that talk about the classification itself are never batched with other users' messages
+INSTRUCTION_PATTERN = re.compile(
+    r"\b(ignore|disregard|instructions?|prompt|verdicts?|is health related|json|(every|all|each|other) messages?"
+    r"|mark|classif\w*|previous|pretend)\b"
+)
+
+
+def looks_like_instructions(human_message: str) -> bool:
+    return INSTRUCTION_PATTERN.search(normalize_message(human_message)) is not None
+
+
+def unparseable(error: BaseException) -> bool:
+    """ True if error, or what it was raised from (e.g. the router's AllModelsFailed), is an answer that did not parse """
+    while error is not None:
+        if isinstance(error, ValueError): # includes langchain's OutputParserException
+            return True
+        error = error.__cause__
+    return False
+
+
+class VerdictCache:
+    """
+    Thread-safe LRU cache of Guardrail verdicts with a time to live
+    """
+    def __init__(self, max_size: int = GUARDRAIL_CACHE_SIZE, ttl: float = GUARDRAIL_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict() # key -> (expires_at, Guardrail)
+        self.lock = threading.Lock()
+
+    def get(self, key: str):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key: str, verdict: Guardrail):
+        with self.lock:
+            self.entries[key] = (time() + self.ttl, verdict)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class TieredGuardrail:
+    """
+    Guardrail check in two tiers: verdict cache, then the LLM. The lexicon only flags messages, it never answers
+    """
+    def __init__(self, cache: VerdictCache = None):
+        self.cache = cache if cache is not None else VerdictCache()
+        self.counters = {"cache_hits": 0, "cache_misses": 0, "lexicon_flags": 0, "lexicon_overruled": 0, "llm_fallbacks": 0}
+        self.counters_lock = threading.Lock()
+
+    def count(self, name: str):
+        with self.counters_lock:
+            self.counters[name] += 1
+
+    def lookup(self, human_message: str):
+        """
+        Used to answer a message from the cache. Returns (cache key, verdict), verdict is None when the LLM is needed
+        """
+        key = normalize_message(human_message)
+        verdict = self.cache.get(key)
+        if verdict is not None:
+            self.count("cache_hits")
+            return key, verdict
+        self.count("cache_misses")
+        self.count("llm_fallbacks")
+        return key, None
+
+    def settle(self, key: str, verdict):
+        """ Caches the LLM's verdict and compares it with the lexicon's hint """
+        if not isinstance(verdict, Guardrail): # unparseable answers are not worth caching
+            return
+        self.cache.put(key, verdict)
+        if lexicon_flags(key):
+            self.count("lexicon_flags")
+            if verdict.is_health_related:
+                self.count("lexicon_overruled")
+
+    def check(self, human_message: str, llm_check) -> Guardrail:
+        """
+        Returns the verdict for human_message. llm_check(human_message) -> Guardrail is only called on a cache miss
+        """
+        key, verdict = self.lookup(human_message)
+        if verdict is not None:
+            return verdict
+        verdict = llm_check(human_message)
+        self.settle(key, verdict)
+        return verdict
+
+    async def acheck(self, human_message: str, allm_check) -> Guardrail:
+        """
+        Async version of check, allm_check is awaited
+        """
+        key, verdict = self.lookup(human_message)
+        if verdict is not None:
+            return verdict
+        verdict = await allm_check(human_message)
+        self.settle(key, verdict)
+        return verdict
+
+    def stats(self) -> dict:
+        with self.counters_lock:
+            stats = dict(self.counters)
+        stats["cache_size"] = len(self.cache)
+        checks = stats["cache_hits"] + stats["cache_misses"]
+        # every check that did not reach the LLM is a call saved
+        stats["llm_calls_saved"] = checks - stats["llm_fallbacks"]
+        return stats
+
+
+class GuardrailBatcher:
+    """
+    Micro-batching of the LLM tier. Checks that arrive within window seconds of each other (up to max_batch of them)
+    are classified together by one classify(messages) -> list[Guardrail] call and each caller gets its own verdict.
+    A check waits at most window seconds longer than it would alone, unless workers calls are already in flight:
+    checks then keep piling into the next batch, so batches grow with the load instead of queueing calls.
+    Batches whose answer does not line up with their messages are classified again one message at a time.
+
+    Messages of different users share a prompt, so one message could try to steer the verdicts of the others.
+    Messages that read like instructions are classified alone, and audit_rate of the batches have one random
+    message classified alone at the same time: if the two verdicts disagree, the whole batch is classified
+    again one message at a time
+    """
+    def __init__(self, classify, window: float = GUARDRAIL_BATCH_WINDOW_SECONDS, max_batch: int = GUARDRAIL_BATCH_SIZE,
+                 workers: int = GUARDRAIL_BATCH_WORKERS, audit_rate: float = GUARDRAIL_BATCH_AUDIT_RATE):
+        self.classify = classify
+        self.window = window
+        self.max_batch = max_batch
+        self.audit_rate = audit_rate
+        self.pending = [] # (message, Future) waiting for the next batch
+        self.cond = threading.Condition()
+        self.thread = None
+        # a batch and its audit run side by side, so there is room for both
+        self.pool = ThreadPoolExecutor(max_workers=2 * workers, thread_name_prefix="guardrail-batch")
+        self.slots = threading.Semaphore(workers) # one per batch in flight
+        self.counters = {"batches": 0, "batched_checks": 0, "largest_batch": 0, "split_batches": 0, "isolated": 0,
+                         "audits": 0, "audit_failures": 0, "errors": 0}
+
+    def start(self):
+        with self.cond:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="guardrail-batcher", daemon=True)
+                self.thread.start()
+
+    def submit(self, human_message: str) -> Future:
+        """ Queues a check. The future resolves to its Guardrail """
+        self.start()
+        future = Future()
+        with self.cond:
+            self.pending.append((human_message, future))
+            self.cond.notify()
+        return future
+
+    def check(self, human_message: str) -> Guardrail:
+        return self.submit(human_message).result()
+
+    async def acheck(self, human_message: str) -> Guardrail:
+        """ Async version of check. The batched call itself runs on the batcher's threads """
+        return await asyncio.wrap_future(self.submit(human_message))
+
+    def next_batch(self) -> list:
+        """ Waits for a batch to be ready and pops it """
+        with self.cond:
+            while len(self.pending) == 0:
+                self.cond.wait()
+            deadline = time() + self.window
+            while len(self.pending) < self.max_batch and time() < deadline:
+                self.cond.wait(timeout=deadline - time())
+            batch = self.pending[:self.max_batch]
+            self.pending = self.pending[self.max_batch:]
+            return batch
+
+    def partition(self, batch: list) -> list[list]:
+        """ The shared batch, then one batch per message that reads like instructions """
+        shared = [item for item in batch if not looks_like_instructions(item[0])]
+        alone = [[item] for item in batch if looks_like_instructions(item[0])]
+        return ([shared] if len(shared) > 0 else []) + alone
+
+    def run(self):
+        while True:
+            self.slots.acquire()
+            groups = self.partition(self.next_batch())
+            for i, group in enumerate(groups):
+                if i > 0:
+                    self.slots.acquire()
+                with self.cond:
+                    self.counters["batches"] += 1
+                    self.counters["batched_checks"] += len(group)
+                    self.counters["largest_batch"] = max(self.counters["largest_batch"], len(group))
+                    self.counters["isolated"] += 1 if i > 0 else 0
+                self.pool.submit(self.dispatch, group)
+
+    def dispatch(self, batch: list):
+        try:
+            self.classify_batch(batch)
+        finally:
+            self.slots.release()
+
+    def classify_batch(self, batch: list):
+        messages = [message for message, _ in batch]
+        audit = None
+        if len(batch) > 1 and random.random() < self.audit_rate:
+            index = random.randrange(len(batch))
+            audit = (index, self.pool.submit(self.classify, [messages[index]]))
+        try:
+            verdicts = self.classify(messages)
+            if len(verdicts) != len(messages):
+                raise ValueError(f"{len(verdicts)} verdicts for {len(messages)} messages")
+        except Exception as e:
+            if len(batch) == 1 or not unparseable(e): # the model is down, retrying message by message would only add load
+                self.fail(batch, e)
+                return
+            # one bad answer should not fail every user in the batch
+            self.count("split_batches")
+            self.classify_alone(batch)
+            return
+        if audit is not None and not self.passes_audit(verdicts, *audit):
+            self.count("audit_failures")
+            self.classify_alone(batch)
+            return
+        for (_, future), verdict in zip(batch, verdicts):
+            future.set_result(verdict)
+
+    def passes_audit(self, verdicts: list[Guardrail], index: int, alone: Future) -> bool:
+        """ False if the message classified alone got another verdict than in the batch """
+        self.count("audits")
+        try:
+            verdict = alone.result()[0]
+        except Exception as e: # nothing to compare against, the batch answer stands
+            print("Guardrail audit failed: ", e)
+            return True
+        return verdict.is_health_related == verdicts[index].is_health_related
+
+    def classify_alone(self, batch: list):
+        for item in batch:
+            self.classify_batch([item])
+
+    def fail(self, batch: list, error: Exception):
+        self.count("errors")
+        for _, future in batch:
+            future.set_exception(error)
+
+    def count(self, name: str):
+        with self.cond:
+            self.counters[name] += 1
+
+    def stats(self) -> dict:
+        with self.cond:
+            stats = dict(self.counters)
+            stats["pending"] = len(self.pending)
+        stats["mean_batch"] = stats["batched_checks"] / stats["batches"] if stats["batches"] > 0 else 0.0
+        return stats
+
+
+tiered_guardrail = TieredGuardrail()
@@ -1,61 +1,98 @@
-from flask import Flask, request, jsonify
-from database import HumanExternalDataStore, HumanMessage, AIMessage
+from flask import Flask, request, jsonify, Response, stream_with_context
+from database import HumanExternalDataStore, HumanMessage, AIMessage, journal, context_assembler, guardrail_batcher, warm_up, user_doc_id
+from response_cache import response_cache
+from routing import router
+from guardrails import tiered_guardrail
+from sessions import SessionPool
+from state_store import state_store_from_env
+from metrics import metrics
+from scheduler import scheduler, Overloaded
 import os
+import sys
+import signal
+import threading
 from dotenv import load_dotenv
 from flask_cors import CORS
 from typing_extensions import TypedDict
 from pydantic import BaseModel
 from time import time
+import json
 # Load environment variables
 load_dotenv()
 
 app = Flask(__name__)
 CORS(app)
-pool = dict()
+pool = SessionPool(store=state_store_from_env()) # SESSION_STORE lets several workers share sessions
+
+# TECHNICAL DECISION: nothing connects on import. PT_WARMUP=gpt-4o-mini,... connects Firestore and builds
+# those models' clients in the background while the worker starts serving
+if os.getenv("PT_WARMUP"):
+    threading.Thread(target=warm_up, args=([m for m in os.getenv("PT_WARMUP").split(",") if m != ""],), name="warm-up", daemon=True).start()
 
 @app.route('/heartbeat', methods=['GET'])
 def heartbeat():
     """Simple route to check if the API is running"""
     return jsonify({"status": "alive", "message": "API is running"}), 200
 
+def collect_stats() -> dict:
+    """Counters used to see how much work the caches and background workers save"""
+    return {
+        "guardrail": tiered_guardrail.stats(),
+        "guardrail_batches": guardrail_batcher.stats(),
+        "sessions": pool.stats(),
+        "persistence": journal.stats(),
+        "context": context_assembler.stats(),
+        "response_cache": response_cache.stats(),
+        "routing": router.stats(),
+        "scheduler": scheduler.stats()
+    }
+
+metrics.register_stats(collect_stats)
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    """Counters used to see how much work the caches and background workers save"""
+    return jsonify(collect_stats()), 200
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Stage latencies, token counts and the /stats counters in the Prometheus text format"""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
 @app.route('/init', methods=['POST'])
 def init():
     """
-    Initialize the database for a new user
+    Initialize the database for a user. Reattaches to the user's session if it is still live
+
+    Expected JSON payload:
+    {
+        "userfname": "First Name",
+        "userlname": "Last Name",
+        "cursor": {"epoch": "...", "count": 12} (optional, the cursor of the last /init. Only newer messages are returned),
+        "meal_plan_version": 3 (optional, only the meal plan changes since that version are returned)
+    }
     """
     data = request.get_json() 
     # handle authentication
     userfname = data.get('userfname')
     userlname = data.get('userlname')
     start_time = time()
-    api_id = userfname + ":" + userlname
+    api_id = user_doc_id(userfname, userlname)
 
-    if api_id not in pool:
-        pool[api_id] = {
-            "fname": userfname,
-            "lname": userlname,
-            "db": None
-        }
-    
     # get url
     url = request.url
     
-    if pool[api_id]["db"] is None: # if the database is not initialized, initialize it
-        pool[api_id]["db"] = HumanExternalDataStore(pool[api_id]["fname"], pool[api_id]["lname"], url)
-    else: # if the database is already initialized, close it and initialize a new one
-        pool[api_id]["db"].close() 
-        pool[api_id]["db"] = HumanExternalDataStore(pool[api_id]["fname"], pool[api_id]["lname"], url)
-    
-    cur_db = pool[api_id]["db"]
+    with pool.turn_lock(api_id):
+        cur_db = pool.open(api_id, userfname, userlname, url)
+        payload = cur_db.history_payload(data.get('cursor'))
+        payload.update(cur_db.meal_plan.payload(data.get('meal_plan_version')))
     end_time = time()
-    print(f"API to Firebase time: {end_time - start_time} seconds")
+    metrics.request_seconds.observe(end_time - start_time, "/init")
     
     return jsonify({
         "status": "success", 
         "message": "Database connection initialized",
-        "human_messages": [m.content for m in cur_db.msg_chain if isinstance(m, HumanMessage)], # "responses" and "messages" was removed
-        "ai_responses": [m.content for m in cur_db.msg_chain if isinstance(m, AIMessage)],
-        "meal_plan": cur_db.structured_data['meal_plan'],
+        **payload,
         "latency": end_time - start_time
     }), 200
 
@@ -69,7 +106,9 @@ def chat():
     {
         "userfname": "First Name",
         "userlname": "Last Name",
-        "message": "User message here"
+        "message": "User message here",
+        "meal_plan_version": 3 (optional, the response then only carries the meal plan changes since that version),
+        "stages": true (optional, adds the seconds spent per stage as stage_latency)
     }
     """
     try:
@@ -85,51 +124,144 @@ def chat():
         userfname = data.get('userfname')
         userlname = data.get('userlname')
         model = data.get('model')
-        api_id = userfname + ":" + userlname
+        api_id = user_doc_id(userfname, userlname)
 
-        # compare userfname and userlname with user_creds
-        if userfname != pool[api_id]["fname"] or userlname != pool[api_id]["lname"]:
+        if not userfname or not userlname:
             return jsonify({"error": "Invalid user credentials"}), 401
         
-        # Process the message and get response
-        pool[api_id]["db"].model = model
-        ai_response = pool[api_id]["db"].call_chat(message)
+        # Process the message and get response. Evicted sessions are reloaded from Firestore
+        # one turn at a time per user, concurrent requests for the same user wait here
+        with pool.turn_lock(api_id), metrics.trace() as stages:
+            cur_db = pool.acquire(api_id, userfname, userlname, request.url)
+            try:
+                cur_db.model = model
+                ai_response = cur_db.call_chat(message)
+            finally:
+                pool.release(api_id)
 
         end_time = time()
-        print(f"API to Lang to GPT and back RTT: {end_time - start_time} seconds")
-        return jsonify({
+        metrics.request_seconds.observe(end_time - start_time, "/chat")
+        response = {
             "status": "success",
             "response": ai_response,
-            "meal_plan": pool[api_id]["db"].structured_data["meal_plan"],
+            **cur_db.meal_plan.payload(data.get('meal_plan_version')),
             "latency": end_time - start_time,
-            "langchain_rtt": pool[api_id]["db"].last_langchain_rtt
-        }), 200
-        
+            "langchain_rtt": cur_db.last_langchain_rtt,
+            "prompt_tokens": cur_db.last_prompt_tokens
+        }
+        if data.get('stages'):
+            response["stage_latency"] = {**stages, **cur_db.last_stage_latency}
+        return jsonify(response), 200
+
+    except Overloaded as e:
+        # the client retries later instead of waiting in a queue it would time out in
+        return jsonify({"error": str(e), "retry_after": e.retry_after}), 429, {"Retry-After": str(e.retry_after)}
     except Exception as e:
         print(e)
+        metrics.request_errors.inc(1, "/chat")
         return jsonify({"error": str(e)}), 500
+
+def sse_event(data: dict, event: str = None) -> str:
+    """Format a dict as a Server-Sent Event"""
+    prefix = f"event: {event}\n" if event is not None else ""
+    return prefix + "data: " + json.dumps(data) + "\n\n"
+
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    """
+    Streaming version of /chat. Takes the same JSON payload and answers with Server-Sent Events:
+    a {"token": "..."} event per chunk of the answer, then a "done" event carrying
+    the meal plan, the per-stage latency and langchain_rtt
+    """
+    start_time = time()
+    data = request.get_json()
+    if not data:
+        return jsonify({"error": "No data provided"}), 400
+
+    message = data.get('message')
+    userfname = data.get('userfname')
+    userlname = data.get('userlname')
+    model = data.get('model')
+    api_id = user_doc_id(userfname, userlname)
+
+    if not userfname or not userlname:
+        return jsonify({"error": "Invalid user credentials"}), 401
+
+    turn_lock = pool.turn_lock(api_id)
+    turn_lock.acquire()
+    try:
+        with metrics.trace() as stages: # Firestore reads of a rehydrated session
+            cur_db = pool.acquire(api_id, userfname, userlname, request.url)
+    except Exception:
+        turn_lock.release()
+        raise
+    cur_db.model = model
+
+    def finish():
+        pool.release(api_id)
+        turn_lock.release()
+
+    def generate():
+        try:
+            first_token_time = None
+            for token in cur_db.call_chat_stream(message):
+                if first_token_time is None:
+                    first_token_time = time()
+                yield sse_event({"token": token})
+            end_time = time()
+            metrics.request_seconds.observe(end_time - start_time, "/chat/stream")
+            yield sse_event({
+                "status": "success",
+                **cur_db.meal_plan.payload(data.get('meal_plan_version')),
+                "latency": end_time - start_time,
+                "time_to_first_token": (first_token_time or end_time) - start_time,
+                "stage_latency": {**stages, **cur_db.last_stage_latency},
+                "langchain_rtt": cur_db.last_langchain_rtt,
+                "prompt_tokens": cur_db.last_prompt_tokens
+            }, event="done")
+        except Overloaded as e:
+            yield sse_event({"error": str(e), "retry_after": e.retry_after}, event="error")
+        except Exception as e:
+            print(e)
+            metrics.request_errors.inc(1, "/chat/stream")
+            yield sse_event({"error": str(e)}, event="error")
+
+    response = Response(stream_with_context(generate()), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no" # stop proxies from buffering the stream
+    })
+    response.call_on_close(finish)
+    return response
     
 @app.route('/close', methods=['POST'])
 def close():
     """
     Close the database for a user
     """
+    start_time = time()
     data = request.get_json()
     userfname = data.get('userfname')
     userlname = data.get('userlname')
-    api_id = userfname + ":" + userlname
+    api_id = user_doc_id(userfname, userlname)
 
     # save user data and remove the user from the pool
     try:
-        _, message = pool[api_id]["db"].close()
-        del pool[api_id]
+        with pool.turn_lock(api_id):
+            cur_db = pool.remove(api_id, userfname, userlname, request.url)
+            if cur_db is None: # evicted sessions were already saved
+                return jsonify({"error": "Session not found"}), 404
+            _, message = cur_db.close(wait=False) # saved with the next write-behind batch
+        metrics.request_seconds.observe(time() - start_time, "/close")
         return jsonify({"status": "success", "message": message}), 200
     except Exception as e:
         print(e)
+        metrics.request_errors.inc(1, "/close")
         return jsonify({"error": str(e)}), 500
     
 
 if __name__ == '__main__':
+    # exit cleanly on SIGTERM so the write-behind journal drains before the process stops
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=False)
 
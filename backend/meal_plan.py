@@ -0,0 +1,169 @@
+"""
+Structured meal plan. The plan is days -> meals -> items, and the model changes it by returning a small
+patch (a list of operations) that is applied here, instead of rewriting the whole plan as text.
+Every applied patch bumps the plan's version, and the last few patches are kept so clients that
+already have an older version can be sent just the operations they missed.
+"""
+import os
+from typing import Literal
+from pydantic import BaseModel
+from langchain_core.output_parsers import PydanticOutputParser
+
+MEAL_PLAN_HISTORY = int(os.getenv("MEAL_PLAN_HISTORY", "10")) # patches kept for delta sync
+
+
+class MealItem(BaseModel):
+    name: str
+    quantity: str = ""
+
+
+class Meal(BaseModel):
+    name: str
+    items: list[MealItem] = []
+
+
+class Day(BaseModel):
+    name: str
+    meals: list[Meal] = []
+
+
+class MealPlan(BaseModel):
+    days: list[Day] = []
+    notes: str = "" # free text, also where plans from before the structured format end up
+
+
+class MealPlanOp(BaseModel):
+    op: Literal["set_meal", "remove_meal", "remove_day", "set_notes"]
+    day: str = ""
+    meal: str = ""
+    items: list[MealItem] = []
+    notes: str = ""
+
+
+class MealPlanPatch(BaseModel):
+    operations: list[MealPlanOp]
+
+
+PATCH_INSTRUCTIONS = """
+            RETURN ONLY A JSON OBJECT {"operations": [...]} with one entry per change, each one of:
+            {"op": "set_meal", "day": "<day>", "meal": "<meal>", "items": [{"name": "<food>", "quantity": "<amount>"}]} adds or replaces a meal
+            {"op": "remove_meal", "day": "<day>", "meal": "<meal>"}
+            {"op": "remove_day", "day": "<day>"}
+            {"op": "set_notes", "notes": "<text>"} replaces the notes
+            If the existing meal plan is only notes, turn it into set_meal operations and clear the notes.
+            Do not include operations for meals that stay the same."""
+
+patch_parser = PydanticOutputParser(pydantic_object=MealPlanPatch)
+
+
+def same_name(a: str, b: str) -> bool:
+    return a.strip().lower() == b.strip().lower()
+
+
+def apply_op(plan: MealPlan, op: MealPlanOp):
+    """
+    Apply one operation to plan in place. Days and meals are matched by name, ignoring case
+    """
+    if op.op == "set_notes":
+        plan.notes = op.notes
+        return
+    day = next((d for d in plan.days if same_name(d.name, op.day)), None)
+    if op.op == "remove_day":
+        if day is not None:
+            plan.days.remove(day)
+        return
+    if op.op == "remove_meal":
+        if day is not None:
+            day.meals = [m for m in day.meals if not same_name(m.name, op.meal)]
+        return
+    # set_meal
+    if day is None:
+        day = Day(name=op.day)
+        plan.days.append(day)
+    meal = Meal(name=op.meal, items=op.items)
+    for i, existing in enumerate(day.meals):
+        if same_name(existing.name, op.meal):
+            day.meals[i] = meal
+            return
+    day.meals.append(meal)
+
+
+def render(plan: MealPlan) -> str:
+    """
+    Compact text form used in prompts and by clients that want a string, one line per day
+    """
+    lines = []
+    for day in plan.days:
+        meals = "; ".join(m.name + ": " + ", ".join((i.name + " " + i.quantity).strip() for i in m.items) for m in day.meals)
+        lines.append(day.name + " - " + meals)
+    if plan.notes != "":
+        lines.append(plan.notes)
+    return "\n".join(lines)
+
+
+class MealPlanDocument:
+    """
+    A meal plan with its version and the patches that led to its latest versions
+    """
+    def __init__(self, plan: MealPlan = None, version: int = 0, history: list = None):
+        self.plan = plan if plan is not None else MealPlan()
+        self.version = version
+        self.history = history if history is not None else [] # [(version, operations as dicts)], oldest first
+        self.rendered = render(self.plan)
+
+    @classmethod
+    def from_data(cls, data):
+        """
+        Load what to_data saved. A plain string is a meal plan from before the structured format
+        """
+        if isinstance(data, str):
+            return cls(MealPlan(notes=data.strip()), version=1 if data.strip() != "" else 0)
+        if not data:
+            return cls()
+        return cls(MealPlan.model_validate(data.get("plan", {})), data.get("version", 0),
+                   [(h["version"], h["operations"]) for h in data.get("history", [])])
+
+    def to_data(self) -> dict:
+        return {
+            "version": self.version,
+            "plan": self.plan.model_dump(),
+            "history": [{"version": v, "operations": ops} for v, ops in self.history],
+        }
+
+    def apply(self, patch: MealPlanPatch):
+        """
+        Apply a patch and bump the version. Returns the operations that were applied, as dicts
+        """
+        for op in patch.operations:
+            apply_op(self.plan, op)
+        operations = [op.model_dump(exclude_defaults=True) for op in patch.operations]
+        self.version += 1
+        self.history = (self.history + [(self.version, operations)])[-MEAL_PLAN_HISTORY:]
+        self.rendered = render(self.plan)
+        return operations
+
+    def delta_since(self, version: int):
+        """
+        Operations that turn version into the current version, oldest first, or None if they are no longer kept
+        """
+        if version == self.version:
+            return []
+        if version > self.version or len(self.history) == 0 or self.history[0][0] > version + 1:
+            return None
+        return [op for v, ops in self.history if v > version for op in ops]
+
+    def payload(self, client_version=None) -> dict:
+        """
+        Meal plan fields of an API response. Clients that send the version they have get only what changed,
+        clients that do not, or send something that is not a version, get the plan as a string like before
+        """
+        try:
+            client_version = int(client_version) if not isinstance(client_version, bool) else None
+        except (TypeError, ValueError):
+            client_version = None
+        if client_version is None:
+            return {"meal_plan": self.rendered, "meal_plan_version": self.version}
+        delta = self.delta_since(client_version)
+        if delta is None:
+            return {"meal_plan_version": self.version, "meal_plan_document": self.plan.model_dump()}
+        return {"meal_plan_version": self.version, "meal_plan_delta": delta}
@@ -0,0 +1,156 @@
+"""
+In-process stand-in for the part of the Firestore client database.py uses: documents, get_all,
+batches and equality queries. Selected with PT_FIRESTORE_BACKEND=memory, so the backend can run and be
+load tested without credentials. latency seconds are slept on every round trip to mimic the real service.
+"""
+import copy
+import threading
+from time import sleep
+from google.api_core.exceptions import AlreadyExists, NotFound
+
+
+class MemorySnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self.data = data
+
+    def to_dict(self):
+        return copy.deepcopy(self.data)
+
+
+class MemoryDocument:
+    def __init__(self, db, path: str):
+        self.db = db
+        self.path = path
+        self.id = path.split("/")[-1]
+
+    def get(self):
+        self.db.round_trip("reads")
+        with self.db.lock:
+            return MemorySnapshot(self, copy.deepcopy(self.db.documents.get(self.path)))
+
+    def set(self, data: dict, merge: bool = False):
+        self.db.round_trip("writes")
+        with self.db.lock:
+            self.db.write(("set", self, data, merge))
+
+    def update(self, data: dict):
+        self.db.round_trip("writes")
+        with self.db.lock:
+            self.db.write(("update", self, data))
+
+    def delete(self):
+        self.db.round_trip("writes")
+        with self.db.lock:
+            self.db.write(("delete", self))
+
+
+class MemoryQuery:
+    def __init__(self, db, collection: str, filters: list = None):
+        self.db = db
+        self.collection = collection
+        self.filters = filters or [] # (field, value), only "==" is supported
+
+    def where(self, field_path: str = None, op_string: str = None, value=None, filter=None):
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        if op_string != "==":
+            raise NotImplementedError(f"Unsupported operator {op_string}")
+        return MemoryQuery(self.db, self.collection, self.filters + [(field_path, value)])
+
+    def get(self):
+        self.db.round_trip("reads")
+        with self.db.lock:
+            return [MemorySnapshot(MemoryDocument(self.db, path), copy.deepcopy(data))
+                    for path, data in self.db.documents.items()
+                    if path.rsplit("/", 1)[0] == self.collection and all(data.get(f) == v for f, v in self.filters)]
+
+    def stream(self):
+        return iter(self.get())
+
+
+class MemoryCollection(MemoryQuery):
+    def document(self, document_id: str) -> MemoryDocument:
+        return MemoryDocument(self.db, self.collection + "/" + document_id)
+
+
+class MemoryBatch:
+    """ Writes applied all at once on commit, or not at all """
+    def __init__(self, db):
+        self.db = db
+        self.writes = []
+
+    def create(self, reference, data: dict):
+        self.writes.append(("create", reference, data))
+
+    def set(self, reference, data: dict, merge: bool = False):
+        self.writes.append(("set", reference, data, merge))
+
+    def update(self, reference, data: dict):
+        self.writes.append(("update", reference, data))
+
+    def delete(self, reference):
+        self.writes.append(("delete", reference))
+
+    def commit(self):
+        self.db.round_trip("writes")
+        with self.db.lock:
+            for write in self.writes:
+                self.db.check(write)
+            for write in self.writes:
+                self.db.write(write)
+
+
+class MemoryFirestore:
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.documents = dict() # path -> data
+        self.lock = threading.Lock()
+        self.counters = {"reads": 0, "writes": 0}
+
+    def round_trip(self, kind: str):
+        with self.lock:
+            self.counters[kind] += 1
+        if self.latency > 0:
+            sleep(self.latency)
+
+    def check(self, write: tuple):
+        """ Raise like Firestore would. Caller holds self.lock """
+        kind, reference = write[0], write[1]
+        if kind == "create" and reference.path in self.documents:
+            raise AlreadyExists(f"Document already exists: {reference.path}")
+        if kind == "update" and reference.path not in self.documents:
+            raise NotFound(f"No document to update: {reference.path}")
+
+    def write(self, write: tuple):
+        """ Caller holds self.lock """
+        self.check(write)
+        kind, reference = write[0], write[1]
+        if kind == "create" or (kind == "set" and not write[3]):
+            self.documents[reference.path] = copy.deepcopy(write[2])
+        elif kind in ("set", "update"):
+            self.documents.setdefault(reference.path, {}).update(copy.deepcopy(write[2]))
+        else:
+            self.documents.pop(reference.path, None)
+
+    def collection(self, name: str) -> MemoryCollection:
+        return MemoryCollection(self, name)
+
+    def document(self, path: str) -> MemoryDocument:
+        return MemoryDocument(self, path)
+
+    def batch(self) -> MemoryBatch:
+        return MemoryBatch(self)
+
+    def get_all(self, references: list):
+        self.round_trip("reads")
+        with self.lock:
+            return [MemorySnapshot(r, copy.deepcopy(self.documents.get(r.path))) for r in references]
+
+    def stats(self) -> dict:
+        with self.lock:
+            stats = dict(self.counters)
+            stats["documents"] = len(self.documents)
+        return stats
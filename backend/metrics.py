@@ -0,0 +1,196 @@
+"""
+Process-wide metrics exposed on /metrics in the Prometheus text format: counters and histograms with labels,
+plus the /stats counters of every component as gauges. span(stage) times a block of code into the
+pt_stage_seconds histogram and into the trace of the current request, if one is being recorded.
+Recording is a dictionary lookup, a bisect and a short lock, so it can sit on the hot path.
+"""
+import math
+import threading
+import contextvars
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from time import perf_counter
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+
+current_trace = contextvars.ContextVar("current_trace", default=None) # stage -> seconds of the request being served
+
+
+def format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{n}="{escape(v)}"' for n, v in zip(names, values)]
+    if extra != "":
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if len(pairs) > 0 else ""
+
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def is_number(value) -> bool:
+    return isinstance(value, (int, float)) # bools too, as 0 and 1
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Counter:
+    """ Monotonic count per combination of label values """
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = dict() # label values -> count
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1, *label_values):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for label_values, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(self.labels, label_values)} {format_value(value)}")
+        return lines
+
+
+class Histogram:
+    """ Observations per combination of label values, counted into fixed buckets """
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series = dict() # label values -> [bucket counts (the last one is +Inf), sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = sorted((k, [list(v[0]), v[1], v[2]]) for k, v in self.series.items())
+        for label_values, (counts, total, count) in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                le = 'le="' + format_value(bound) + '"'
+                lines.append(f"{self.name}_bucket{format_labels(self.labels, label_values, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, label_values)} {format_value(total)}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, label_values)} {count}")
+        return lines
+
+
+class Metrics:
+    """
+    Used to hold every metric of the process. Components keep their own stats() counters,
+    collectors registered with register_stats expose them as gauges
+    """
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+        self.stage_seconds = self.histogram("pt_stage_seconds", "Seconds spent per stage of a request", ("stage",))
+        self.request_seconds = self.histogram("pt_request_seconds", "Seconds to answer a request", ("endpoint",))
+        self.request_errors = self.counter("pt_request_errors_total", "Requests answered with an error", ("endpoint",))
+        self.llm_calls = self.counter("pt_llm_calls_total", "Calls made to chat models", ("model",))
+        self.llm_tokens = self.counter("pt_llm_tokens_total", "Tokens sent to (input) and received from (output) chat models", ("model", "kind"))
+        self.prompt_tokens = self.histogram("pt_prompt_tokens", "Prompt tokens per call type, as assembled", ("call_type",), TOKEN_BUCKETS)
+
+    def counter(self, name: str, help: str, labels: tuple = ()) -> Counter:
+        metric = Counter(name, help, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        metric = Histogram(name, help, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def register_stats(self, collect):
+        """ collect() returns {section: stats dict}, like main.collect_stats """
+        self.collectors.append(collect)
+
+    def observe_stage(self, stage: str, seconds: float):
+        self.stage_seconds.observe(seconds, stage)
+        trace = current_trace.get()
+        if trace is not None:
+            trace[stage] = trace.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def span(self, stage: str):
+        """ Times the block as a stage """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_stage(stage, perf_counter() - start)
+
+    def timed(self, stage: str):
+        """ Decorator version of span """
+        def decorate(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.span(stage):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    @contextmanager
+    def trace(self):
+        """
+        Records the stages of the current request into the yielded dict. Threads started with
+        asyncio.to_thread or contextvars.copy_context() record into it too
+        """
+        stages = dict[str, float]()
+        token = current_trace.set(stages)
+        try:
+            yield stages
+        finally:
+            current_trace.reset(token)
+
+    def render_stats(self) -> list[str]:
+        """ Numeric stats as gauges: pt_<section>_<key>, nested dicts become a name label """
+        lines = []
+        for collect in self.collectors:
+            try:
+                sections = collect()
+            except Exception as e:
+                print("Error collecting stats: ", e)
+                continue
+            for section, stats in sections.items():
+                samples = dict() # metric name -> lines
+                for key, value in stats.items():
+                    if isinstance(value, dict):
+                        for inner_key, inner_value in value.items():
+                            if is_number(inner_value):
+                                samples.setdefault(f"pt_{section}_{inner_key}", []).append(f"{format_labels(('name',), (key,))} {format_value(inner_value)}")
+                    elif is_number(value):
+                        samples.setdefault(f"pt_{section}_{key}", []).append(f" {format_value(value)}")
+                for name, values in samples.items():
+                    lines.append(f"# TYPE {name} gauge")
+                    lines.extend(name + v for v in values)
+        return lines
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        lines.extend(self.render_stats())
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
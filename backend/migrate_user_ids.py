@@ -0,0 +1,14 @@
+"""
+One-time migration of users created before deterministic document ids, or under an earlier encoding of them
+(see user_doc_id in database.py). Users that are not migrated here are still migrated on their next /init.
+Once it has run, new users no longer pay for the lookup of a legacy document on their first /init.
+
+Usage (from backend/): python migrate_user_ids.py
+"""
+from dotenv import load_dotenv
+load_dotenv()
+
+from database import migrate_legacy_users
+
+if __name__ == '__main__':
+    print(f"Migrated {migrate_legacy_users()} users")
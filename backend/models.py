@@ -0,0 +1,163 @@
+import os
+import threading
+import httpx
+from langchain_core.callbacks import BaseCallbackHandler
+from metrics import metrics
+
+# the router gives up on a call much earlier, this only bounds how long an abandoned call keeps its thread
+PROVIDER_TIMEOUT_SECONDS = float(os.getenv("PROVIDER_TIMEOUT_SECONDS", "60"))
+# models clients may ask for, comma separated, "*" for any model a provider's prefix matches
+ALLOWED_MODELS = os.getenv("ALLOWED_MODELS", "gpt-4o-mini,gpt-3.5-turbo,gemini-1.5-flash,gemini-2.0-flash,llama3.2,llama3.1,llama2,deepseek-r1")
+
+
+def parse_models(spec: str):
+    """ Set of model names, None for any model """
+    if spec.strip() == "*":
+        return None
+    return {m.strip() for m in spec.split(",") if m.strip() != ""}
+
+
+def estimate_tokens(text: str) -> int:
+    """ ~4 characters per token, for providers that do not report usage """
+    return (len(text) + 3) // 4
+
+
+class TokenUsage(BaseCallbackHandler):
+    """
+    Used to count the calls and tokens of one model's client into the metrics, whichever chain or router
+    path the call took. Uses the usage the provider reports and estimates it when there is none
+    """
+    def __init__(self, model: str):
+        self.model = model
+        self.prompts = dict() # run id -> estimated input tokens
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self.prompts[run_id] = sum(estimate_tokens(m.content if isinstance(m.content, str) else str(m.content)) for batch in messages for m in batch)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        estimated_input = self.prompts.pop(run_id, 0)
+        metrics.llm_calls.inc(1, self.model)
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+                if usage:
+                    input_tokens, output_tokens = usage["input_tokens"], usage["output_tokens"]
+                else:
+                    input_tokens, output_tokens = estimated_input, estimate_tokens(generation.text)
+                metrics.llm_tokens.inc(input_tokens, self.model, "input")
+                metrics.llm_tokens.inc(output_tokens, self.model, "output")
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self.prompts.pop(run_id, None)
+
+
+class ModelRegistry:
+    """
+    Process-wide cache of chat model clients and the chains built on top of them.
+    Clients are keyed by (provider, model, params) and built once, so HTTP connection pools
+    and TLS sessions are reused across calls and sessions. Safe to use from any thread.
+    The process-wide registry only serves ALLOWED_MODELS, the model name comes from the client so the cache
+    and the per-model metric labels stay bounded.
+    """
+    def __init__(self, allowed: set[str] = None):
+        self.allowed = allowed # None for any model
+        self.factories = dict() # provider -> factory(model, **params)
+        self.prefixes = dict() # model name prefix -> provider
+        self.clients = dict()
+        self.chains = dict()
+        self.lock = threading.RLock() # factories call back into http_clients()
+        self.shared_http_client = None
+        self.shared_async_http_client = None
+
+    def register_provider(self, provider: str, factory, prefix: str = None):
+        """
+        Used to add a provider. Models whose name starts with prefix are routed to it
+        """
+        with self.lock:
+            self.factories[provider] = factory
+            if prefix is not None:
+                self.prefixes[prefix] = provider
+
+    def provider_for(self, model: str, requester_url: str = ""):
+        """
+        Used to pick the provider serving a model. Returns None if no provider serves it or it is not allowed
+        """
+        if not isinstance(model, str) or (self.allowed is not None and model not in self.allowed):
+            return None
+        for prefix, provider in self.prefixes.items():
+            if model.startswith(prefix):
+                return provider
+        # TECHNICAL DECISION: open-source models are only served through ollama when running locally
+        if requester_url.startswith("http://localhost"):
+            return "ollama"
+        return None
+
+    def http_clients(self):
+        """
+        Keep-alive HTTP clients shared by every OpenAI model
+        """
+        with self.lock:
+            if self.shared_http_client is None:
+                self.shared_http_client = httpx.Client(timeout=PROVIDER_TIMEOUT_SECONDS)
+                self.shared_async_http_client = httpx.AsyncClient(timeout=PROVIDER_TIMEOUT_SECONDS)
+            return self.shared_http_client, self.shared_async_http_client
+
+    def get_chat(self, model: str, requester_url: str = "", **params):
+        """
+        Used to get the shared client for a model. Returns None if no provider serves it
+        """
+        provider = self.provider_for(model, requester_url)
+        if provider is None:
+            return None
+        key = (provider, model, tuple(sorted(params.items())))
+        chat = self.clients.get(key)
+        if chat is not None:
+            return chat
+        with self.lock:
+            if key not in self.clients:
+                chat = self.factories[provider](model, **params)
+                chat.callbacks = [TokenUsage(model)]
+                self.clients[key] = chat
+            return self.clients[key]
+
+    def get_chain(self, name: str, model: str, build, requester_url: str = "", **params):
+        """
+        Used to get a chain built on top of a model's shared client, e.g. chat | parser.
+        build(chat) is only called the first time
+        """
+        provider = self.provider_for(model, requester_url)
+        key = (name, provider, model, tuple(sorted(params.items())))
+        chain = self.chains.get(key)
+        if chain is not None:
+            return chain
+        chat = self.get_chat(model, requester_url, **params)
+        if chat is None:
+            return None
+        with self.lock:
+            if key not in self.chains:
+                self.chains[key] = build(chat)
+            return self.chains[key]
+
+
+# TECHNICAL DECISION: provider packages are imported by their factory on first use, a worker only loads the ones it serves
+def openai_factory(model: str, **params):
+    from langchain_openai.chat_models import ChatOpenAI
+    http_client, async_http_client = model_registry.http_clients()
+    # stream_usage makes streamed answers report their token usage like invoked ones
+    return ChatOpenAI(model=model, http_client=http_client, http_async_client=async_http_client, stream_usage=True, **params)
+
+
+def google_factory(model: str, **params):
+    from langchain_google_genai.chat_models import ChatGoogleGenerativeAI
+    return ChatGoogleGenerativeAI(model=model, **params)
+
+
+def ollama_factory(model: str, **params):
+    from langchain_ollama.chat_models import ChatOllama
+    return ChatOllama(model=model, **params)
+
+
+model_registry = ModelRegistry(allowed=parse_models(ALLOWED_MODELS))
+model_registry.register_provider("openai", openai_factory, prefix="gpt")
+model_registry.register_provider("google", google_factory, prefix="gemini")
+model_registry.register_provider("ollama", ollama_factory)
@@ -0,0 +1,119 @@
+import os
+import threading
+import atexit
+from collections import OrderedDict
+
+PERSIST_INTERVAL_SECONDS = float(os.getenv("PERSIST_INTERVAL_SECONDS", "30"))
+PERSIST_BATCH_LIMIT = min(int(os.getenv("PERSIST_BATCH_LIMIT", "500")), 500) # Firestore allows 500 writes per batch
+
+
+class WriteBehindJournal:
+    """
+    Write-behind persistence of sessions. Every turn marks its session dirty, and a background thread
+    commits the dirty sessions every interval seconds in batched writes of up to batch_limit users.
+    Sessions only ever lose the turns made since the last flush.
+    """
+    def __init__(self, save_batch, interval: float = PERSIST_INTERVAL_SECONDS, batch_limit: int = PERSIST_BATCH_LIMIT):
+        self.save_batch = save_batch # save_batch(list of (fname, lname, user_data)) -> number of users saved
+        self.interval = interval
+        self.batch_limit = batch_limit
+        self.dirty = OrderedDict() # (fname, lname) -> HumanExternalDataStore
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock() # one flush at a time, so a flush_user never overtakes an older write
+        self.wake = threading.Event()
+        self.is_current = None # optional is_current(store) -> bool, used to skip copies another worker replaced
+        self.thread = None
+        self.counters = {"flushes": 0, "users_saved": 0, "batches": 0, "errors": 0}
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="write-behind", daemon=True)
+                self.thread.start()
+                atexit.register(self.drain)
+
+    def mark_dirty(self, store):
+        self.start()
+        with self.lock:
+            self.dirty[(store.fname, store.lname)] = store
+
+    def discard(self, store):
+        """ Forget a pending write, e.g. when the copy turned out to be stale """
+        with self.lock:
+            if self.dirty.get((store.fname, store.lname)) is store:
+                del self.dirty[(store.fname, store.lname)]
+
+    def write(self, stores: list):
+        """ Snapshot and commit stores in batches. Caller holds self.flush_lock """
+        users = []
+        for store in stores:
+            if self.is_current is not None and not self.is_current(store):
+                continue
+            user_data = store.snapshot()
+            if user_data["messages"] == [] and user_data["responses"] == []:
+                continue # No user data to save
+            users.append((store.fname, store.lname, user_data))
+        saved = 0
+        for i in range(0, len(users), self.batch_limit):
+            chunk = users[i:i + self.batch_limit]
+            try:
+                saved += self.save_batch(chunk)
+                self.counters["batches"] += 1
+            except Exception as e:
+                self.counters["errors"] += 1
+                print("Error flushing sessions: ", e)
+                # put them back so the next flush retries, unless a newer turn already did
+                with self.lock:
+                    for fname, lname, _ in chunk:
+                        for store in stores:
+                            if (store.fname, store.lname) == (fname, lname):
+                                self.dirty.setdefault((fname, lname), store)
+        self.counters["users_saved"] += saved
+        return saved
+
+    def flush(self) -> int:
+        """
+        Commit every dirty session. Returns how many users were saved
+        """
+        with self.flush_lock:
+            with self.lock:
+                stores = list(self.dirty.values())
+                self.dirty.clear()
+            self.counters["flushes"] += 1
+            return self.write(stores)
+
+    def flush_user(self, fname: str, lname: str) -> int:
+        """
+        Commit one user's pending write now. Used before reading the user back from Firestore
+        """
+        with self.flush_lock:
+            with self.lock:
+                store = self.dirty.pop((fname, lname), None)
+            if store is None:
+                return 0
+            return self.write([store])
+
+    def drain(self):
+        """
+        Called at shutdown. Commits everything still pending, retrying failed batches a couple of times
+        """
+        for _ in range(3):
+            if len(self.dirty) == 0:
+                return
+            self.flush()
+        if len(self.dirty) > 0:
+            print(f"Giving up on {len(self.dirty)} unsaved sessions")
+
+    def run(self):
+        while True:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print("Error flushing sessions: ", e)
+
+    def stats(self) -> dict:
+        stats = dict(self.counters)
+        stats["dirty"] = len(self.dirty)
+        return stats
@@ -0,0 +1,185 @@
+import os
+import re
+import hashlib
+import threading
+import numpy as np
+from collections import OrderedDict
+from time import time
+from guardrails import normalize_message
+from retrieval import hash_term
+
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "2048"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_THRESHOLD = float(os.getenv("RESPONSE_CACHE_THRESHOLD", "0.9"))
+
+
+NEGATIONS = {"no", "not", "never", "without", "nor", "none", "dont", "don", "doesnt", "didnt", "isnt", "arent",
+             "cant", "cannot", "shouldnt", "wont", "avoid", "except", "t"} # "don't" normalizes to "don t"
+
+
+# words that tie a question to the asker's own data (profile, plan, earlier turns) rather than general knowledge
+PERSONAL_TERMS = {"my", "mine", "myself", "im", "plan", "remember", "earlier", "previous", "previously", "yesterday",
+                  "told", "said", "again", "last"}
+PERSONAL_PHRASES = ("i am ", "i m ", "i ve ", "i weigh ") # "i'm" normalizes to "i m"
+
+
+def personal_message(normalized: str) -> bool:
+    """ Used to tell questions about the asker ("is my squat form ok", "i am 40...") from general ones """
+    words = normalized.split(" ")
+    return any(w in PERSONAL_TERMS for w in words) or any(p in normalized + " " for p in PERSONAL_PHRASES)
+
+
+def context_fingerprint(human_message: str, user: str, model: str, meal_plan: str, summary: str) -> str:
+    """
+    Used to scope a cached answer. A general question is shared by every user of the same model.
+    A question about the asker's own data is only reused for the same user, meal plan and conversation summary
+    """
+    # TECHNICAL DECISION: the summary changes after nearly every turn, so keying every question on it (and on the user)
+    # meant the cache never hit. General questions are answered from general knowledge, the same answer serves everyone
+    if not personal_message(normalize_message(human_message)):
+        return hashlib.sha256(("general\x00" + (model or "")).encode("utf-8")).hexdigest()
+    return hashlib.sha256("\x00".join([user or "", model or "", meal_plan or "", summary or ""]).encode("utf-8")).hexdigest()
+
+
+def match_key(normalized: str) -> str:
+    """
+    The parts of a message a similar message has to repeat exactly: every number with the word after it
+    (its unit) and every negation. "70 kg" never matches "70 lbs", "should I eat" never matches "should I not eat"
+    """
+    words = normalized.split(" ")
+    numbers = [w + " " + (words[i + 1] if i + 1 < len(words) else "") for i, w in enumerate(words) if re.search(r"\d", w)]
+    negations = sorted(w for w in words if w in NEGATIONS)
+    return "|".join(sorted(numbers)) + "\x00" + " ".join(negations)
+
+
+def message_vector(normalized: str):
+    """
+    Unit-length bag of hashed unigrams and bigrams, as (sorted term ids, weights).
+    Unlike retrieval, short words such as "not" are kept, they change what an answer should be
+    """
+    words = normalized.split(" ") if normalized != "" else []
+    terms = [hash_term(w) for w in words] + [hash_term(a + " " + b) for a, b in zip(words, words[1:])]
+    ids, counts = np.unique(np.asarray(terms, dtype=np.int32), return_counts=True)
+    weights = counts.astype(np.float32)
+    return ids, weights / max(float(np.linalg.norm(weights)), 1e-9)
+
+
+class ContextBucket:
+    """
+    Entries sharing a context fingerprint and a match key, with their vectors packed into flat arrays for one-pass cosine similarity
+    """
+    def __init__(self):
+        self.keys = list[tuple[str, str]]()
+        self.packed = None # (term ids, entry numbers, weights), rebuilt after the bucket changes
+
+    def pack(self, entries: OrderedDict):
+        if self.packed is None:
+            vectors = [entries[key]["vector"] for key in self.keys]
+            self.packed = (
+                np.concatenate([v[0] for v in vectors]),
+                np.repeat(np.arange(len(vectors)), [len(v[0]) for v in vectors]),
+                np.concatenate([v[1] for v in vectors]),
+            )
+        return self.packed
+
+
+class ResponseCache:
+    """
+    Thread-safe cache of answers to earlier messages. A message hits when its normalized form matches exactly,
+    or its vector has cosine similarity >= threshold with a cached message under the same context fingerprint
+    that has the same numbers, units and negations (see match_key).
+    Entries expire after ttl seconds, and the least recently used go first once max_size is reached
+    """
+    def __init__(self, max_size: int = RESPONSE_CACHE_SIZE, ttl: float = RESPONSE_CACHE_TTL, threshold: float = RESPONSE_CACHE_THRESHOLD):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.threshold = threshold
+        self.entries = OrderedDict() # (fingerprint, normalized message) -> {"vector", "response", "expires_at", "latency"}
+        self.buckets = dict() # (fingerprint, match key) -> ContextBucket
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "exact_hits": 0, "similar_hits": 0, "misses": 0, "stores": 0, "expirations": 0, "evictions": 0}
+        self.latency_saved = 0.0
+
+    def remove(self, key: tuple[str, str]):
+        """ Caller holds self.lock """
+        del self.entries[key]
+        bucket_key = (key[0], match_key(key[1]))
+        bucket = self.buckets[bucket_key]
+        bucket.keys.remove(key)
+        bucket.packed = None
+        if len(bucket.keys) == 0:
+            del self.buckets[bucket_key]
+
+    def similar(self, fingerprint: str, normalized: str):
+        """ Closest cached key under fingerprint, or None. Caller holds self.lock """
+        bucket = self.buckets.get((fingerprint, match_key(normalized)))
+        if bucket is None:
+            return None
+        query_ids, query_weights = message_vector(normalized)
+        if len(query_ids) == 0:
+            return None
+        ids, owners, weights = bucket.pack(self.entries)
+        slots = np.clip(np.searchsorted(query_ids, ids), 0, len(query_ids) - 1)
+        hits = query_ids[slots] == ids
+        scores = np.bincount(owners[hits], weights=weights[hits] * query_weights[slots[hits]], minlength=len(bucket.keys))
+        best = int(np.argmax(scores))
+        return bucket.keys[best] if scores[best] >= self.threshold else None
+
+    def get(self, human_message: str, fingerprint: str):
+        """
+        Returns the cached answer for a message or None
+        """
+        normalized = normalize_message(human_message)
+        with self.lock:
+            key = (fingerprint, normalized)
+            exact = key in self.entries
+            if not exact:
+                key = self.similar(fingerprint, normalized)
+            entry = self.entries.get(key) if key is not None else None
+            if entry is not None and entry["expires_at"] < time():
+                self.remove(key)
+                self.counters["expirations"] += 1
+                entry = None
+            if entry is None:
+                self.counters["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.counters["hits"] += 1
+            self.counters["exact_hits" if exact else "similar_hits"] += 1
+            self.latency_saved += entry["latency"]
+            return entry["response"]
+
+    def put(self, human_message: str, fingerprint: str, response: str, latency: float):
+        """
+        Cache an answer. latency is what producing it cost, credited to latency_saved on every hit
+        """
+        normalized = normalize_message(human_message)
+        if normalized == "":
+            return
+        key = (fingerprint, normalized)
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = {"vector": message_vector(normalized), "response": response, "expires_at": time() + self.ttl, "latency": latency}
+            bucket = self.buckets.setdefault((fingerprint, match_key(normalized)), ContextBucket())
+            bucket.keys.append(key)
+            bucket.packed = None
+            self.counters["stores"] += 1
+            while len(self.entries) > self.max_size:
+                self.remove(next(iter(self.entries)))
+                self.counters["evictions"] += 1
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self) -> dict:
+        with self.lock:
+            stats = dict(self.counters)
+            stats["size"] = len(self.entries)
+            stats["latency_saved"] = self.latency_saved
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups > 0 else 0.0
+        return stats
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,265 @@
+"""
+Long-term memory. Every finished turn is appended to a per-user history log and indexed with BM25 over
+hashed unigrams and bigrams, so call_chat can bring back relevant turns that fell out of msg_chain
+(Firestore only keeps the last 20). The index is plain NumPy arrays, saved next to the log as a
+compressed .npz holding the hashed terms and the log offset of every turn, never the text itself.
+"""
+import os
+import re
+import json
+import zlib
+import threading
+import numpy as np
+from functools import lru_cache
+
+RETRIEVAL_DIR = os.getenv("RETRIEVAL_DIR", "history")
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "3"))
+HASH_BITS = 20 # 1M buckets, collisions barely move BM25 scores at this size
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+WORD = re.compile(r"[a-z0-9]+")
+# common words carry no signal and would make up most postings
+STOPWORDS = frozenset("""
+    a an and are as at be but by can do does for from had has have he her his how i if in is it its just me my
+    no not of on or our she should so that the their them then there they this to too up us was we were what
+    when which who why will with would you your
+""".split())
+# a query only ever touches a few dozen buckets, so one shared lookup table serves every index
+term_slots = np.full(1 << HASH_BITS, -1, dtype=np.int32)
+term_slots_lock = threading.Lock()
+
+
+@lru_cache(maxsize=131072)
+def hash_term(term: str) -> int:
+    """ Stable across processes, unlike hash() """
+    return zlib.crc32(term.encode("utf-8")) & ((1 << HASH_BITS) - 1)
+
+
+def text_terms(text: str) -> list[int]:
+    """
+    Hashed unigrams and bigrams of a text
+    """
+    words = [w for w in WORD.findall(text.lower()) if len(w) > 1 and w not in STOPWORDS]
+    terms = [hash_term(w) for w in words]
+    terms += [hash_term(a + " " + b) for a, b in zip(words, words[1:])]
+    return terms
+
+
+class RetrievalIndex:
+    """
+    Append-only BM25 index. Documents are numbered in the order they are added.
+    Postings are (term, document, term frequency) triples kept sorted by term, so a query only reads the
+    postings of its own terms. New documents go to a small unsorted tail that is merged in once it grows
+    """
+    def __init__(self):
+        self.post_terms = np.zeros(0, dtype=np.int32)
+        self.post_docs = np.zeros(0, dtype=np.int32)
+        self.post_tf = np.zeros(0, dtype=np.int32)
+        self.tail = list[tuple[np.ndarray, np.ndarray, np.ndarray]]() # (terms, docs, tf) of unmerged documents
+        self.doc_lengths = list[int]()
+        self.lengths = np.zeros(0, dtype=np.float64) # doc_lengths as an array, rebuilt lazily
+
+    def __len__(self):
+        return len(self.doc_lengths)
+
+    def add(self, terms: list[int]) -> int:
+        """
+        Index a document. Returns its number
+        """
+        doc = len(self.doc_lengths)
+        unique, tf = np.unique(np.asarray(terms, dtype=np.int32), return_counts=True)
+        self.tail.append((unique, np.full(len(unique), doc, dtype=np.int32), tf.astype(np.int32)))
+        self.doc_lengths.append(len(terms))
+        if len(self.tail) >= max(64, len(self.doc_lengths) // 8):
+            self.merge()
+        return doc
+
+    def merge(self):
+        """ Fold the tail into the sorted postings """
+        if len(self.tail) == 0:
+            return
+        terms = np.concatenate([self.post_terms] + [t[0] for t in self.tail])
+        docs = np.concatenate([self.post_docs] + [t[1] for t in self.tail])
+        tf = np.concatenate([self.post_tf] + [t[2] for t in self.tail])
+        order = np.argsort(terms, kind="stable") # documents stay in order within a term
+        self.post_terms, self.post_docs, self.post_tf = terms[order], docs[order], tf[order]
+        self.tail = []
+
+    def postings(self, query_terms: np.ndarray):
+        """
+        (documents, term frequencies, query term slot) of every posting of the query terms
+        """
+        left = np.searchsorted(self.post_terms, query_terms, side="left")
+        right = np.searchsorted(self.post_terms, query_terms, side="right")
+        counts = right - left
+        positions = np.repeat(right - np.cumsum(counts), counts) + np.arange(counts.sum()) if counts.sum() > 0 else np.zeros(0, dtype=np.int64)
+        docs, tf = self.post_docs[positions], self.post_tf[positions]
+        slots = np.repeat(np.arange(len(query_terms), dtype=np.int32), counts)
+        if len(self.tail) > 0:
+            tail_terms = np.concatenate([t[0] for t in self.tail])
+            with term_slots_lock:
+                term_slots[query_terms] = np.arange(len(query_terms), dtype=np.int32)
+                tail_slots = term_slots[tail_terms]
+                term_slots[query_terms] = -1
+            hits = tail_slots >= 0
+            docs = np.concatenate([docs, np.concatenate([t[1] for t in self.tail])[hits]])
+            tf = np.concatenate([tf, np.concatenate([t[2] for t in self.tail])[hits]])
+            slots = np.concatenate([slots, tail_slots[hits]])
+        return docs, tf, slots
+
+    def search(self, query: str, k: int, exclude_last: int = 0) -> list[tuple[int, float]]:
+        """
+        Returns up to k (document, score) pairs, best first. The newest exclude_last documents are skipped
+        """
+        n_docs = len(self.doc_lengths) - exclude_last
+        query_terms = np.unique(np.asarray(text_terms(query), dtype=np.int32))
+        if n_docs <= 0 or len(query_terms) == 0:
+            return []
+        docs, tf, slots = self.postings(query_terms)
+        keep = docs < n_docs
+        docs, tf, slots = docs[keep], tf[keep], slots[keep]
+        if len(docs) == 0:
+            return []
+        df = np.bincount(slots, minlength=len(query_terms))
+        idf = np.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+        if len(self.lengths) != len(self.doc_lengths):
+            self.lengths = np.asarray(self.doc_lengths, dtype=np.float64)
+        lengths = self.lengths[:n_docs]
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths[docs] / max(lengths.mean(), 1))
+        scores = np.bincount(docs, weights=idf[slots] * tf * (BM25_K1 + 1) / (tf + norm), minlength=n_docs)
+        k = min(k, n_docs)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(doc), float(scores[doc])) for doc in top if scores[doc] > 0]
+
+    def arrays(self) -> dict:
+        self.merge()
+        return {"terms": self.post_terms, "docs": self.post_docs, "tf": self.post_tf,
+                "doc_lengths": np.asarray(self.doc_lengths, dtype=np.int32)}
+
+    def load_arrays(self, terms: np.ndarray, docs: np.ndarray, tf: np.ndarray, doc_lengths: np.ndarray):
+        self.post_terms, self.post_docs, self.post_tf = terms.astype(np.int32), docs.astype(np.int32), tf.astype(np.int32)
+        self.tail = []
+        self.doc_lengths = doc_lengths.tolist()
+
+
+class UserHistory:
+    """
+    Every turn of one user plus their key facts, searchable.
+    Turns are appended to <RETRIEVAL_DIR>/<doc id>.jsonl with O_APPEND, so workers on the same host can share
+    a user; each worker indexes whatever the log gained since it last looked before searching it
+    """
+    def __init__(self, doc_id: str, directory: str = RETRIEVAL_DIR):
+        self.log_path = os.path.join(directory, doc_id + ".jsonl")
+        self.index_path = os.path.join(directory, doc_id + ".npz")
+        self.directory = directory
+        self.turns = RetrievalIndex()
+        self.turn_offsets = list[tuple[int, int]]() # (byte offset, length) of every turn in the log
+        self.log_offset = 0 # bytes of the log already indexed
+        self.saved_turns = 0
+        self.facts = RetrievalIndex()
+        self.fact_texts = list[str]()
+        self.lock = threading.Lock()
+        self.load()
+
+    def exists(self) -> bool:
+        return os.path.exists(self.log_path)
+
+    def load(self):
+        """
+        Load the saved index, then index the turns logged after it was saved
+        """
+        if os.path.exists(self.index_path):
+            try:
+                with np.load(self.index_path) as saved:
+                    offsets = saved["offsets"]
+                    self.turns.load_arrays(saved["terms"], saved["docs"], saved["tf"], saved["doc_lengths"])
+                    self.turn_offsets = [tuple(o) for o in offsets.tolist()]
+                    self.log_offset = int(saved["log_offset"])
+                    self.saved_turns = len(self.turns)
+            except Exception as e:
+                print("Error loading history index, rebuilding it: ", e)
+                self.turns, self.turn_offsets, self.log_offset = RetrievalIndex(), [], 0
+        self.refresh()
+
+    def refresh(self):
+        """
+        Index the turns other workers (or we) appended to the log since the last look
+        """
+        try:
+            if os.path.getsize(self.log_path) <= self.log_offset:
+                return
+        except FileNotFoundError:
+            return
+        with open(self.log_path, "rb") as log:
+            log.seek(self.log_offset)
+            data = log.read()
+        offset = self.log_offset
+        for line in data.splitlines(keepends=True):
+            if not line.endswith(b"\n"):
+                break # still being written
+            try:
+                turn = json.loads(line)
+                self.turns.add(text_terms(turn["human"] + " " + turn["ai"]))
+                self.turn_offsets.append((offset, len(line)))
+            except ValueError:
+                pass # skip a damaged line rather than the whole history
+            offset += len(line)
+        self.log_offset = offset
+
+    def append(self, turns: list[tuple[str, str]]):
+        """
+        Log finished (human message, ai message) turns
+        """
+        if len(turns) == 0:
+            return
+        data = b"".join(json.dumps({"human": h, "ai": a}).encode("utf-8") + b"\n" for h, a in turns)
+        with self.lock:
+            os.makedirs(self.directory, exist_ok=True)
+            fd = os.open(self.log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+            try:
+                os.write(fd, data) # one write, so lines from different workers never interleave
+            finally:
+                os.close(fd)
+            self.refresh()
+
+    def set_key_facts(self, key_facts: dict):
+        with self.lock:
+            self.facts = RetrievalIndex()
+            self.fact_texts = [f"{k}: {v}" for k, v in key_facts.items()]
+            for text in self.fact_texts:
+                self.facts.add(text_terms(text))
+
+    def turn_text(self, doc: int) -> str:
+        offset, length = self.turn_offsets[doc]
+        with open(self.log_path, "rb") as log:
+            log.seek(offset)
+            turn = json.loads(log.read(length))
+        return f"User: {turn['human']} | You: {turn['ai']}"
+
+    def search(self, query: str, k: int = RETRIEVAL_TOP_K, exclude_last: int = 0) -> list[str]:
+        """
+        Returns the key facts and past turns most relevant to query, best first.
+        exclude_last skips the newest turns, which the prompt already carries
+        """
+        with self.lock:
+            self.refresh()
+            facts = [self.fact_texts[doc] for doc, _ in self.facts.search(query, k)]
+            turns = [self.turn_text(doc) for doc, _ in self.turns.search(query, k, exclude_last)]
+        return facts + turns
+
+    def save(self):
+        """
+        Save the index if it grew since the last save. Written to a temporary file first, so a crash never
+        leaves a half written index behind
+        """
+        with self.lock:
+            if len(self.turns) == self.saved_turns:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = self.index_path + ".tmp.npz"
+            np.savez_compressed(tmp_path, offsets=np.asarray(self.turn_offsets, dtype=np.int64).reshape(-1, 2),
+                                log_offset=np.int64(self.log_offset), **self.turns.arrays())
+            os.replace(tmp_path, self.index_path)
+            self.saved_turns = len(self.turns)
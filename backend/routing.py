@@ -0,0 +1,347 @@
+"""
+Routing layer in front of the chat models. Every call gets a deadline, failed attempts are retried with
+backoff on the next model of its fallback chain, a circuit breaker per (provider, model) stops sending
+calls to a model that keeps failing, and a call still running after the model's p95 latency can be hedged
+by firing the same call at the fallback model and keeping whichever valid answer comes first.
+"""
+import os
+import random
+import threading
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from time import time, sleep
+from langchain_core.exceptions import OutputParserException
+from models import model_registry, ModelRegistry
+
+ROUTE_DEADLINE_SECONDS = float(os.getenv("ROUTE_DEADLINE_SECONDS", "30"))
+ROUTE_FIRST_TOKEN_SECONDS = float(os.getenv("ROUTE_FIRST_TOKEN_SECONDS", "10")) # streams fail over if nothing arrives by then
+ROUTE_RETRIES = int(os.getenv("ROUTE_RETRIES", "2"))
+ROUTE_BACKOFF_SECONDS = float(os.getenv("ROUTE_BACKOFF_SECONDS", "0.25"))
+ROUTE_HEDGE = os.getenv("ROUTE_HEDGE", "1") == "1"
+ROUTE_HEDGE_MIN_SAMPLES = int(os.getenv("ROUTE_HEDGE_MIN_SAMPLES", "20")) # no hedging until the p95 means something
+ROUTE_WORKERS = int(os.getenv("ROUTE_WORKERS", "32"))
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))
+BREAKER_COOLDOWN_SECONDS = float(os.getenv("BREAKER_COOLDOWN_SECONDS", "30"))
+# "model=fallback,model=fallback", e.g. gpt-4o-mini=gemini-2.0-flash
+ROUTE_FALLBACKS = os.getenv("ROUTE_FALLBACKS", "")
+
+
+def parse_fallbacks(spec: str) -> dict[str, str]:
+    fallbacks = dict()
+    for pair in spec.split(","):
+        if "=" in pair:
+            model, fallback = pair.split("=", 1)
+            fallbacks[model.strip()] = fallback.strip()
+    return fallbacks
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class AllModelsFailed(RuntimeError):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Opens after max_failures failures in a row. Once cooldown seconds have passed a single trial call
+    is let through (half open): success closes the breaker, failure opens it for another cooldown.
+    A trial that never reports back frees its slot after another cooldown
+    """
+    def __init__(self, max_failures: int = BREAKER_FAILURES, cooldown: float = BREAKER_COOLDOWN_SECONDS):
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial_started = None
+        self.lock = threading.Lock()
+
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if time() - self.opened_at >= self.cooldown else "open"
+
+    def allow(self) -> bool:
+        with self.lock:
+            state = self.state()
+            if state == "closed":
+                return True
+            if state == "half_open" and (self.trial_started is None or time() - self.trial_started >= self.cooldown):
+                self.trial_started = time()
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_started = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_started = None
+            if self.opened_at is not None or self.failures >= self.max_failures:
+                self.opened_at = time()
+
+
+class ModelRoute:
+    """
+    Health of one (provider, model): its breaker, recent latencies and counters
+    """
+    def __init__(self):
+        self.breaker = CircuitBreaker()
+        self.latencies = deque(maxlen=200)
+        self.counters = {"calls": 0, "failures": 0, "timeouts": 0, "invalid": 0, "hedges": 0, "hedge_wins": 0, "rejected": 0}
+        self.lock = threading.Lock()
+
+    def count(self, name: str):
+        with self.lock:
+            self.counters[name] += 1
+
+    def p95(self):
+        """ p95 latency of recent successful calls, None until there are enough of them """
+        with self.lock:
+            if len(self.latencies) < ROUTE_HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(self.latencies)
+        return ordered[int(len(ordered) * 0.95) - 1]
+
+
+class Router:
+    """
+    Used to call a model through its fallback chain. Safe to use from any thread
+    """
+    def __init__(self, registry: ModelRegistry = model_registry, fallbacks: dict[str, str] = None,
+                 deadline: float = ROUTE_DEADLINE_SECONDS, retries: int = ROUTE_RETRIES,
+                 backoff: float = ROUTE_BACKOFF_SECONDS, hedge: bool = ROUTE_HEDGE):
+        self.registry = registry
+        self.fallbacks = fallbacks if fallbacks is not None else parse_fallbacks(ROUTE_FALLBACKS)
+        self.deadline = deadline
+        self.retries = retries
+        self.backoff = backoff
+        self.hedge = hedge
+        self.routes = dict() # (provider, model) -> ModelRoute
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=ROUTE_WORKERS, thread_name_prefix="route")
+
+    def route(self, model: str, requester_url: str = "") -> ModelRoute:
+        key = (self.registry.provider_for(model, requester_url), model)
+        with self.lock:
+            if key not in self.routes:
+                self.routes[key] = ModelRoute()
+            return self.routes[key]
+
+    def chain(self, model: str) -> list[str]:
+        """ model followed by its fallbacks, without cycles """
+        models = [model]
+        while self.fallbacks.get(models[-1]) is not None and self.fallbacks[models[-1]] not in models:
+            models.append(self.fallbacks[models[-1]])
+        return models
+
+    def available(self, model: str, requester_url: str = "") -> list[str]:
+        """
+        Models of the chain that have a provider and whose breaker lets calls through
+        """
+        models = []
+        for candidate in self.chain(model):
+            if self.registry.provider_for(candidate, requester_url) is None:
+                continue
+            route = self.route(candidate, requester_url)
+            if route.breaker.allow():
+                models.append(candidate)
+            else:
+                route.count("rejected")
+        return models
+
+    def sleep_backoff(self, attempt: int, expires_at: float):
+        delay = self.backoff * (2 ** attempt) * random.uniform(0.5, 1.0) # jitter so retries do not line up
+        sleep(max(min(delay, expires_at - time()), 0))
+
+    def record(self, route: ModelRoute, started: float, error: Exception = None):
+        """ Feed the outcome of one call to its route """
+        if error is None:
+            with route.lock:
+                route.latencies.append(time() - started)
+            route.breaker.record_success()
+        elif isinstance(error, OutputParserException):
+            route.count("invalid") # the provider is fine, the answer was not
+            route.breaker.record_success()
+        else:
+            route.count("timeouts" if isinstance(error, DeadlineExceeded) else "failures")
+            route.breaker.record_failure()
+
+    def submit(self, call, model: str, requester_url: str):
+        route = self.route(model, requester_url)
+        route.count("calls")
+        started = time()
+        outcome = {"recorded": False} # whichever of the call and its abandonment comes first records it
+        def finish(error: Exception = None):
+            with route.lock:
+                if outcome["recorded"]:
+                    return
+                outcome["recorded"] = True
+            self.record(route, started, error)
+        def run():
+            try:
+                result = call(model)
+            except Exception as e:
+                finish(e)
+                raise
+            finish() # a late answer to an abandoned call neither counts nor closes the breaker
+            return result
+        future = self.executor.submit(run)
+        future.model = model
+        future.abandon = lambda: finish(DeadlineExceeded())
+        return future
+
+    def invoke(self, model: str, call, requester_url: str = "", deadline: float = None):
+        """
+        Returns call(model_name) for the first model of the chain that answers in time.
+        call raises to reject an answer (e.g. an OutputParserException), which is retried like an error
+        """
+        expires_at = time() + (deadline if deadline is not None else self.deadline)
+        last_error = None
+        for attempt in range(self.retries + 1):
+            models = self.available(model, requester_url)
+            if len(models) == 0:
+                raise AllModelsFailed(f"No model available for {model}") from last_error
+            primary = models[attempt % len(models)] # each retry fails over to the next model
+            futures = [self.submit(call, primary, requester_url)]
+            hedge_model = next((m for m in models if m != primary), None)
+            hedge_delay = self.route(primary, requester_url).p95() if self.hedge and hedge_model is not None else None
+            while len(futures) > 0:
+                remaining = expires_at - time()
+                if remaining <= 0:
+                    break
+                timeout = remaining
+                hedging_pending = hedge_delay is not None and len(futures) == 1 and futures[0].model == primary
+                if hedging_pending:
+                    timeout = min(remaining, hedge_delay)
+                done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+                if len(done) == 0:
+                    if hedging_pending:
+                        # the primary is slower than 95% of its calls, race it against the fallback
+                        self.route(primary, requester_url).count("hedges")
+                        futures.append(self.submit(call, hedge_model, requester_url))
+                        hedge_delay = None
+                    continue
+                for future in done:
+                    futures.remove(future)
+                    if future.exception() is None:
+                        if future.model != primary:
+                            self.route(primary, requester_url).count("hedge_wins")
+                        return future.result()
+                    last_error = future.exception()
+                    print(f"Call to {future.model} failed: ", last_error)
+            if time() >= expires_at:
+                for future in futures:
+                    # abandoned, the thread finishes on its own but the caller moves on
+                    future.abandon()
+                raise DeadlineExceeded(f"No answer from {model} within the deadline") from last_error
+            if attempt < self.retries:
+                self.sleep_backoff(attempt, expires_at)
+        raise AllModelsFailed(f"Every attempt for {model} failed") from last_error
+
+    def stream(self, model: str, open_stream, requester_url: str = "", deadline: float = None):
+        """
+        Yields the chunks of open_stream(model_name) for the first model of the chain that starts answering in time.
+        Failover only happens before the first chunk, once the client has seen part of an answer it is final
+        """
+        expires_at = time() + (deadline if deadline is not None else self.deadline)
+        last_error = None
+        for attempt in range(self.retries + 1):
+            models = self.available(model, requester_url)
+            if len(models) == 0:
+                raise AllModelsFailed(f"No model available for {model}") from last_error
+            current = models[attempt % len(models)]
+            route = self.route(current, requester_url)
+            route.count("calls")
+            started = time()
+            stream = open_stream(current)
+            first = self.executor.submit(next, stream, None)
+            done, _ = wait([first], timeout=max(min(ROUTE_FIRST_TOKEN_SECONDS, expires_at - time()), 0))
+            if len(done) == 0:
+                # abandoned, the thread finishes on its own but the caller moves on
+                last_error = DeadlineExceeded(f"No first token from {current} in time")
+                self.record(route, started, last_error)
+                if time() >= expires_at:
+                    raise last_error
+                continue
+            if first.exception() is not None:
+                last_error = first.exception()
+                self.record(route, started, last_error)
+                print(f"Stream from {current} failed: ", last_error)
+                if attempt < self.retries:
+                    self.sleep_backoff(attempt, expires_at)
+                continue
+            self.record(route, started)
+            chunk = first.result()
+            try:
+                while chunk is not None:
+                    yield chunk
+                    chunk = next(stream, None)
+            finally:
+                stream.close()
+            return
+        raise AllModelsFailed(f"Every attempt for {model} failed") from last_error
+
+    async def astream(self, model: str, open_stream, requester_url: str = "", deadline: float = None):
+        """
+        Async version of stream, open_stream(model_name) returns an async iterator
+        """
+        loop = asyncio.get_running_loop()
+        expires_at = loop.time() + (deadline if deadline is not None else self.deadline)
+        last_error = None
+        for attempt in range(self.retries + 1):
+            models = self.available(model, requester_url)
+            if len(models) == 0:
+                raise AllModelsFailed(f"No model available for {model}") from last_error
+            current = models[attempt % len(models)]
+            route = self.route(current, requester_url)
+            route.count("calls")
+            started = time()
+            stream = open_stream(current)
+            try:
+                chunk = await asyncio.wait_for(anext(stream, None), timeout=max(min(ROUTE_FIRST_TOKEN_SECONDS, expires_at - loop.time()), 0))
+            except asyncio.TimeoutError:
+                last_error = DeadlineExceeded(f"No first token from {current} in time")
+                self.record(route, started, last_error)
+                await stream.aclose()
+                if loop.time() >= expires_at:
+                    raise last_error
+                continue
+            except Exception as e:
+                last_error = e
+                self.record(route, started, e)
+                print(f"Stream from {current} failed: ", e)
+                if attempt < self.retries:
+                    delay = self.backoff * (2 ** attempt) * random.uniform(0.5, 1.0)
+                    await asyncio.sleep(max(min(delay, expires_at - loop.time()), 0))
+                continue
+            self.record(route, started)
+            try:
+                while chunk is not None:
+                    yield chunk
+                    chunk = await anext(stream, None)
+            finally:
+                await stream.aclose()
+            return
+        raise AllModelsFailed(f"Every attempt for {model} failed") from last_error
+
+    def stats(self) -> dict:
+        with self.lock:
+            routes = dict(self.routes)
+        stats = dict()
+        for (provider, model), route in routes.items():
+            with route.lock:
+                entry = dict(route.counters)
+            entry["breaker"] = route.breaker.state()
+            entry["p95"] = route.p95()
+            stats[f"{provider}:{model}"] = entry
+        return stats
+
+
+router = Router()
@@ -0,0 +1,330 @@
+"""
+Admission control and fair queuing of LLM calls. Every call takes a slot from its provider's budget first:
+at most `concurrency` calls in flight and, optionally, `tokens_per_minute` estimated tokens. Waiting calls are
+served by priority class (guardrail batches, which every turn waits on, then answers, then background
+summaries and key facts) and, within a class, round robin across users, so one chatty user cannot starve the
+others. A user-facing request is turned away with Overloaded (a 429 with Retry-After) when its expected wait
+would exceed the latency SLO, instead of joining a queue it cannot get through in time. A user's own backlog
+counts fully towards that wait and other users' only up to the same depth, so under a burst the bursting user
+is turned away first; regular users are only turned away once their own requests are more than the budget can serve.
+"""
+import os
+import math
+import asyncio
+import threading
+from contextlib import contextmanager, asynccontextmanager
+from collections import OrderedDict, deque
+from time import time
+from metrics import metrics
+
+GUARDRAIL = "guardrail" # guardrail batches, short and shared by the turns of many users
+INTERACTIVE = "interactive" # the user is waiting on it: answers, meal plan changes
+BACKGROUND = "background" # summaries and key facts, only delay the next turns
+PRIORITIES = [GUARDRAIL, INTERACTIVE, BACKGROUND]
+
+SCHEDULER_CONCURRENCY = int(os.getenv("SCHEDULER_CONCURRENCY", "16")) # calls in flight per provider
+SCHEDULER_TOKENS_PER_MINUTE = int(os.getenv("SCHEDULER_TOKENS_PER_MINUTE", "0")) # per provider, 0 for no limit
+SCHEDULER_OUTPUT_TOKENS = int(os.getenv("SCHEDULER_OUTPUT_TOKENS", "256")) # answer tokens assumed per call
+SCHEDULER_SLO_SECONDS = float(os.getenv("SCHEDULER_SLO_SECONDS", "5")) # longest expected queue wait a request accepts
+SCHEDULER_MAX_WAIT_SECONDS = float(os.getenv("SCHEDULER_MAX_WAIT_SECONDS", "20")) # a queued call gives up after that
+# per provider overrides, "provider=concurrency:tokens_per_minute,...", e.g. openai=32:200000,google=8:0
+SCHEDULER_BUDGETS = os.getenv("SCHEDULER_BUDGETS", "")
+RATE_WINDOW_SECONDS = 2.0 # answer throughput is measured over the grants of the last seconds
+
+# shared by every Scheduler, the provider label tells them apart
+wait_seconds = metrics.histogram("pt_scheduler_wait_seconds", "Seconds LLM calls waited for a slot", ("provider", "priority"))
+rejections = metrics.counter("pt_scheduler_rejections_total", "Calls turned away, over the SLO or after waiting too long", ("provider", "reason"))
+
+
+def parse_budgets(spec: str) -> dict[str, tuple[int, int]]:
+    budgets = dict()
+    for pair in spec.split(","):
+        if "=" in pair:
+            provider, budget = pair.split("=", 1)
+            concurrency, _, tokens_per_minute = budget.partition(":")
+            budgets[provider.strip()] = (int(concurrency), int(tokens_per_minute or "0"))
+    return budgets
+
+
+class Overloaded(RuntimeError):
+    """ Raised instead of queueing a call that would miss the SLO. retry_after is in seconds """
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Waiter:
+    """ A call waiting for a slot. Sync callers wait on an event, async callers on a future of their loop """
+    def __init__(self, user: str, priority: str, tokens: int, loop=None):
+        self.user = user
+        self.priority = priority
+        self.tokens = tokens
+        self.enqueued = time()
+        self.granted = False
+        self.loop = loop
+        self.event = threading.Event() if loop is None else None
+        self.future = loop.create_future() if loop is not None else None
+
+    def grant(self):
+        """ Caller holds the scheduler lock """
+        self.granted = True
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(lambda: self.future.done() or self.future.set_result(True))
+
+
+class ProviderQueue:
+    """
+    Budget and waiting calls of one provider. Every method is called with the scheduler lock held
+    """
+    def __init__(self, provider: str, concurrency: int, tokens_per_minute: int):
+        self.provider = provider
+        self.concurrency = concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self.tokens = float(tokens_per_minute)
+        self.refilled = time()
+        self.in_flight = 0
+        self.queues = {priority: OrderedDict() for priority in PRIORITIES} # user -> deque of Waiters
+        self.call_seconds = None # moving average of how long a slot is held
+        self.refill_timer = None
+        self.answer_grants = deque(maxlen=4 * concurrency) # when the latest answer calls got their slot
+        self.counters = {"granted": 0, "rejected": 0, "gave_up": 0, "wait_seconds": 0.0}
+
+    def refill(self):
+        if self.tokens_per_minute <= 0:
+            return
+        now = time()
+        self.tokens = min(self.tokens + (now - self.refilled) * self.tokens_per_minute / 60, self.tokens_per_minute)
+        self.refilled = now
+
+    def waiting(self, priority: str = None) -> int:
+        priorities = PRIORITIES if priority is None else [priority]
+        return sum(len(waiters) for p in priorities for waiters in self.queues[p].values())
+
+    def enqueue(self, waiter: Waiter):
+        self.queues[waiter.priority].setdefault(waiter.user, deque()).append(waiter)
+
+    def remove(self, waiter: Waiter):
+        waiters = self.queues[waiter.priority].get(waiter.user)
+        if waiters is not None and waiter in waiters:
+            waiters.remove(waiter)
+            if len(waiters) == 0:
+                del self.queues[waiter.priority][waiter.user]
+
+    def next_waiter(self):
+        """ Highest priority class first, round robin across the users of a class. Does not pop """
+        for priority in PRIORITIES:
+            users = self.queues[priority]
+            if len(users) > 0:
+                return users[next(iter(users))][0]
+        return None
+
+    def pop(self, waiter: Waiter):
+        users = self.queues[waiter.priority]
+        users[waiter.user].popleft()
+        if len(users[waiter.user]) == 0:
+            del users[waiter.user]
+        else:
+            users.move_to_end(waiter.user) # the user's next call goes behind every other user
+
+    def token_shortfall(self, tokens: int) -> float:
+        """ Seconds until tokens are available, 0 if they are. A call bigger than the whole budget waits for a full bucket """
+        if self.tokens_per_minute <= 0:
+            return 0.0
+        needed = min(tokens, self.tokens_per_minute)
+        return max(needed - self.tokens, 0) / (self.tokens_per_minute / 60)
+
+    def answer_rate(self) -> float:
+        """
+        Answer calls served per second. The budget's rate while nothing waits; once answers queue, the rate
+        they actually got their slots at lately, which already accounts for the guardrail batches served first
+        """
+        capacity = self.concurrency / max(self.call_seconds, 1e-9) # a call can finish within the clock resolution
+        now = time()
+        recent = [t for t in self.answer_grants if now - t <= RATE_WINDOW_SECONDS]
+        if self.waiting(INTERACTIVE) == 0 or len(recent) < 2:
+            return capacity
+        return min(capacity, len(recent) / max(now - recent[0], 1e-3))
+
+    def expected_wait(self, user: str, tokens: int) -> float:
+        """
+        Rough queue wait of a new user-facing call of user: the calls served before it over the rate answers are served at.
+        Every queued guardrail batch goes first. Round robin then serves a user's (k+1)th queued call after
+        at most k+1 calls of every other user, so a user with a backlog sees a longer wait than everyone else
+        """
+        queued_tokens = sum(w.tokens for p in (GUARDRAIL, INTERACTIVE) for waiters in self.queues[p].values() for w in waiters)
+        shortfall = self.token_shortfall(queued_tokens + tokens)
+        if not self.call_seconds: # nothing finished yet, or only faster than the clock can tell
+            return shortfall
+        users = self.queues[INTERACTIVE]
+        rounds = len(users.get(user, ())) + 1
+        ahead = self.waiting(GUARDRAIL) + sum(min(len(waiters), rounds) for waiters in users.values())
+        ahead += max(self.in_flight - self.concurrency + 1, 0)
+        return ahead / self.answer_rate() + shortfall
+
+
+class Scheduler:
+    """
+    Used to take and give back slots of the providers' budgets. Safe to use from any thread and event loop
+    """
+    def __init__(self, concurrency: int = SCHEDULER_CONCURRENCY, tokens_per_minute: int = SCHEDULER_TOKENS_PER_MINUTE,
+                 budgets: dict[str, tuple[int, int]] = None, slo: float = SCHEDULER_SLO_SECONDS,
+                 max_wait: float = SCHEDULER_MAX_WAIT_SECONDS):
+        self.concurrency = concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self.budgets = budgets if budgets is not None else parse_budgets(SCHEDULER_BUDGETS)
+        self.slo = slo
+        self.max_wait = max_wait
+        self.providers = dict() # provider -> ProviderQueue
+        self.lock = threading.Lock()
+
+    def queue(self, provider: str) -> ProviderQueue:
+        """ Caller holds self.lock """
+        if provider not in self.providers:
+            concurrency, tokens_per_minute = self.budgets.get(provider, (self.concurrency, self.tokens_per_minute))
+            self.providers[provider] = ProviderQueue(provider, concurrency, tokens_per_minute)
+        return self.providers[provider]
+
+    def admit(self, provider: str, user: str, tokens: int = SCHEDULER_OUTPUT_TOKENS):
+        """
+        Used at the start of a user-facing request. Raises Overloaded if its calls would wait longer than the SLO
+        """
+        if provider is None:
+            return
+        with self.lock:
+            queue = self.queue(provider)
+            queue.refill()
+            wait = queue.expected_wait(user, tokens)
+            if wait <= self.slo:
+                return
+            queue.counters["rejected"] += 1
+        rejections.inc(1, provider, "slo")
+        raise Overloaded(f"{provider} is overloaded, expected wait {wait:.1f}s", retry_after=max(math.ceil(wait), 1))
+
+    def dispatch(self, queue: ProviderQueue):
+        """ Grants slots while the budget allows. Caller holds self.lock """
+        queue.refill()
+        while queue.in_flight < queue.concurrency:
+            waiter = queue.next_waiter()
+            if waiter is None:
+                return
+            shortfall = queue.token_shortfall(waiter.tokens)
+            if shortfall > 0:
+                # nothing jumps the head of the line, dispatch again once the tokens are there
+                if queue.refill_timer is None:
+                    queue.refill_timer = threading.Timer(shortfall, self.redispatch, args=(queue,))
+                    queue.refill_timer.daemon = True
+                    queue.refill_timer.start()
+                return
+            queue.pop(waiter)
+            if waiter.priority == INTERACTIVE:
+                queue.answer_grants.append(time())
+            queue.in_flight += 1
+            queue.tokens -= min(waiter.tokens, queue.tokens_per_minute) if queue.tokens_per_minute > 0 else 0
+            queue.counters["granted"] += 1
+            queue.counters["wait_seconds"] += time() - waiter.enqueued
+            waiter.grant()
+
+    def redispatch(self, queue: ProviderQueue):
+        with self.lock:
+            queue.refill_timer = None
+            self.dispatch(queue)
+
+    def enqueue(self, provider: str, user: str, priority: str, tokens: int, loop=None):
+        waiter = Waiter(user, priority, tokens, loop)
+        with self.lock:
+            queue = self.queue(provider)
+            queue.enqueue(waiter)
+            self.dispatch(queue)
+        return queue, waiter
+
+    def granted(self, queue: ProviderQueue, waiter: Waiter) -> dict:
+        wait_seconds.observe(time() - waiter.enqueued, queue.provider, waiter.priority)
+        return {"queue": queue, "started": time()}
+
+    def give_up(self, queue: ProviderQueue, waiter: Waiter) -> bool:
+        """ Takes a waiter out of the queue. Returns False if it was granted in the meantime """
+        with self.lock:
+            if waiter.granted:
+                return False
+            queue.remove(waiter)
+            queue.counters["gave_up"] += 1
+            self.dispatch(queue) # a head of line waiting for tokens may have been the one leaving
+        rejections.inc(1, queue.provider, "timeout")
+        return True
+
+    def acquire(self, provider: str, user: str, priority: str = INTERACTIVE, tokens: int = SCHEDULER_OUTPUT_TOKENS):
+        """
+        Blocks until the call may run. Returns a grant to pass to release, None if provider is None (nothing to schedule)
+        """
+        if provider is None:
+            return None
+        queue, waiter = self.enqueue(provider, user, priority, tokens)
+        if not waiter.event.wait(timeout=self.max_wait) and self.give_up(queue, waiter):
+            raise Overloaded(f"No {provider} slot within {self.max_wait:.0f}s", retry_after=max(math.ceil(queue.call_seconds or 1), 1))
+        return self.granted(queue, waiter)
+
+    async def aacquire(self, provider: str, user: str, priority: str = INTERACTIVE, tokens: int = SCHEDULER_OUTPUT_TOKENS):
+        """ Async version of acquire """
+        if provider is None:
+            return None
+        queue, waiter = self.enqueue(provider, user, priority, tokens, asyncio.get_running_loop())
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), timeout=self.max_wait)
+        except asyncio.TimeoutError:
+            if self.give_up(queue, waiter):
+                raise Overloaded(f"No {provider} slot within {self.max_wait:.0f}s", retry_after=max(math.ceil(queue.call_seconds or 1), 1))
+        except asyncio.CancelledError:
+            if not self.give_up(queue, waiter):
+                self.release({"queue": queue, "started": time()})
+            raise
+        return self.granted(queue, waiter)
+
+    def release(self, grant: dict):
+        if grant is None:
+            return
+        queue = grant["queue"]
+        held = time() - grant["started"]
+        with self.lock:
+            queue.in_flight -= 1
+            queue.call_seconds = held if queue.call_seconds is None else 0.9 * queue.call_seconds + 0.1 * held
+            self.dispatch(queue)
+
+    @contextmanager
+    def slot(self, provider: str, user: str, priority: str = INTERACTIVE, tokens: int = SCHEDULER_OUTPUT_TOKENS):
+        """ Holds a slot for the duration of the with block """
+        grant = self.acquire(provider, user, priority, tokens)
+        try:
+            yield
+        finally:
+            self.release(grant)
+
+    @asynccontextmanager
+    async def aslot(self, provider: str, user: str, priority: str = INTERACTIVE, tokens: int = SCHEDULER_OUTPUT_TOKENS):
+        """ Async version of slot """
+        grant = await self.aacquire(provider, user, priority, tokens)
+        try:
+            yield
+        finally:
+            self.release(grant)
+
+    def stats(self) -> dict:
+        with self.lock:
+            stats = dict()
+            for provider, queue in self.providers.items():
+                queue.refill()
+                entry = dict(queue.counters)
+                entry["mean_wait"] = entry.pop("wait_seconds") / entry["granted"] if entry["granted"] > 0 else 0.0
+                entry["in_flight"] = queue.in_flight
+                entry["concurrency"] = queue.concurrency
+                entry["queued_guardrail"] = queue.waiting(GUARDRAIL)
+                entry["queued_interactive"] = queue.waiting(INTERACTIVE)
+                entry["queued_background"] = queue.waiting(BACKGROUND)
+                entry["tokens_available"] = queue.tokens if queue.tokens_per_minute > 0 else None
+                entry["call_seconds"] = queue.call_seconds
+                stats[provider] = entry
+        return stats
+
+
+scheduler = Scheduler()
@@ -0,0 +1,377 @@
+import os
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from time import time, sleep
+from database import HumanExternalDataStore, journal, user_doc_id
+from state_store import state_store_from_env
+from summarizer import summary_worker
+
+SESSION_MAX_COUNT = int(os.getenv("SESSION_MAX_COUNT", "1000"))
+SESSION_MAX_BYTES = int(os.getenv("SESSION_MAX_BYTES", str(256 * 1024 * 1024)))
+SESSION_IDLE_TTL = float(os.getenv("SESSION_IDLE_TTL", "1800"))
+SESSION_SWEEP_SECONDS = float(os.getenv("SESSION_SWEEP_SECONDS", "60"))
+SESSION_LOCK_SECONDS = float(os.getenv("SESSION_LOCK_SECONDS", "120")) # a turn held longer than this lets other workers in
+SESSION_LOCK_WAIT_SECONDS = float(os.getenv("SESSION_LOCK_WAIT_SECONDS", "30"))
+
+
+class TurnLock:
+    """
+    Serializes the turns of one user. A plain class so it can live in a WeakValueDictionary
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        self.lock.acquire()
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        self.lock.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.lock.release()
+
+
+def session_bytes(db: HumanExternalDataStore) -> int:
+    """
+    Rough size of a session, dominated by the text it holds
+    """
+    size = sum(len(m.content) for m in db.msg_chain if isinstance(m.content, str))
+    size += len(db.structured_data.get("summary", "")) + len(db.meal_plan.rendered)
+    return size
+
+
+class SessionPool:
+    """
+    Bounded pool of HumanExternalDataStore sessions keyed by api_id (user_doc_id of the names).
+    Sessions are evicted least recently used first once the count or memory budget is exceeded,
+    or once they have been idle for idle_ttl seconds. Eviction saves the session to Firestore in the background
+    exactly like /close does, and the next request for that user rehydrates it from Firestore.
+
+    With a state store (SESSION_STORE) every finished request writes the session's state to the store,
+    and a worker whose copy is missing or older than the store's reloads it, so any worker can serve any user.
+    A request holds the session's lock in the store from acquire() to release(), so the turns of one user
+    run one after the other even across workers, and background summaries are written back to the store.
+    """
+    def __init__(self, max_count: int = SESSION_MAX_COUNT, max_bytes: int = SESSION_MAX_BYTES, idle_ttl: float = SESSION_IDLE_TTL, store=None):
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self.store = store # shared state store, None when sessions only live in this process
+        self.sessions = OrderedDict() # api_id -> {"fname", "lname", "db", "last_used", "busy", "version", "bytes"}
+        self.total_bytes = 0 # sum of the entries' "bytes", kept up to date as entries come, go and are released
+        self.evicting = dict() # api_id -> future of the background close
+        self.lock = threading.RLock()
+        self.executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="session-evict")
+        self.counters = {"evictions": 0, "idle_evictions": 0, "rehydrations": 0, "eviction_errors": 0, "store_loads": 0, "stale_drops": 0,
+                         "reattaches": 0, "summary_commits": 0}
+        self.janitor = None
+        self.turn_locks = weakref.WeakValueDictionary() # api_id -> TurnLock, dropped once nobody holds it
+        self.store_locks = dict() # api_id -> token of the store lock this worker holds
+        if store is not None:
+            journal.is_current = self.is_current_copy
+            summary_worker.on_summary = self.summarized
+
+    def is_current_copy(self, db: HumanExternalDataStore) -> bool:
+        """
+        Used by the write-behind journal so a worker never saves a copy another worker has replaced
+        """
+        api_id = user_doc_id(db.fname, db.lname)
+        with self.lock:
+            entry = self.sessions.get(api_id)
+        if entry is None:
+            return True # closed or evicted, this is the final write
+        return entry["db"] is db and self.store.version(api_id) == entry["version"]
+
+    def turn_lock(self, api_id: str) -> TurnLock:
+        """
+        Used so two requests for the same user never change its msg_chain at the same time
+        """
+        with self.lock:
+            lock = self.turn_locks.get(api_id)
+            if lock is None:
+                lock = TurnLock()
+                self.turn_locks[api_id] = lock
+            return lock
+
+    def lock_store(self, api_id: str):
+        """
+        Used so no other worker serves the user until unlock_store(). Waits for a worker that is still serving it
+        """
+        if self.store is None:
+            return
+        deadline = time() + SESSION_LOCK_WAIT_SECONDS
+        while True:
+            token = self.store.try_lock(api_id, SESSION_LOCK_SECONDS)
+            if token is not None:
+                with self.lock:
+                    self.store_locks[api_id] = token
+                return
+            if time() >= deadline:
+                raise TimeoutError(f"Another worker is still serving {api_id}")
+            sleep(0.05)
+
+    def unlock_store(self, api_id: str):
+        with self.lock:
+            token = self.store_locks.pop(api_id, None)
+        if token is not None:
+            self.store.unlock(api_id, token)
+
+    def summarized(self, db: HumanExternalDataStore):
+        """
+        Called by the summary worker. Writes the new summary to the shared store, unless a turn is in flight
+        (its release() writes it) or another worker took the user over (our copy is stale)
+        """
+        api_id = user_doc_id(db.fname, db.lname)
+        with self.lock:
+            entry = self.sessions.get(api_id)
+            if entry is None or entry["db"] is not db or entry["busy"] > 0:
+                return
+        token = self.store.try_lock(api_id, SESSION_LOCK_SECONDS)
+        if token is None:
+            return
+        try:
+            if self.store.version(api_id) == entry["version"]:
+                entry["version"] = self.store.put(api_id, db.to_state())
+                self.counters["summary_commits"] += 1
+        finally:
+            self.store.unlock(api_id, token)
+
+    def start(self):
+        with self.lock:
+            if self.janitor is None:
+                self.janitor = threading.Thread(target=self.sweep_forever, name="session-janitor", daemon=True)
+                self.janitor.start()
+
+    def wait_for_eviction(self, api_id: str):
+        """
+        Used before loading a user from Firestore so we never read data that is still being saved
+        """
+        future = self.evicting.get(api_id)
+        if future is not None:
+            try:
+                future.result()
+            except Exception:
+                pass # already reported by the eviction itself
+
+    def new_entry(self, fname: str, lname: str, db: HumanExternalDataStore, version: int = 0) -> dict:
+        return {"fname": fname, "lname": lname, "db": db, "last_used": time(), "busy": 0, "version": version, "bytes": session_bytes(db)}
+
+    def add_entry(self, api_id: str, entry: dict):
+        """ Caller holds self.lock """
+        old = self.sessions.get(api_id)
+        if old is not None:
+            self.total_bytes -= old["bytes"]
+        self.sessions[api_id] = entry
+        self.total_bytes += entry["bytes"]
+
+    def pop_entry(self, api_id: str):
+        """ Caller holds self.lock. Returns the entry or None """
+        entry = self.sessions.pop(api_id, None)
+        if entry is not None:
+            self.total_bytes -= entry["bytes"]
+        return entry
+
+    def commit(self, api_id: str):
+        """
+        Write a session's state to the shared store
+        """
+        if self.store is None:
+            return
+        with self.lock:
+            entry = self.sessions.get(api_id)
+        if entry is not None:
+            entry["version"] = self.store.put(api_id, entry["db"].to_state())
+
+    def from_store(self, api_id: str, fname: str, lname: str, url: str):
+        """
+        Used to load a session another worker wrote to the shared store. Returns an entry or None
+        """
+        if self.store is None:
+            return None
+        stored = self.store.get(api_id)
+        if stored is None:
+            return None
+        self.counters["store_loads"] += 1
+        version, state = stored
+        return self.new_entry(fname, lname, HumanExternalDataStore(fname, lname, url, state=state), version)
+
+    def open(self, api_id: str, fname: str, lname: str, url: str) -> HumanExternalDataStore:
+        """
+        Used by /init. Reattaches to the user's live session if there is one (no LLM or Firestore work),
+        otherwise loads it from the shared store or Firestore like acquire() does
+        """
+        if api_id in self.sessions:
+            self.counters["reattaches"] += 1
+        db = self.acquire(api_id, fname, lname, url)
+        self.release(api_id)
+        return db
+
+    def put(self, api_id: str, fname: str, lname: str, db: HumanExternalDataStore, version: int = 0):
+        with self.lock:
+            self.add_entry(api_id, self.new_entry(fname, lname, db, version))
+            self.sessions.move_to_end(api_id)
+        self.enforce_budget()
+
+    def acquire(self, api_id: str, fname: str, lname: str, url: str) -> HumanExternalDataStore:
+        """
+        Used by /chat. Returns the user's session, loading it from the shared store or rehydrating it
+        from Firestore if this worker does not have an up to date copy.
+        The session can not be evicted, nor served by another worker, until release() is called
+        """
+        self.lock_store(api_id)
+        try:
+            return self.load(api_id, fname, lname, url)
+        except Exception:
+            self.unlock_store(api_id)
+            raise
+
+    def load(self, api_id: str, fname: str, lname: str, url: str) -> HumanExternalDataStore:
+        """ acquire() once the store lock is held """
+        with self.lock:
+            entry = self.sessions.get(api_id)
+        if entry is not None and self.store is not None:
+            store_version = self.store.version(api_id)
+            if store_version != entry["version"]:
+                # another worker served this user since (newer version) or already evicted and saved it (missing)
+                self.counters["stale_drops"] += 1
+                with self.lock:
+                    if self.sessions.get(api_id) is entry:
+                        self.pop_entry(api_id)
+                journal.discard(entry["db"])
+                entry = None
+        if entry is None:
+            self.start()
+            entry = self.from_store(api_id, fname, lname, url)
+        if entry is None:
+            self.wait_for_eviction(api_id)
+            entry = self.new_entry(fname, lname, HumanExternalDataStore(fname, lname, url))
+            if entry["db"].rehydrated: # a first-time user had nothing to rehydrate
+                self.counters["rehydrations"] += 1
+
+        with self.lock:
+            current = self.sessions.get(api_id)
+            if current is None: # another request may have loaded the user meanwhile
+                self.add_entry(api_id, entry)
+            else:
+                entry = current
+            entry["busy"] += 1
+            entry["last_used"] = time()
+            self.sessions.move_to_end(api_id)
+        self.enforce_budget()
+        return entry["db"]
+
+    def release(self, api_id: str):
+        """
+        Called once a request is done with the session. Hands the new state to the other workers
+        and re-measures the session, the turn is what grows it
+        """
+        try:
+            self.commit(api_id)
+            with self.lock:
+                entry = self.sessions.get(api_id)
+            size = session_bytes(entry["db"]) if entry is not None else 0 # outside the lock, the session is still ours
+            with self.lock:
+                if entry is not None and self.sessions.get(api_id) is entry:
+                    self.total_bytes += size - entry["bytes"]
+                    entry["bytes"] = size
+                    entry["busy"] = max(entry["busy"] - 1, 0)
+                    entry["last_used"] = time()
+        finally:
+            self.unlock_store(api_id) # a summary landing from now on is written by summarized()
+
+    def remove(self, api_id: str, fname: str = "", lname: str = "", url: str = ""):
+        """
+        Used by /close. Returns the session so the caller can save it, or None if no worker has it
+        """
+        with self.lock:
+            entry = self.pop_entry(api_id)
+        if self.store is not None:
+            self.lock_store(api_id)
+            try:
+                if entry is None or self.store.version(api_id) != entry["version"]:
+                    entry = self.from_store(api_id, fname, lname, url)
+                self.store.delete(api_id)
+            finally:
+                self.unlock_store(api_id)
+        if entry is None:
+            self.wait_for_eviction(api_id)
+            return None
+        return entry["db"]
+
+    def evict(self, api_id: str, idle: bool = False):
+        """ Remove a session and save it in the background. Caller holds self.lock """
+        entry = self.pop_entry(api_id)
+        if self.store is not None and self.store.version(api_id) != entry["version"]:
+            # another worker owns a newer copy, ours is just a stale cache
+            self.counters["stale_drops"] += 1
+            journal.discard(entry["db"])
+            return
+        self.counters["idle_evictions" if idle else "evictions"] += 1
+        print(f"Evicting session {api_id} ({'idle' if idle else 'over budget'})")
+
+        def save():
+            try:
+                entry["db"].close(wait=False) # committed with the next write-behind batch
+                if self.store is not None:
+                    self.store.delete(api_id, entry["version"])
+            except Exception as e:
+                self.counters["eviction_errors"] += 1
+                print("Error saving evicted session: ", e)
+                raise
+            finally:
+                with self.lock:
+                    if self.evicting.get(api_id) is future:
+                        del self.evicting[api_id]
+        with self.lock:
+            future = self.executor.submit(save)
+            self.evicting[api_id] = future
+
+    def enforce_budget(self):
+        """
+        Evict least recently used sessions until the pool is within its count and memory budget.
+        Sizes are the ones measured on each session's last release, so this never walks the messages
+        """
+        with self.lock:
+            if len(self.sessions) <= self.max_count and self.total_bytes <= self.max_bytes:
+                return
+            for api_id in list(self.sessions.keys()):
+                if len(self.sessions) <= self.max_count and self.total_bytes <= self.max_bytes:
+                    break
+                if self.sessions[api_id]["busy"] > 0:
+                    continue
+                self.evict(api_id)
+
+    def evict_idle(self):
+        with self.lock:
+            now = time()
+            for api_id, entry in list(self.sessions.items()):
+                if entry["busy"] == 0 and now - entry["last_used"] >= self.idle_ttl:
+                    self.evict(api_id, idle=True)
+
+    def sweep_forever(self):
+        while True:
+            sleep(SESSION_SWEEP_SECONDS)
+            try:
+                self.evict_idle()
+                self.enforce_budget()
+            except Exception as e:
+                print("Error sweeping sessions: ", e)
+
+    def __contains__(self, api_id: str):
+        return api_id in self.sessions
+
+    def stats(self) -> dict:
+        with self.lock:
+            stats = dict(self.counters)
+            stats["size"] = len(self.sessions)
+            stats["bytes"] = self.total_bytes
+            stats["pending_saves"] = len(self.evicting)
+        if self.store is not None:
+            stats["store_size"] = len(self.store)
+        return stats
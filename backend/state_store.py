@@ -0,0 +1,222 @@
+"""
+Session state stores. They hold the serialized HumanExternalDataStore state (msg_chain, summary,
+meal plan, ...) of every live session so that any worker process can pick up any user.
+Every put() bumps the session's version, which lets workers tell whether their in-memory copy is stale.
+A worker holds a session's lock (try_lock/unlock) while it serves a turn, so two workers never run turns
+of the same user at the same time. Locks expire after ttl seconds in case their worker dies.
+"""
+import os
+import json
+import uuid
+import sqlite3
+import threading
+from time import time
+
+
+class InMemoryStateStore:
+    """
+    Single process store. Only useful to run the shared-store code path without a shared backend
+    """
+    def __init__(self):
+        self.states = dict() # api_id -> (version, state)
+        self.locks = dict() # api_id -> (token, expires_at)
+        self.lock = threading.Lock()
+
+    def version(self, api_id: str) -> int:
+        """ Current version of a session, 0 if the store does not have it """
+        entry = self.states.get(api_id)
+        return entry[0] if entry is not None else 0
+
+    def get(self, api_id: str):
+        """ Returns (version, state) or None """
+        return self.states.get(api_id)
+
+    def put(self, api_id: str, state: dict) -> int:
+        with self.lock:
+            version = self.version(api_id) + 1
+            self.states[api_id] = (version, json.loads(json.dumps(state)))
+            return version
+
+    def delete(self, api_id: str, version: int = None) -> bool:
+        """ Deletes a session. If version is given, only deletes it if nobody wrote a newer one """
+        with self.lock:
+            if version is not None and self.version(api_id) != version:
+                return False
+            return self.states.pop(api_id, None) is not None
+
+    def try_lock(self, api_id: str, ttl: float):
+        """ Returns a token to unlock with, None if someone else holds the lock """
+        with self.lock:
+            held = self.locks.get(api_id)
+            if held is not None and held[1] > time():
+                return None
+            token = uuid.uuid4().hex
+            self.locks[api_id] = (token, time() + ttl)
+            return token
+
+    def unlock(self, api_id: str, token: str):
+        with self.lock:
+            if self.locks.get(api_id, (None,))[0] == token:
+                del self.locks[api_id]
+
+    def __len__(self):
+        return len(self.states)
+
+
+class SQLiteStateStore:
+    """
+    Store backed by a SQLite file. Every worker on the same machine (or volume) opens the same file
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    api_id TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL,
+                    state TEXT NOT NULL,
+                    updated REAL NOT NULL
+                )
+            """)
+            self.conn.execute("CREATE TABLE IF NOT EXISTS locks (api_id TEXT PRIMARY KEY, token TEXT NOT NULL, expires REAL NOT NULL)")
+
+    def version(self, api_id: str) -> int:
+        with self.lock:
+            row = self.conn.execute("SELECT version FROM sessions WHERE api_id = ?", (api_id,)).fetchone()
+        return row[0] if row is not None else 0
+
+    def get(self, api_id: str):
+        with self.lock:
+            row = self.conn.execute("SELECT version, state FROM sessions WHERE api_id = ?", (api_id,)).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def put(self, api_id: str, state: dict) -> int:
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.execute("""
+                    INSERT INTO sessions (api_id, version, state, updated) VALUES (?, 1, ?, ?)
+                    ON CONFLICT(api_id) DO UPDATE SET version = version + 1, state = excluded.state, updated = excluded.updated
+                """, (api_id, json.dumps(state), time()))
+                version = self.conn.execute("SELECT version FROM sessions WHERE api_id = ?", (api_id,)).fetchone()[0]
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        return version
+
+    def delete(self, api_id: str, version: int = None) -> bool:
+        with self.lock:
+            if version is None:
+                cursor = self.conn.execute("DELETE FROM sessions WHERE api_id = ?", (api_id,))
+            else:
+                cursor = self.conn.execute("DELETE FROM sessions WHERE api_id = ? AND version = ?", (api_id, version))
+        return cursor.rowcount > 0
+
+    def try_lock(self, api_id: str, ttl: float):
+        token = uuid.uuid4().hex
+        now = time()
+        with self.lock:
+            # takes the lock if nobody has it or its holder let it expire
+            cursor = self.conn.execute("""
+                INSERT INTO locks (api_id, token, expires) VALUES (?, ?, ?)
+                ON CONFLICT(api_id) DO UPDATE SET token = excluded.token, expires = excluded.expires WHERE locks.expires < ?
+            """, (api_id, token, now + ttl, now))
+        return token if cursor.rowcount > 0 else None
+
+    def unlock(self, api_id: str, token: str):
+        with self.lock:
+            self.conn.execute("DELETE FROM locks WHERE api_id = ? AND token = ?", (api_id, token))
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+
+class RedisStateStore:
+    """
+    Store backed by any server speaking the Redis protocol. Needs the redis package
+    """
+    def __init__(self, url: str, prefix: str = "pt:session:", lock_prefix: str = "pt:lock:"):
+        import redis # optional dependency, only needed for this store
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.lock_prefix = lock_prefix
+        self.watch_error = redis.WatchError
+
+    def version(self, api_id: str) -> int:
+        version = self.client.hget(self.prefix + api_id, "version")
+        return int(version) if version is not None else 0
+
+    def get(self, api_id: str):
+        entry = self.client.hgetall(self.prefix + api_id)
+        if not entry:
+            return None
+        return int(entry[b"version"]), json.loads(entry[b"state"])
+
+    def put(self, api_id: str, state: dict) -> int:
+        pipe = self.client.pipeline(transaction=True)
+        pipe.hincrby(self.prefix + api_id, "version", 1)
+        pipe.hset(self.prefix + api_id, "state", json.dumps(state))
+        return int(pipe.execute()[0])
+
+    def delete(self, api_id: str, version: int = None) -> bool:
+        key = self.prefix + api_id
+        if version is None:
+            return self.client.delete(key) > 0
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                current = pipe.hget(key, "version")
+                if current is None or int(current) != version:
+                    return False
+                pipe.multi()
+                pipe.delete(key)
+                pipe.execute()
+                return True
+            except self.watch_error:
+                return False # someone wrote a newer version meanwhile
+
+    def try_lock(self, api_id: str, ttl: float):
+        token = uuid.uuid4().hex
+        acquired = self.client.set(self.lock_prefix + api_id, token, nx=True, px=max(int(ttl * 1000), 1))
+        return token if acquired else None
+
+    def unlock(self, api_id: str, token: str):
+        key = self.lock_prefix + api_id
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                current = pipe.get(key)
+                if current is None or current.decode() != token:
+                    return # expired and taken by someone else
+                pipe.multi()
+                pipe.delete(key)
+                pipe.execute()
+            except self.watch_error:
+                pass
+
+    def __len__(self):
+        return sum(1 for _ in self.client.scan_iter(self.prefix + "*"))
+
+
+def state_store_from_env():
+    """
+    Used to build the store named by SESSION_STORE: "memory", "sqlite:///path/to/file.db" or "redis://host:port/0".
+    Returns None when unset, in which case sessions only live in this process
+    """
+    url = os.getenv("SESSION_STORE", "")
+    if url == "":
+        return None
+    if url == "memory":
+        return InMemoryStateStore()
+    if url.startswith("sqlite:///"):
+        return SQLiteStateStore(url[len("sqlite:///"):])
+    if url.startswith("redis://") or url.startswith("rediss://"):
+        return RedisStateStore(url)
+    raise ValueError(f"Unknown SESSION_STORE: {url}")
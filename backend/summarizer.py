@@ -0,0 +1,99 @@
+import threading
+import os
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+# TECHNICAL DECISION: update_summary only looks at the last 8 messages (4 turns), so never let more than 4 turns pile up
+SUMMARY_EVERY_N_TURNS = min(int(os.getenv("SUMMARY_EVERY_N_TURNS", "3")), 4)
+SUMMARY_IDLE_SECONDS = float(os.getenv("SUMMARY_IDLE_SECONDS", "5"))
+SUMMARY_WORKERS = int(os.getenv("SUMMARY_WORKERS", "4")) # sessions summarized at the same time
+
+
+class SummaryWorker:
+    """
+    Background thread that keeps conversation summaries up to date off the request path.
+    Turns are queued per session and coalesced: a session is summarized once it has
+    every_n_turns pending turns or has been idle for idle_seconds, whichever comes first.
+    Up to workers sessions are summarized at the same time, never the same session twice:
+    turns that arrive while a session is being summarized wait for the next run
+    """
+    def __init__(self, every_n_turns: int = SUMMARY_EVERY_N_TURNS, idle_seconds: float = SUMMARY_IDLE_SECONDS,
+                 workers: int = SUMMARY_WORKERS):
+        self.every_n_turns = every_n_turns
+        self.idle_seconds = idle_seconds
+        self.pending = dict() # id(store) -> {"store", "turns", "last_turn"}
+        self.running = set() # id(store) of the sessions being summarized
+        self.cond = threading.Condition()
+        self.thread = None
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="summary")
+        self.on_summary = None # called with the store after each background summary, e.g. to share it with other workers
+
+    def start(self):
+        with self.cond:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="summary-worker", daemon=True)
+                self.thread.start()
+
+    def submit(self, store):
+        """
+        Called after every finished turn. Never blocks on the model
+        """
+        self.start()
+        with self.cond:
+            entry = self.pending.setdefault(id(store), {"store": store, "turns": 0, "last_turn": 0.0})
+            entry["turns"] += 1
+            entry["last_turn"] = time()
+            self.cond.notify()
+
+    def flush(self, store):
+        """
+        Run any pending summary for store right now. Used before the session is persisted
+        """
+        with self.cond:
+            entry = self.pending.pop(id(store), None)
+        # waits for a summary the worker may already be running for this session
+        with store.summary_lock:
+            if entry is not None:
+                store.update_summary()
+
+    def due(self, now: float):
+        """ Pop the sessions that should be summarized now and mark them running. Caller holds self.cond """
+        ready = []
+        for key, entry in list(self.pending.items()):
+            if key in self.running:
+                continue
+            if entry["turns"] >= self.every_n_turns or now - entry["last_turn"] >= self.idle_seconds:
+                ready.append((key, self.pending.pop(key)["store"]))
+                self.running.add(key)
+        return ready
+
+    def run(self):
+        while True:
+            with self.cond:
+                ready = self.due(time())
+                while len(ready) == 0:
+                    waiting = [e for key, e in self.pending.items() if key not in self.running]
+                    if len(waiting) == 0:
+                        self.cond.wait() # woken by submit or by a finished summary
+                    else:
+                        next_due = min(e["last_turn"] for e in waiting) + self.idle_seconds
+                        self.cond.wait(timeout=max(next_due - time(), 0.01))
+                    ready = self.due(time())
+            for key, store in ready:
+                self.pool.submit(self.summarize, key, store)
+
+    def summarize(self, key: int, store):
+        try:
+            with store.summary_lock:
+                store.update_summary()
+            if self.on_summary is not None:
+                self.on_summary(store)
+        except Exception as e:
+            print("Error updating summary: ", e)
+        finally:
+            with self.cond:
+                self.running.discard(key)
+                self.cond.notify()
+
+
+summary_worker = SummaryWorker()
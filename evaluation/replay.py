@@ -0,0 +1,201 @@
+"""
+Replays logged requests through the backend (HumanExternalDataStore.call_chat) for several models and writes
+a dataset scores.py can score directly: "Question", "Response" (the reference answer, if the record has one),
+"GPT Response" (the model's answer) and "Model", plus the latency of every stage.
+
+Each input line is a JSON object with a "message" (or "Question") and optionally a reference "response"
+(or "Response") and a "user". Records of the same user are replayed in order as one conversation,
+records without a user are conversations of their own. Conversations run concurrently, at most
+--concurrency at a time, and every model is held to --rate turns per second. A turn is several calls
+(the answer, its guardrail check and now and then a summary or key facts update), so the provider sees more.
+Turns answered with one of the backend's fallback messages (refused, unsure, model down) count as errors
+and are left out of scoring.
+
+Every model has to be served by a provider and allowed. Firestore is the in-memory stand-in unless
+--firestore and --confirm-firestore are given, and the response cache is off unless --cache
+is given, so every answer is really generated.
+
+Usage (from evaluation/):
+    python replay.py requests.jsonl --models gpt-4o-mini,gemini-2.0-flash --out replay.jsonl
+    python scores.py replay.jsonl --group-column Model --out replay_scores.csv
+"""
+import os
+import sys
+import json
+import argparse
+import tempfile
+import threading
+from datetime import datetime
+from time import time, sleep
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+BACKEND = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("inputs", nargs="+", help="JSONL request records")
+    parser.add_argument("--models", default="gpt-4o-mini", help="comma separated models to replay against")
+    parser.add_argument("--concurrency", type=int, default=8, help="conversations replayed at the same time")
+    parser.add_argument("--rate", type=float, default=2.0, help="turns per second allowed per model, 0 for no limit. Each turn makes a guardrail call too, and now and then summary and key facts calls")
+    parser.add_argument("--limit", type=int, default=None, help="only replay the first records")
+    parser.add_argument("--url", default="http://localhost/replay", help="requester url, localhost allows ollama models")
+    parser.add_argument("--firestore", action="store_true", help="use the real Firestore instead of the in-memory stand-in")
+    parser.add_argument("--confirm-firestore", action="store_true", help="needed with --firestore, replayed users are written to the production collections")
+    parser.add_argument("--cache", action="store_true", help="let repeated questions be answered from the response cache")
+    parser.add_argument("--fake", action="store_true", help="answer with fake models, to try the harness offline")
+    parser.add_argument("--out", default="replay.jsonl")
+    args = parser.parse_args()
+    if args.firestore and not args.confirm_firestore:
+        parser.error("--firestore writes every replayed user to the production Firestore, pass --confirm-firestore as well")
+    return args
+
+
+def read_records(paths: list[str], limit: int = None) -> list[dict]:
+    records = []
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                if line.strip() == "":
+                    continue
+                record = json.loads(line)
+                message = record.get("message", record.get("Question"))
+                if message is None:
+                    continue
+                records.append({
+                    "user": record.get("user"),
+                    "message": str(message),
+                    "reference": record.get("response", record.get("Response")),
+                })
+                if limit is not None and len(records) == limit:
+                    return records
+    return records
+
+
+def conversations(records: list[dict]) -> list[list[dict]]:
+    """ Records grouped per user, in their original order """
+    grouped = dict()
+    for i, record in enumerate(records):
+        grouped.setdefault(record["user"] if record["user"] is not None else ("record", i), []).append(record)
+    return list(grouped.values())
+
+
+class RateLimiter:
+    """
+    Token bucket shared by every thread calling one model
+    """
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.allowance = 1.0
+        self.last = time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time()
+                self.allowance = min(self.allowance + (now - self.last) * self.rate, 1.0)
+                self.last = now
+                if self.allowance >= 1.0:
+                    self.allowance -= 1.0
+                    return
+                wait = (1.0 - self.allowance) / self.rate
+            sleep(wait)
+
+
+def boot(args):
+    """
+    Import the backend. Environment switches have to be set before database is imported
+    """
+    sys.path.insert(0, BACKEND)
+    from dotenv import load_dotenv
+    load_dotenv(os.path.join(BACKEND, ".env"))
+    if not args.firestore:
+        os.environ["PT_FIRESTORE_BACKEND"] = "memory"
+    if not args.cache:
+        os.environ["RESPONSE_CACHE_SIZE"] = "0"
+    os.environ.setdefault("RETRIEVAL_DIR", tempfile.mkdtemp(prefix="pt-replay-")) # replayed users are new every run
+    if args.fake:
+        from fakes import FakeChatModel
+        from models import model_registry
+        fake = lambda model, **params: FakeChatModel(model=model, latency=0.1, latency_sigma=0.2)
+        model_registry.register_provider("openai", fake, prefix="gpt")
+        model_registry.register_provider("google", fake, prefix="gemini")
+    import database
+    return database
+
+
+def fallback_error(database, answer: str):
+    """ Why an answer is a fallback message rather than a model answer, None if it is a real answer """
+    fallbacks = {database.REFUSAL_MESSAGE: "refused", database.UNSURE_MESSAGE: "unsure", database.MODEL_DOWN_MESSAGE: "model down"}
+    return fallbacks.get(answer)
+
+
+def replay(database, model: str, conversation: list[dict], run_id: str, index: int, limiter: RateLimiter, url: str) -> list[dict]:
+    """ Replays one conversation against one model. Returns a row per record """
+    store = database.HumanExternalDataStore(f"replay-{model}", f"{run_id}-{index}", url)
+    store.model = model
+    rows = []
+    for turn, record in enumerate(conversation):
+        limiter.acquire()
+        start = time()
+        row = {"Question": record["message"], "Response": record["reference"], "Model": model,
+               "user": record["user"], "turn": turn}
+        try:
+            answer = store.call_chat(record["message"])
+            row["error"] = fallback_error(database, answer)
+            # a fallback is not the model's answer, left out of scoring like a failed call
+            row["GPT Response"] = answer if row["error"] is None else None
+        except Exception as e:
+            row["GPT Response"] = None
+            row["error"] = str(e)
+        row["latency"] = time() - start
+        row["langchain_rtt"] = store.last_langchain_rtt
+        row["prompt_tokens"] = store.last_prompt_tokens.get("chat")
+        for stage, seconds in store.last_stage_latency.items():
+            row["stage_" + stage] = seconds
+        rows.append(row)
+    store.close(wait=False)
+    return rows
+
+
+def percentile(samples: list[float], p: float) -> float:
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * p), len(samples) - 1)]
+
+
+def main():
+    args = parse_args()
+    database = boot(args)
+    models = [m.strip() for m in args.models.split(",") if m.strip() != ""]
+    # an unknown model would be answered by the session's previous client and still be labelled with its name
+    unknown = [m for m in models if database.model_registry.provider_for(m, args.url) is None]
+    if len(unknown) > 0:
+        sys.exit(f"no provider serves {', '.join(unknown)} (or they are not in ALLOWED_MODELS)")
+    limiters = {model: RateLimiter(args.rate) for model in models}
+    groups = conversations(read_records(args.inputs, args.limit))
+    run_id = datetime.now().strftime("%Y%m%d%H%M%S")
+    print(f"replaying {sum(len(g) for g in groups)} records in {len(groups)} conversations against {', '.join(models)}")
+
+    rows = []
+    with ThreadPoolExecutor(args.concurrency) as pool, open(args.out, "w") as out:
+        futures = [pool.submit(replay, database, model, group, run_id, i, limiters[model], args.url)
+                   for i, group in enumerate(groups) for model in models]
+        for future in as_completed(futures):
+            for row in future.result():
+                out.write(json.dumps(row) + "\n")
+                rows.append(row)
+
+    print(f"\n{'model':<24}{'rows':>6}{'errors':>8}{'p50 (ms)':>10}{'p95 (ms)':>10}")
+    for model in models:
+        latencies = [r["latency"] for r in rows if r["Model"] == model and r["error"] is None]
+        errors = sum(1 for r in rows if r["Model"] == model and r["error"] is not None)
+        p50, p95 = (percentile(latencies, 0.5) * 1e3, percentile(latencies, 0.95) * 1e3) if len(latencies) > 0 else (0, 0)
+        print(f"{model:<24}{len(latencies) + errors:>6}{errors:>8}{p50:>10.0f}{p95:>10.0f}")
+    print(f"saved to {args.out}, score it with: python scores.py {args.out} --group-column Model")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,55 +1,220 @@
-import pandas as pd
-import re
-import numpy as np
-from rouge_score import rouge_scorer
-from bert_score import score
-
-# Load Excel file
-df = pd.read_excel("data.xlsx")
-
-def cleanse(text):
-    text = str(text).lower().strip()
-    text = re.sub(r"\s+", " ", text)             # Remove whitespace and newlines
-    text = re.sub(r"[^\w\s]", "", text)          # Remove punctuation
-    return text
-
-gpt_responses_clean = df["GPT Response"].apply(cleanse).tolist()
-human_responses_clean = df["Response"].apply(cleanse).tolist()
-
-# ROUGE setup
-scorer = rouge_scorer.RougeScorer(['rouge1', 'rouge2', 'rougeL'], use_stemmer=True)
-rouge1_p, rouge1_r, rouge1_f1 = [], [], []
-rouge2_p, rouge2_r, rouge2_f1 = [], [], []
-rougeL_p, rougeL_r, rougeL_f1 = [], [], []
-
-# Compute ROUGE
-for ref, pred in zip(human_responses_clean, gpt_responses_clean):
-    scores = scorer.score(ref, pred)
-    rouge1_p.append(scores["rouge1"].precision)
-    rouge1_r.append(scores["rouge1"].recall)
-    rouge1_f1.append(scores["rouge1"].fmeasure)
-
-    rouge2_p.append(scores["rouge2"].precision)
-    rouge2_r.append(scores["rouge2"].recall)
-    rouge2_f1.append(scores["rouge2"].fmeasure)
-
-    rougeL_p.append(scores["rougeL"].precision)
-    rougeL_r.append(scores["rougeL"].recall)
-    rougeL_f1.append(scores["rougeL"].fmeasure)
-
-def compute_mean(scores):
-    if isinstance(scores, list):
-        return round(np.mean(scores), 4)
-    return round(scores.mean().item(), 4)
-
-print(f"\nROUGE-1: P = {compute_mean(rouge1_p)} R = {compute_mean(rouge1_r)} F1 = {compute_mean(rouge1_f1)}")
-print(f"ROUGE-2: P = {compute_mean(rouge2_p)} R = {compute_mean(rouge2_r)} F1 = {compute_mean(rouge2_f1)}")
-print(f"ROUGE-L: P = {compute_mean(rougeL_p)} R = {compute_mean(rougeL_r)} F1 = {compute_mean(rougeL_f1)}")
-
-# Compute BERTScore
-P, R, F1 = score(gpt_responses_clean, human_responses_clean, lang="en")
-
-print("\nBERTScore:")
-print(f"Precision: {compute_mean(P)}")
-print(f"Recall   : {compute_mean(R)}")
-print(f"F1       : {compute_mean(F1)}")
+"""
+Scores model answers against reference answers with ROUGE-1/2/L and BERTScore.
+
+Inputs (xlsx, CSV or JSONL) are read in chunks, ROUGE runs across a process pool and BERTScore in batches
+with the model loaded once. Scores are cached on disk per row, keyed by a hash of the cleaned reference,
+the cleaned prediction and the metric config, so re-running on a dataset with a few new rows only scores those.
+Writes every row with its scores (CSV) plus the averages (JSON).
+
+Usage:
+    python scores.py                                   # data.xlsx, "Response" vs "GPT Response"
+    python scores.py replay.jsonl --prediction-column "GPT Response" --out replay_scores.csv
+    python scores.py data.xlsx --no-bert --workers 4
+"""
+import os
+import re
+import sys
+import json
+import hashlib
+import sqlite3
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+
+ROUGE_TYPES = ["rouge1", "rouge2", "rougeL"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("inputs", nargs="*", default=["data.xlsx"], help="xlsx, csv or jsonl files")
+    parser.add_argument("--reference-column", default="Response")
+    parser.add_argument("--prediction-column", default="GPT Response")
+    parser.add_argument("--group-column", default=None, help="also average per value of this column, e.g. Model")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="rows read and scored at a time")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="processes computing ROUGE")
+    parser.add_argument("--no-bert", action="store_true", help="only compute ROUGE")
+    parser.add_argument("--bert-model", default=None, help="defaults to bert_score's model for --lang")
+    parser.add_argument("--bert-batch-size", type=int, default=32)
+    parser.add_argument("--lang", default="en")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--cache", default=".score_cache.sqlite", help="per-row score cache")
+    parser.add_argument("--out", default="scores.csv", help="per-row scores")
+    parser.add_argument("--summary", default="scores_summary.json", help="averages")
+    return parser.parse_args()
+
+
+def cleanse(text):
+    text = str(text).lower().strip()
+    text = re.sub(r"\s+", " ", text)             # Remove whitespace and newlines
+    text = re.sub(r"[^\w\s]", "", text)          # Remove punctuation
+    return text
+
+
+def read_chunks(path: str, chunk_size: int):
+    """ Yields DataFrames of up to chunk_size rows, without loading the whole file """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".csv":
+        yield from pd.read_csv(path, chunksize=chunk_size)
+    elif extension in (".jsonl", ".json"):
+        yield from pd.read_json(path, lines=True, chunksize=chunk_size)
+    elif extension in (".xlsx", ".xlsm"):
+        from openpyxl import load_workbook
+        workbook = load_workbook(path, read_only=True, data_only=True)
+        rows = workbook.active.iter_rows(values_only=True)
+        header = [str(h) for h in next(rows)]
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                yield pd.DataFrame(chunk, columns=header)
+                chunk = []
+        if len(chunk) > 0:
+            yield pd.DataFrame(chunk, columns=header)
+        workbook.close()
+    else:
+        raise ValueError(f"Unsupported input {path}, expected xlsx, csv or jsonl")
+
+
+class ScoreCache:
+    """
+    Scores per (metric, row key) in a SQLite file
+    """
+    def __init__(self, path: str):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS scores (key TEXT PRIMARY KEY, scores TEXT NOT NULL)")
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, keys: list[str]) -> dict:
+        found = dict()
+        for start in range(0, len(keys), 500): # SQLite caps the number of parameters
+            batch = keys[start:start + 500]
+            rows = self.conn.execute(f"SELECT key, scores FROM scores WHERE key IN ({','.join('?' * len(batch))})", batch)
+            found.update((key, json.loads(scores)) for key, scores in rows)
+        self.hits += len(found)
+        self.misses += len(set(keys)) - len(found)
+        return found
+
+    def put_many(self, entries: dict):
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO scores VALUES (?, ?)", [(k, json.dumps(v)) for k, v in entries.items()])
+
+
+def row_key(config: dict, reference: str, prediction: str) -> str:
+    return hashlib.sha256(json.dumps([config, reference, prediction]).encode("utf-8")).hexdigest()
+
+
+rouge = None # RougeScorer of this worker process
+
+def init_rouge():
+    global rouge
+    from rouge_score import rouge_scorer
+    rouge = rouge_scorer.RougeScorer(ROUGE_TYPES, use_stemmer=True)
+
+def rouge_row(pair: tuple[str, str]) -> dict:
+    scores = rouge.score(*pair)
+    row = dict()
+    for rouge_type in ROUGE_TYPES:
+        row[rouge_type + "_p"] = scores[rouge_type].precision
+        row[rouge_type + "_r"] = scores[rouge_type].recall
+        row[rouge_type + "_f1"] = scores[rouge_type].fmeasure
+    return row
+
+
+class Scorer:
+    """
+    Used to score chunks of (reference, prediction) pairs. Each metric is only computed for the pairs
+    the cache does not have under the current config
+    """
+    def __init__(self, args, cache: ScoreCache):
+        self.args = args
+        self.cache = cache
+        self.pool = ProcessPoolExecutor(max_workers=args.workers, initializer=init_rouge)
+        self.rouge_config = {"metric": "rouge", "types": ROUGE_TYPES, "stemmer": True}
+        self.bert_config = {"metric": "bertscore", "model": args.bert_model, "lang": args.lang}
+        self.bert = None # loaded on the first chunk that needs it
+
+    def bert_scorer(self):
+        if self.bert is None:
+            from bert_score import BERTScorer
+            self.bert = BERTScorer(model_type=self.args.bert_model, lang=self.args.lang,
+                                   batch_size=self.args.bert_batch_size, device=self.args.device)
+        return self.bert
+
+    def rouge(self, pairs: list[tuple[str, str]]) -> list[dict]:
+        chunksize = max(len(pairs) // (self.args.workers * 4), 1)
+        return list(self.pool.map(rouge_row, pairs, chunksize=chunksize))
+
+    def bertscore(self, pairs: list[tuple[str, str]]) -> list[dict]:
+        references = [ref for ref, _ in pairs]
+        predictions = [pred for _, pred in pairs]
+        P, R, F1 = self.bert_scorer().score(predictions, references, batch_size=self.args.bert_batch_size)
+        return [{"bert_p": p, "bert_r": r, "bert_f1": f} for p, r, f in zip(P.tolist(), R.tolist(), F1.tolist())]
+
+    def metric(self, config: dict, compute, pairs: list[tuple[str, str]]) -> list[dict]:
+        keys = [row_key(config, ref, pred) for ref, pred in pairs]
+        cached = self.cache.get_many(keys)
+        missing = dict() # key -> pair, repeated rows are scored once
+        for key, pair in zip(keys, pairs):
+            if key not in cached:
+                missing[key] = pair
+        if len(missing) > 0:
+            computed = dict(zip(missing.keys(), compute(list(missing.values()))))
+            self.cache.put_many(computed)
+            cached.update(computed)
+        return [cached[key] for key in keys]
+
+    def score(self, references: list[str], predictions: list[str]) -> pd.DataFrame:
+        pairs = list(zip(references, predictions))
+        rows = self.metric(self.rouge_config, self.rouge, pairs)
+        if not self.args.no_bert:
+            rows = [{**r, **b} for r, b in zip(rows, self.metric(self.bert_config, self.bertscore, pairs))]
+        return pd.DataFrame(rows)
+
+
+def main():
+    args = parse_args()
+    cache = ScoreCache(args.cache)
+    scorer = Scorer(args, cache)
+    if os.path.exists(args.out):
+        os.remove(args.out)
+    totals = dict() # group -> (sum of every score column, rows)
+    for path in args.inputs:
+        for chunk in read_chunks(path, args.chunk_size):
+            chunk = chunk.dropna(subset=[args.reference_column, args.prediction_column]).reset_index(drop=True)
+            if len(chunk) == 0:
+                continue
+            references = chunk[args.reference_column].apply(cleanse).tolist()
+            predictions = chunk[args.prediction_column].apply(cleanse).tolist()
+            scored = pd.concat([chunk, scorer.score(references, predictions)], axis=1)
+            scored.insert(0, "input_file", os.path.basename(path))
+            scored.to_csv(args.out, mode="a", header=not os.path.exists(args.out), index=False)
+            score_columns = [c for c in scored.columns if c.endswith(("_p", "_r", "_f1"))]
+            groups = [("all", scored)] if args.group_column is None else [("all", scored)] + list(scored.groupby(args.group_column))
+            for group, rows in groups:
+                sums, count = totals.get(str(group), (pd.Series(0.0, index=score_columns), 0))
+                totals[str(group)] = (sums + rows[score_columns].sum(), count + len(rows))
+            print(f"{path}: scored {len(chunk)} rows ({cache.hits} cached, {cache.misses} new so far)", file=sys.stderr)
+    scorer.pool.shutdown()
+
+    summary = {group: {"rows": count, **{k: round(v / count, 4) for k, v in sums.items()}} for group, (sums, count) in totals.items()}
+    summary["cache"] = {"hits": cache.hits, "misses": cache.misses}
+    with open(args.summary, "w") as f:
+        json.dump(summary, f, indent=2)
+
+    for group, means in summary.items():
+        if group == "cache":
+            continue
+        print(f"\n{group} ({means['rows']} rows)")
+        for rouge_type, name in zip(ROUGE_TYPES, ["ROUGE-1", "ROUGE-2", "ROUGE-L"]):
+            print(f"{name}: P = {means[rouge_type + '_p']} R = {means[rouge_type + '_r']} F1 = {means[rouge_type + '_f1']}")
+        if "bert_f1" in means:
+            print("BERTScore:")
+            print(f"Precision: {means['bert_p']}")
+            print(f"Recall   : {means['bert_r']}")
+            print(f"F1       : {means['bert_f1']}")
+    print(f"\nper-row scores in {args.out}, averages in {args.summary}")
+
+
+if __name__ == '__main__':
+    main()